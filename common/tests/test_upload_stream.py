@@ -0,0 +1,72 @@
+import http.server
+import io
+import os
+import pytest
+import requests
+import zstandard as zstd
+
+from openpilot.common.utils import LOG_COMPRESSION_LEVEL, UPLOAD_READ_SIZE, ZstdUploadStream, get_upload_stream
+from openpilot.selfdrive.test.helpers import http_server_context
+
+
+class RecordingHandler(http.server.BaseHTTPRequestHandler):
+  received: list[tuple[dict, bytes]] = []
+
+  def do_PUT(self):
+    length = int(self.headers['Content-Length'])
+    RecordingHandler.received.append((dict(self.headers), self.rfile.read(length)))
+    self.send_response(201, "Created")
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
+@pytest.fixture
+def log_file(tmp_path):
+  fn = tmp_path / "rlog"
+  # mix of compressible and incompressible data, spanning several read chunks
+  fn.write_bytes(b"".join(os.urandom(100_000) + bytes(400_000) for _ in range(8)))
+  return str(fn)
+
+
+class TestUploadStream:
+  def test_compressed_length(self, log_file):
+    expected = io.BytesIO()
+    with open(log_file, "rb") as f:
+      zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL).copy_stream(f, expected)
+
+    stream, length = get_upload_stream(log_file, True)
+    with stream:
+      data = stream.read(8192) + stream.read()
+
+    assert length == len(data)
+    assert data == expected.getvalue()
+
+  @pytest.mark.parametrize("spool_size", [1024, 64 * 1024 * 1024])
+  def test_spool(self, log_file, tmp_path, spool_size):
+    spool_dir = tmp_path / "spool"
+    with ZstdUploadStream(log_file, spool_size=spool_size, spool_dir=str(spool_dir)) as stream, open(log_file, "rb") as f:
+      # only kept in memory while small enough, then in spool_dir
+      assert stream.f._rolled == (stream.len > spool_size)
+      if stream.f._rolled:
+        assert os.path.dirname(os.readlink(f"/proc/self/fd/{stream.f.fileno()}")) == str(spool_dir)
+      assert zstd.ZstdDecompressor().decompressobj().decompress(stream.read()) == f.read()
+
+  @pytest.mark.parametrize("compress", [True, False])
+  def test_upload(self, log_file, compress):
+    RecordingHandler.received.clear()
+    stream, length = get_upload_stream(log_file, compress)
+    with http_server_context(RecordingHandler) as (host, port), stream:
+      resp = requests.put(f"http://{host}:{port}/rlog.zst", data=stream, timeout=10)
+    assert resp.status_code == 201
+
+    headers, body = RecordingHandler.received[0]
+    assert int(headers['Content-Length']) == length == len(body)
+    assert 'Transfer-Encoding' not in headers
+
+    with open(log_file, "rb") as f:
+      raw = f.read()
+    assert (zstd.ZstdDecompressor().decompressobj().decompress(body) if compress else body) == raw
+    if compress:
+      assert len(body) < len(raw) > UPLOAD_READ_SIZE
@@ -9,6 +9,8 @@ from subprocess import Popen, PIPE, TimeoutExpired
 import zstandard as zstd
 
 LOG_COMPRESSION_LEVEL = 10  # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_READ_SIZE = 1024 * 1024
+UPLOAD_SPOOL_SIZE = 4 * 1024 * 1024
 
 
 def sudo_write(val: str, path: str) -> None:
@@ -93,21 +95,46 @@ def atomic_write(path: str, mode: str = 'w', buffering: int = -1, encoding: str
   os.replace(tmp_file_name, path)
 
 
-def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.BufferedIOBase, int]:
+class ZstdUploadStream:
+  """Compresses a file with zstd for uploading. Uploads need the exact compressed size up front, so the whole file is
+  compressed once into a temporary file before the upload starts, and compression doesn't overlap with the transfer.
+  The temporary file is only kept in memory while it's smaller than spool_size, then moves to spool_dir, which should
+  be disk backed since the default temp dir can be tmpfs."""
+
+  def __init__(self, filepath: str, read_size: int = UPLOAD_READ_SIZE, spool_size: int = UPLOAD_SPOOL_SIZE,
+               spool_dir: str | None = None):
+    if spool_dir is not None:
+      os.makedirs(spool_dir, exist_ok=True)
+    self.f = tempfile.SpooledTemporaryFile(max_size=spool_size, dir=spool_dir)
+    try:
+      with open(filepath, "rb") as raw:
+        _, self.len = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL).copy_stream(raw, self.f, read_size=read_size)
+      self.f.seek(0)
+    except Exception:
+      self.f.close()
+      raise
+
+  def read(self, size: int = -1) -> bytes:
+    return self.f.read(size)
+
+  def close(self) -> None:
+    self.f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+
+def get_upload_stream(filepath: str, should_compress: bool, spool_dir: str | None = None) -> tuple[io.BufferedIOBase | ZstdUploadStream, int]:
   if not should_compress:
     file_size = os.path.getsize(filepath)
     file_stream = open(filepath, "rb")
     return file_stream, file_size
 
-  # Compress the file on the fly
-  compressed_stream = io.BytesIO()
-  compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
-
-  with open(filepath, "rb") as f:
-    compressor.copy_stream(f, compressed_stream)
-    compressed_size = compressed_stream.tell()
-    compressed_stream.seek(0)
-    return compressed_stream, compressed_size
+  compressed_stream = ZstdUploadStream(filepath, spool_dir=spool_dir)
+  return compressed_stream, compressed_stream.len
 
 
 # remove all keys that end in DEPRECATED
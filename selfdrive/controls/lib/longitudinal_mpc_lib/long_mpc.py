@@ -2,6 +2,7 @@
 import os
 import time
 import numpy as np
+from typing import NamedTuple
 from cereal import log
 from opendbc.car.interfaces import ACCEL_MIN, ACCEL_MAX
 from openpilot.common.realtime import DT_MDL
@@ -221,6 +222,13 @@ def gen_long_ocp():
   return ocp
 
 
+class BatchSolution(NamedTuple):
+  x_sol: np.ndarray  # (B, N+1, X_DIM)
+  u_sol: np.ndarray  # (B, N, U_DIM)
+  solve_time: np.ndarray  # (B,)
+  solution_status: np.ndarray  # (B,)
+
+
 class LongitudinalMpc:
   def __init__(self, mode='acc', dt=DT_MDL):
     self.mode = mode
@@ -327,6 +335,132 @@ class LongitudinalMpc:
     lead_xv = self.extrapolate_lead(x_lead, v_lead, a_lead, a_lead_tau)
     return lead_xv
 
+  @staticmethod
+  def process_leads(v_ego, x_lead, v_lead, a_lead, a_lead_tau, status):
+    """Vectorized process_lead, taking arrays of B lead states and returning lead trajectories of shape (B, N+1, 2)"""
+    v_ego, status = np.asarray(v_ego, dtype=float), np.asarray(status, dtype=bool)
+    x_lead = np.where(status, x_lead, 50.0)
+    v_lead = np.where(status, v_lead, v_ego + 10.0)
+    a_lead = np.where(status, a_lead, 0.0)
+    a_lead_tau = np.where(status, a_lead_tau, _LEAD_ACCEL_TAU)
+
+    min_x_lead = ((v_ego + v_lead)/2) * (v_ego - v_lead) / (-ACCEL_MIN * 2)
+    x_lead = np.clip(x_lead, min_x_lead, 1e8)
+    v_lead = np.clip(v_lead, 0.0, 1e8)
+    a_lead = np.clip(a_lead, -10., 5.)
+
+    a_lead_traj = a_lead[:,None] * np.exp(-a_lead_tau[:,None] * (T_IDXS**2)/2.)
+    v_lead_traj = np.clip(v_lead[:,None] + np.cumsum(T_DIFFS * a_lead_traj, axis=1), 0.0, 1e8)
+    x_lead_traj = x_lead[:,None] + np.cumsum(T_DIFFS * v_lead_traj, axis=1)
+    return np.stack((x_lead_traj, v_lead_traj), axis=-1)
+
+  def batch_references(self, v_ego, lead_xv_0, lead_xv_1, v_cruise, prev_a, t_follow, x=None, v=None, a=None, j=None):
+    """Vectorized yref and params of update for B samples, of shapes (B, N+1, COST_DIM) and (B, N+1, PARAM_DIM)"""
+    B = len(v_ego)
+    v_ego = np.asarray(v_ego, dtype=float)[:,None]
+    lead_0_obstacle = lead_xv_0[...,0] + get_stopped_equivalence_factor(lead_xv_0[...,1])
+    lead_1_obstacle = lead_xv_1[...,0] + get_stopped_equivalence_factor(lead_xv_1[...,1])
+
+    yref = np.zeros((B, N+1, COST_DIM))
+    params = np.zeros((B, N+1, PARAM_DIM))
+    params[...,0] = ACCEL_MIN
+    params[...,1] = ACCEL_MAX
+
+    if self.mode == 'acc':
+      params[...,5] = LEAD_DANGER_FACTOR
+
+      v_lower = v_ego + (T_IDXS * CRUISE_MIN_ACCEL * 1.05)
+      v_upper = v_ego + (T_IDXS * CRUISE_MAX_ACCEL * 1.05)
+      v_cruise_clipped = np.clip(np.asarray(v_cruise, dtype=float)[:,None], v_lower, v_upper)
+      cruise_obstacle = np.cumsum(T_DIFFS * v_cruise_clipped, axis=1) + get_safe_obstacle_distance(v_cruise_clipped, t_follow)
+      x_obstacles = np.stack([lead_0_obstacle, lead_1_obstacle, cruise_obstacle], axis=-1)
+
+    elif self.mode == 'blended':
+      assert x is not None and v is not None and a is not None and j is not None, "blended mode needs the model trajectory"
+      params[...,5] = 1.0
+
+      x_obstacles = np.stack([lead_0_obstacle, lead_1_obstacle], axis=-1)
+      cruise_target = T_IDXS * np.clip(np.asarray(v_cruise, dtype=float)[:,None], v_ego - 2.0, 1e3) + x[:,:1]
+      xforward = ((v[:,1:] + v[:,:-1]) / 2) * (T_IDXS[1:] - T_IDXS[:-1])
+      x = np.cumsum(np.concatenate([x[:,:1], xforward], axis=1), axis=1)
+
+      yref[...,1] = np.minimum(x, cruise_target)
+      yref[...,2] = v
+      yref[...,3] = a
+      yref[...,5] = j
+
+    else:
+      raise NotImplementedError(f'Planner mode {self.mode} not recognized in planner update')
+
+    params[...,2] = np.min(x_obstacles, axis=-1)
+    params[...,3] = prev_a
+    params[...,4] = t_follow
+    return yref, params
+
+  def solve_batch(self, v_ego, a_ego, lead_xv_0, lead_xv_1, v_cruise, prev_a=None, x=None, v=None, a=None, j=None,
+                  personality=log.LongitudinalPersonality.standard, warm_start=True) -> BatchSolution:
+    """
+    Solves the MPC for B independent samples, such as logged radarState snapshots, as update would for each.
+
+    The lead trajectories are of shape (B, N+1, 2), see process_leads. prev_a defaults to holding a_ego over
+    the horizon, and the model trajectory x, v, a, j of shape (B, N+1) is only used in blended mode.
+    With warm_start, each solve starts from the previous sample's solution, like consecutive update calls,
+    so samples in time order converge fastest. The solver is reset before and after, dropping any state of update.
+    """
+    v_ego = np.asarray(v_ego, dtype=float)
+    a_ego = np.asarray(a_ego, dtype=float)
+    B = len(v_ego)
+    if prev_a is None:
+      prev_a = np.repeat(a_ego[:,None], N+1, axis=1)
+    yref, params = self.batch_references(v_ego, lead_xv_0, lead_xv_1, v_cruise, prev_a, get_T_FOLLOW(personality), x, v, a, j)
+
+    out = BatchSolution(np.zeros((B, N+1, X_DIM)), np.zeros((B, N, U_DIM)), np.zeros(B), np.zeros(B, dtype=int))
+    self.reset()
+    self.set_weights(personality=personality)
+    # references are constant in acc mode, so they're only set once
+    set_yref = self.mode != 'acc'
+    if not set_yref and B:
+      for i in range(N):
+        self.solver.set(i, "yref", yref[0, i])
+      self.solver.set(N, "yref", yref[0, N, :COST_E_DIM])
+
+    x0 = np.zeros(X_DIM)
+    init_x = True
+    for b in range(B):
+      v_prev = x0[1]
+      x0[1] = v_ego[b]
+      x0[2] = a_ego[b]
+      if not warm_start:
+        self.solver.reset()
+        init_x = True
+      if init_x or abs(v_prev - x0[1]) > 2.:
+        for i in range(N+1):
+          self.solver.set(i, 'x', x0)
+
+      if set_yref:
+        for i in range(N):
+          self.solver.set(i, "yref", yref[b, i])
+        self.solver.set(N, "yref", yref[b, N, :COST_E_DIM])
+      for i in range(N+1):
+        self.solver.set(i, 'p', params[b, i])
+      self.solver.constraints_set(0, "lbx", x0)
+      self.solver.constraints_set(0, "ubx", x0)
+
+      out.solution_status[b] = self.solver.solve()
+      out.solve_time[b] = self.solver.get_stats('time_tot')[0]
+      for i in range(N+1):
+        out.x_sol[b, i] = self.solver.get(i, 'x')
+      for i in range(N):
+        out.u_sol[b, i] = self.solver.get(i, 'u')
+
+      # like run, don't carry a failed solution over to the next sample
+      init_x = out.solution_status[b] != 0
+      if init_x:
+        self.solver.reset()
+
+    self.reset()
+    return out
+
   def update(self, radarstate, v_cruise, x, v, a, j, personality=log.LongitudinalPersonality.standard):
     t_follow = get_T_FOLLOW(personality)
     v_ego = self.x0[1]
@@ -8,6 +8,28 @@ from openpilot.selfdrive.controls.lib.longitudinal_planner import LongitudinalPl
 import cereal.messaging as messaging
 
 
+class PlannerD:
+  def __init__(self, CP):
+    self.ldw = LaneDepartureWarning()
+    self.longitudinal_planner = LongitudinalPlanner(CP)
+    self.pm = messaging.PubMaster(['longitudinalPlan', 'driverAssistance'])
+    self.sm = messaging.SubMaster(['carControl', 'carState', 'controlsState', 'liveParameters', 'radarState', 'modelV2', 'selfdriveState'],
+                                  poll='modelV2')
+
+  def step(self):
+    self.sm.update()
+    if self.sm.updated['modelV2']:
+      self.longitudinal_planner.update(self.sm)
+      self.longitudinal_planner.publish(self.sm, self.pm)
+
+      self.ldw.update(self.sm.frame, self.sm['modelV2'], self.sm['carState'], self.sm['carControl'])
+      msg = messaging.new_message('driverAssistance')
+      msg.valid = self.sm.all_checks(['carState', 'carControl', 'modelV2', 'liveParameters'])
+      msg.driverAssistance.leftLaneDeparture = self.ldw.left
+      msg.driverAssistance.rightLaneDeparture = self.ldw.right
+      self.pm.send('driverAssistance', msg)
+
+
 def main():
   config_realtime_process(5, Priority.CTRL_LOW)
 
@@ -16,24 +38,9 @@ def main():
   CP = messaging.log_from_bytes(params.get("CarParams", block=True), car.CarParams)
   cloudlog.info("plannerd got CarParams: %s", CP.brand)
 
-  ldw = LaneDepartureWarning()
-  longitudinal_planner = LongitudinalPlanner(CP)
-  pm = messaging.PubMaster(['longitudinalPlan', 'driverAssistance'])
-  sm = messaging.SubMaster(['carControl', 'carState', 'controlsState', 'liveParameters', 'radarState', 'modelV2', 'selfdriveState'],
-                           poll='modelV2')
-
+  plannerd = PlannerD(CP)
   while True:
-    sm.update()
-    if sm.updated['modelV2']:
-      longitudinal_planner.update(sm)
-      longitudinal_planner.publish(sm, pm)
-
-      ldw.update(sm.frame, sm['modelV2'], sm['carState'], sm['carControl'])
-      msg = messaging.new_message('driverAssistance')
-      msg.valid = sm.all_checks(['carState', 'carControl', 'modelV2', 'liveParameters'])
-      msg.driverAssistance.leftLaneDeparture = ldw.left
-      msg.driverAssistance.rightLaneDeparture = ldw.right
-      pm.send('driverAssistance', msg)
+    plannerd.step()
 
 
 if __name__ == "__main__":
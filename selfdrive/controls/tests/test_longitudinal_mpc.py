@@ -0,0 +1,68 @@
+import numpy as np
+from types import SimpleNamespace
+
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import LongitudinalMpc, N
+
+
+def make_lead(x_lead, v_lead, a_lead, status=True):
+  return SimpleNamespace(dRel=x_lead, vLead=v_lead, aLeadK=a_lead, aLeadTau=1.5, status=status, modelProb=1.0)
+
+
+# (v_ego, a_ego, lead one, v_cruise)
+SAMPLES = [
+  (25., 0., make_lead(120., 0., 0.), 30.),
+  (20., -1., make_lead(30., 15., -2.), 25.),
+  (10., 0.5, make_lead(50., 20., 1., status=False), 15.),
+  (30., 0., make_lead(5., 35., 0.), 35.),
+]
+
+
+def run_batch(mpc, samples, **kwargs):
+  v_ego = np.array([s[0] for s in samples])
+  a_ego = np.array([s[1] for s in samples])
+  leads = [s[2] for s in samples]
+  lead_xv_0 = LongitudinalMpc.process_leads(v_ego, *(np.array([getattr(lead, f) for lead in leads])
+                                                     for f in ('dRel', 'vLead', 'aLeadK', 'aLeadTau', 'status')))
+  lead_xv_1 = LongitudinalMpc.process_leads(v_ego, *np.zeros((5, len(samples))))
+  v_cruise = np.array([s[3] for s in samples])
+  return mpc.solve_batch(v_ego, a_ego, lead_xv_0, lead_xv_1, v_cruise, **kwargs)
+
+
+class TestLongitudinalMpcBatch:
+  def test_process_leads(self):
+    mpc = LongitudinalMpc()
+    v_ego = np.array([s[0] for s in SAMPLES])
+    leads = [s[2] for s in SAMPLES]
+    batch = LongitudinalMpc.process_leads(v_ego, *(np.array([getattr(lead, f) for lead in leads])
+                                                  for f in ('dRel', 'vLead', 'aLeadK', 'aLeadTau', 'status')))
+    for i, lead in enumerate(leads):
+      mpc.x0[1] = v_ego[i]
+      np.testing.assert_allclose(batch[i], mpc.process_lead(lead))
+
+  def test_matches_update(self):
+    batch = run_batch(LongitudinalMpc(), SAMPLES, prev_a=np.zeros((len(SAMPLES), N+1)), warm_start=False)
+    assert batch.x_sol.shape == (len(SAMPLES), N+1, 3)
+    assert batch.u_sol.shape == (len(SAMPLES), N, 1)
+
+    for i, (v_ego, a_ego, lead, v_cruise) in enumerate(SAMPLES):
+      mpc = LongitudinalMpc()
+      mpc.set_cur_state(v_ego, a_ego)
+      radarstate = SimpleNamespace(leadOne=lead, leadTwo=make_lead(0., 0., 0., status=False))
+      mpc.update(radarstate, v_cruise, *np.zeros((4, N+1)))
+
+      assert batch.solution_status[i] == mpc.solution_status
+      assert batch.solve_time[i] > 0
+      np.testing.assert_allclose(batch.x_sol[i], mpc.x_sol, atol=1e-6)
+      np.testing.assert_allclose(batch.u_sol[i], mpc.u_sol, atol=1e-6)
+
+  def test_warm_start(self):
+    # a lead slowly closing in, sampled at the model rate
+    samples = [(20., 0., make_lead(60. - 0.25 * i, 15., 0.), 25.) for i in range(50)]
+    mpc = LongitudinalMpc()
+    warm = run_batch(mpc, samples)
+    cold = run_batch(mpc, samples, warm_start=False)
+
+    assert np.all(warm.solution_status == 0)
+    # both start from the current state, after which warm starting carries the previous solution over
+    np.testing.assert_allclose(warm.x_sol[0], cold.x_sol[0])
+    assert not np.allclose(warm.x_sol[1:], cold.x_sol[1:])
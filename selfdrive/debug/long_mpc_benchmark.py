@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import argparse
+import time
+import numpy as np
+from types import SimpleNamespace
+
+from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import LongitudinalMpc, N
+from openpilot.tools.lib.logreader import LogReader
+
+LEAD_FIELDS = ('dRel', 'vLead', 'aLeadK', 'aLeadTau', 'status')
+
+
+def random_samples(n, seed=0):
+  rng = np.random.default_rng(seed)
+  v_ego = rng.uniform(0., 35., n)
+  leads = [{
+    'dRel': rng.uniform(5., 150., n),
+    'vLead': np.clip(v_ego + rng.normal(0., 5., n), 0., None),
+    'aLeadK': rng.normal(0., 1., n),
+    'aLeadTau': np.full(n, 1.5),
+    'status': rng.random(n) < 0.8,
+  } for _ in range(2)]
+  return v_ego, rng.normal(0., 0.5, n), leads, v_ego + rng.uniform(0., 10., n)
+
+
+def route_samples(route):
+  v_ego, a_ego, v_cruise = [], [], []
+  leads = [{f: [] for f in LEAD_FIELDS} for _ in range(2)]
+  car_state = None
+  for msg in LogReader(route):
+    if msg.which() == 'carState':
+      car_state = msg.carState
+    elif msg.which() == 'radarState' and car_state is not None:
+      v_ego.append(car_state.vEgo)
+      a_ego.append(car_state.aEgo)
+      v_cruise.append(car_state.vCruise / 3.6)
+      for lead, msg_lead in zip(leads, (msg.radarState.leadOne, msg.radarState.leadTwo), strict=True):
+        for f in LEAD_FIELDS:
+          lead[f].append(getattr(msg_lead, f))
+  return np.array(v_ego), np.array(a_ego), [{f: np.array(v) for f, v in lead.items()} for lead in leads], np.array(v_cruise)
+
+
+def run_update(mpc, v_ego, a_ego, leads, v_cruise):
+  zeros = np.zeros(N+1)
+  for i in range(len(v_ego)):
+    lead_one, lead_two = (SimpleNamespace(modelProb=1.0, **{f: lead[f][i] for f in LEAD_FIELDS}) for lead in leads)
+    mpc.set_cur_state(v_ego[i], a_ego[i])
+    mpc.update(SimpleNamespace(leadOne=lead_one, leadTwo=lead_two), v_cruise[i], zeros, zeros, zeros, zeros)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark longitudinal MPC solves per second")
+  parser.add_argument("--route", help="Evaluate on the radarState snapshots of a route instead of random ones")
+  parser.add_argument("-n", type=int, default=10000, help="Number of random samples")
+  args = parser.parse_args()
+
+  v_ego, a_ego, leads, v_cruise = route_samples(args.route) if args.route else random_samples(args.n)
+  n = len(v_ego)
+  mpc = LongitudinalMpc()
+
+  st = time.monotonic()
+  run_update(mpc, v_ego, a_ego, leads, v_cruise)
+  print(f"{'update:':19s}{n / (time.monotonic() - st):8.0f} solves/s")
+
+  for warm_start in (True, False):
+    st = time.monotonic()
+    lead_xv_0, lead_xv_1 = (LongitudinalMpc.process_leads(v_ego, *(lead[f] for f in LEAD_FIELDS)) for lead in leads)
+    sol = mpc.solve_batch(v_ego, a_ego, lead_xv_0, lead_xv_1, v_cruise, warm_start=warm_start)
+    dt = time.monotonic() - st
+    solve_time = sol.solve_time * 1e3
+    name = "solve_batch" if warm_start else "solve_batch (cold)"
+    p50, p99 = np.percentile(solve_time, [50, 99])
+    print(f"{name + ':':19s}{n / dt:8.0f} solves/s, solve_time p50 {p50:.3f}ms p99 {p99:.3f}ms, {np.count_nonzero(sol.solution_status)}/{n} failed")
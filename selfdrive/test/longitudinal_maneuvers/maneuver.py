@@ -1,6 +1,11 @@
+import concurrent.futures
+import os
 import numpy as np
 from openpilot.selfdrive.test.longitudinal_maneuvers.plant import Plant
 
+# columns of the logs returned by Maneuver.evaluate
+LOG_COLUMNS = ("time", "distance", "distance_lead", "speed", "speed_lead", "acceleration", "solve_time")
+
 
 class Maneuver:
   def __init__(self, title, duration, **kwargs):
@@ -60,7 +65,8 @@ class Maneuver:
                             log['distance_lead'],
                             log['speed'],
                             speed_lead,
-                            log['acceleration']]))
+                            log['acceleration'],
+                            log['solve_time']]))
 
       if d_rel < .4 and (self.only_radar or prob_lead > 0.5):
         print("Crashed!!!!")
@@ -81,3 +87,28 @@ class Maneuver:
 
     print("maneuver end", valid)
     return valid, np.array(logs)
+
+
+def run_maneuvers(maneuvers, n_jobs=None, return_exceptions=False):
+  """
+  Evaluates maneuvers in a pool of n_jobs worker processes (all cores by default),
+  returning the (valid, logs) of each in the order of maneuvers.
+  With return_exceptions, a maneuver that raises returns its exception instead, and the others still run.
+  """
+  n_jobs = n_jobs or os.cpu_count() or 1
+  if n_jobs <= 1 or len(maneuvers) <= 1:
+    results = []
+    for m in maneuvers:
+      try:
+        results.append(m.evaluate())
+      except Exception as e:
+        if not return_exceptions:
+          raise
+        results.append(e)
+    return results
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=min(n_jobs, len(maneuvers))) as pool:
+    futures = [pool.submit(Maneuver.evaluate, m) for m in maneuvers]
+    if not return_exceptions:
+      return [f.result() for f in futures]
+    return [f.exception() or f.result() for f in futures]
@@ -12,19 +12,16 @@ from openpilot.selfdrive.controls.radard import _LEAD_ACCEL_TAU
 
 
 class Plant:
-  messaging_initialized = False
-
   def __init__(self, lead_relevancy=False, speed=0.0, distance_lead=2.0,
-               enabled=True, only_lead2=False, only_radar=False, e2e=False, personality=0, force_decel=False):
+               enabled=True, only_lead2=False, only_radar=False, e2e=False, personality=0, force_decel=False,
+               realtime=False):
     self.rate = 1. / DT_MDL
+    self.ts = 1. / self.rate
+    self.frame = 0
 
-    if not Plant.messaging_initialized:
-      Plant.radar = messaging.pub_sock('radarState')
-      Plant.controls_state = messaging.pub_sock('controlsState')
-      Plant.selfdrive_state = messaging.pub_sock('selfdriveState')
-      Plant.car_state = messaging.pub_sock('carState')
-      Plant.plan = messaging.sub_sock('longitudinalPlan')
-      Plant.messaging_initialized = True
+    # the planner is stepped in lockstep with the plant, as fast as it solves,
+    # unless realtime is set, which paces the steps at the model rate
+    self.rk = Ratekeeper(self.rate, print_delay_threshold=100.0) if realtime else None
 
     self.v_lead_prev = 0.0
 
@@ -43,11 +40,6 @@ class Plant:
     self.personality = personality
     self.force_decel = force_decel
 
-    self.rk = Ratekeeper(self.rate, print_delay_threshold=100.0)
-    self.ts = 1. / self.rate
-    time.sleep(0.1)
-    self.sm = messaging.SubMaster(['longitudinalPlan'])
-
     from opendbc.car.honda.values import CAR
     from opendbc.car.honda.interface import CarInterface
 
@@ -55,7 +47,7 @@ class Plant:
 
   @property
   def current_time(self):
-    return float(self.rk.frame) / self.rate
+    return float(self.frame) / self.rate
 
   def step(self, v_lead=0.0, prob_lead=1.0, v_cruise=50., pitch=0.0, prob_throttle=1.0):
     # ******** publish a fake model going straight and fake calibration ********
@@ -134,7 +126,9 @@ class Plant:
           'selfdriveState': ss.selfdriveState,
           'liveParameters': lp.liveParameters,
           'modelV2': model.modelV2}
+    t = time.monotonic()
     self.planner.update(sm)
+    plan_time = time.monotonic() - t
     self.acceleration = self.planner.output_a_target
     self.speed = self.speed + self.acceleration * self.ts
     self.should_stop = self.planner.output_should_stop
@@ -163,7 +157,9 @@ class Plant:
 
 
     # ******** update prevs ********
-    self.rk.monitor_time()
+    self.frame += 1
+    if self.rk is not None:
+      self.rk.keep_time()
 
     return {
       "distance": self.distance,
@@ -172,11 +168,13 @@ class Plant:
       "should_stop": self.should_stop,
       "distance_lead": self.distance_lead,
       "fcw": fcw,
+      "solve_time": self.planner.mpc.solve_time,
+      "plan_time": plan_time,
     }
 
 # simple engage in standalone mode
 def plant_thread():
-  plant = Plant()
+  plant = Plant(realtime=True)
   while 1:
     plant.step()
 
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import time
+import numpy as np
+
+from cereal import log
+from openpilot.selfdrive.test.longitudinal_maneuvers.maneuver import LOG_COLUMNS, Maneuver, run_maneuvers
+
+SOLVE_TIME = LOG_COLUMNS.index("solve_time")
+PERSONALITIES = {
+  "relaxed": log.LongitudinalPersonality.relaxed,
+  "standard": log.LongitudinalPersonality.standard,
+  "aggressive": log.LongitudinalPersonality.aggressive,
+}
+
+
+def parse_floats(s):
+  return [float(x) for x in s.split(",")]
+
+
+def create_sweep(speeds, lead_speeds, distances, personalities, e2e, duration):
+  maneuvers = []
+  for speed, lead_speed, distance, personality in itertools.product(speeds, lead_speeds, distances, personalities):
+    maneuvers.append(Maneuver(
+      f"{speed:.0f}m/s approaching {lead_speed:.0f}m/s lead at {distance:.0f}m, {personality}",
+      duration=duration,
+      initial_speed=speed,
+      lead_relevancy=True,
+      initial_distance_lead=distance,
+      speed_lead_values=[lead_speed, lead_speed],
+      cruise_values=[max(speed, lead_speed) + 5.] * 2,
+      e2e=e2e,
+      personality=PERSONALITIES[personality],
+    ))
+  return maneuvers
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Sweep lead/speed/personality combinations of the longitudinal planner in lockstep",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--speeds", type=parse_floats, default="5,15,25,35", help="Initial ego speeds in m/s")
+  parser.add_argument("--lead-speeds", type=parse_floats, default="0,5,15,25", help="Lead speeds in m/s")
+  parser.add_argument("--distances", type=parse_floats, default="20,50,100", help="Initial lead distances in m")
+  parser.add_argument("--personalities", default=",".join(PERSONALITIES), help="Comma separated personalities")
+  parser.add_argument("--e2e", action="store_true", help="Run the planner in experimental mode")
+  parser.add_argument("--duration", type=float, default=20., help="Duration of each maneuver in seconds")
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of worker processes, all cores by default")
+  args = parser.parse_args()
+
+  maneuvers = create_sweep(args.speeds, args.lead_speeds, args.distances, args.personalities.split(","), args.e2e, args.duration)
+  st = time.monotonic()
+  results = run_maneuvers(maneuvers, args.jobs)
+  wall_time = time.monotonic() - st
+
+  failed = [m.title for m, (valid, _) in zip(maneuvers, results, strict=True) if not valid]
+  solve_times = np.concatenate([logs[:, SOLVE_TIME] for _, logs in results]) * 1e3
+  sim_time = sum(m.duration for m in maneuvers)
+
+  print(f"{len(maneuvers)} maneuvers, {sim_time:.0f}s simulated in {wall_time:.1f}s ({sim_time / wall_time:.0f}x realtime)")
+  print(f"solve time: p50 {np.percentile(solve_times, 50):.2f}ms, p99 {np.percentile(solve_times, 99):.2f}ms, max {solve_times.max():.2f}ms")
+  print(f"{len(failed)} failed")
+  for title in failed:
+    print(f"  {title}")
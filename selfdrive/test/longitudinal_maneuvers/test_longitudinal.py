@@ -1,8 +1,12 @@
 import itertools
+import os
 from parameterized import parameterized_class
 
 from openpilot.selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import STOP_DISTANCE
-from openpilot.selfdrive.test.longitudinal_maneuvers.maneuver import Maneuver
+from openpilot.selfdrive.test.longitudinal_maneuvers.maneuver import Maneuver, run_maneuvers
+
+# the test classes already run in parallel under xdist, so maneuvers aren't spread over a pool of their own by default
+NUM_JOBS = int(os.environ.get("NUM_JOBS", "1"))
 
 
 # TODO: make new FCW tests
@@ -184,8 +188,15 @@ class TestLongitudinalControl:
   force_decel: bool
 
   def test_maneuver(self, subtests):
-    for maneuver in create_maneuvers({"e2e": self.e2e, "force_decel": self.force_decel}):
+    maneuvers = create_maneuvers({"e2e": self.e2e, "force_decel": self.force_decel})
+    # serially, each maneuver is evaluated in its subtest. in parallel, they're evaluated upfront and errors are raised in their subtest
+    results = run_maneuvers(maneuvers, NUM_JOBS, return_exceptions=True) if NUM_JOBS > 1 else [None] * len(maneuvers)
+    for maneuver, result in zip(maneuvers, results, strict=True):
       with subtests.test(title=maneuver.title, e2e=maneuver.e2e, force_decel=maneuver.force_decel):
         print(maneuver.title, f'in {"e2e" if maneuver.e2e else "acc"} mode')
-        valid, _ = maneuver.evaluate()
+        if result is None:
+          result = maneuver.evaluate()
+        elif isinstance(result, Exception):
+          raise result
+        valid, _ = result
         assert valid
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+import argparse
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass, field
+from typing import Any
+import capnp
+import numpy as np
+
+import cereal.messaging as messaging
+from cereal import car
+from opendbc.car.car_helpers import interfaces
+from openpilot.common.params import Params
+from openpilot.common.prefix import OpenpilotPrefix
+from openpilot.common.utils import atomic_write
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import PROC_REPLAY_DIR, generate_environ_config, generate_params_config, \
+                                                                   get_car_from_logs, get_car_params_callback
+from openpilot.selfdrive.test.process_replay.test_processes import segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+BASELINE_FN = os.path.join(PROC_REPLAY_DIR, "benchmark_baseline.json")
+
+# timings are compared loosely, since they're noisy and the machine may differ from the baseline's.
+# only medians are checked, tail latencies vary too much between runs to gate on
+TIME_TOLERANCE = 1.5
+TIME_SLACK_MS = 0.05
+ALLOC_TOLERANCE = 1.2
+ALLOC_SLACK_KB = 1.0
+
+
+class ReplaySocket:
+  """Stands in for a SubSocket, receiving the raw messages queued on it"""
+  def __init__(self):
+    self.queue: deque[bytes] = deque()
+
+  def receive(self, non_blocking: bool = False) -> bytes | None:
+    return self.queue.popleft() if len(self.queue) else None
+
+
+class NullPubMaster:
+  """Stands in for a PubMaster, serializing messages without sending them"""
+  def send(self, s: str, dat: bytes | capnp.lib.capnp._DynamicStructBuilder) -> None:
+    if not isinstance(dat, bytes):
+      dat.to_bytes()
+
+
+@dataclass
+class Cycle:
+  cur_time: float
+  msgs: list[capnp._DynamicStructReader] = field(default_factory=list)
+  raw: dict[str, list[bytes]] = field(default_factory=lambda: defaultdict(list))
+
+
+class ReplayInputs:
+  """Replaces the sockets of a daemon, so each update of its SubMaster and raw sockets gets the messages of the current cycle"""
+  def __init__(self, daemon: Any, socks: dict[str, str]):
+    self.sm: messaging.SubMaster = daemon.sm
+    self.sm.update = self.update_sm  # type: ignore[method-assign]
+    daemon.pm = NullPubMaster()
+
+    self.socks: dict[str, ReplaySocket] = {}
+    for service, attr in socks.items():
+      self.socks[service] = ReplaySocket()
+      setattr(daemon, attr, self.socks[service])
+    self.cycle = Cycle(0.)
+
+  def update_sm(self, timeout: int = 0) -> None:
+    self.sm.update_msgs(self.cycle.cur_time, self.cycle.msgs)
+    self.cycle.msgs = []
+
+  def feed(self, cycle: Cycle) -> None:
+    self.cycle = Cycle(cycle.cur_time, list(cycle.msgs))
+    for service, raw in cycle.raw.items():
+      self.socks[service].queue.extend(raw)
+
+
+class CycleProfiler:
+  """
+  Records the time of each call of the measured functions, or with trace_alloc, the peak memory allocated during each call
+  and the number of memory blocks it left allocated.
+  Tracing allocations slows everything down, so timings and allocations are measured in separate runs.
+  """
+  def __init__(self, trace_alloc: bool = False):
+    self.trace_alloc = trace_alloc
+    self.times: defaultdict[str, list[float]] = defaultdict(list)
+    self.allocs: defaultdict[str, list[float]] = defaultdict(list)
+    self.blocks: defaultdict[str, list[int]] = defaultdict(list)
+    self._peaks: list[int] = []  # highest peak so far of each running call, including its finished nested calls
+
+  def measure(self, name: str, func: Callable, *args, **kwargs) -> Any:
+    if self.trace_alloc:
+      start, peak = tracemalloc.get_traced_memory()
+      # resetting the peak discards the one of the enclosing call so far, so it's kept first
+      if len(self._peaks):
+        self._peaks[-1] = max(self._peaks[-1], peak)
+      self._peaks.append(start)
+      tracemalloc.reset_peak()
+      start_blocks = sys.getallocatedblocks()
+
+    t = time.perf_counter()
+    ret = func(*args, **kwargs)
+    dt = time.perf_counter() - t
+
+    if self.trace_alloc:
+      self.blocks[name].append(sys.getallocatedblocks() - start_blocks)
+      peak = max(tracemalloc.get_traced_memory()[1], self._peaks.pop())
+      if len(self._peaks):
+        self._peaks[-1] = max(self._peaks[-1], peak)
+      self.allocs[name].append((peak - start) / 1024)
+    else:
+      self.times[name].append(dt * 1e3)
+    return ret
+
+  def instrument(self, obj: Any, path: str) -> None:
+    *owners, attr = path.split(".")
+    for owner in owners:
+      obj = getattr(obj, owner)
+    setattr(obj, attr, functools.partial(self.measure, path, getattr(obj, attr)))
+
+
+class RadarDaemon:
+  # the loop of radard's main
+  def __init__(self, CP: car.CarParams):
+    from openpilot.selfdrive.controls.radard import RadarD
+    self.RD = RadarD(CP.radarDelay)
+    self.sm = messaging.SubMaster(['modelV2', 'carState', 'liveTracks'], poll='modelV2')
+    self.pm = messaging.PubMaster(['radarState'])
+
+  def step(self) -> None:
+    self.sm.update()
+    self.RD.update(self.sm, self.sm['liveTracks'])
+    self.RD.publish(self.pm)
+
+
+def get_car_params() -> car.CarParams:
+  return messaging.log_from_bytes(Params().get("CarParams", block=True), car.CarParams)
+
+
+def create_controlsd(msgs):
+  from openpilot.selfdrive.controls.controlsd import Controls
+  return Controls()
+
+def step_controlsd(controls) -> None:
+  controls.update()
+  CC, lac_log = controls.state_control()
+  controls.publish(CC, lac_log)
+
+def create_plannerd(msgs):
+  from openpilot.selfdrive.controls.plannerd import PlannerD
+  return PlannerD(get_car_params())
+
+def create_selfdrived(msgs):
+  from openpilot.selfdrive.selfdrived.selfdrived import SelfdriveD
+  return SelfdriveD(get_car_params())
+
+def create_card(msgs):
+  from openpilot.selfdrive.car.card import Car
+  CI = get_car_from_logs(msgs)
+  return Car(CI, interfaces[CI.CP.carFingerprint].RadarInterface(CI.CP))
+
+
+@dataclass
+class BenchmarkConfig:
+  name: str
+  trigger: str  # the service each cycle of the daemon waits on
+  create: Callable[[list[capnp._DynamicStructReader]], Any]
+  step: Callable[[Any], None]
+  functions: list[str] = field(default_factory=list)  # attribute paths from the daemon, measured on their own
+  socks: dict[str, str] = field(default_factory=dict)  # service -> attribute of the daemon's raw SubSocket
+
+
+CONFIGS = [
+  BenchmarkConfig("controlsd", "selfdriveState", create_controlsd, step_controlsd,
+                  ["update", "state_control", "publish", "LoC.update", "LaC.update"]),
+  BenchmarkConfig("plannerd", "modelV2", create_plannerd, lambda d: d.step(),
+                  ["longitudinal_planner.update", "longitudinal_planner.mpc.update", "longitudinal_planner.publish", "ldw.update"]),
+  BenchmarkConfig("radard", "modelV2", lambda msgs: RadarDaemon(get_car_params()), lambda d: d.step(),
+                  ["RD.update", "RD.publish"]),
+  BenchmarkConfig("selfdrived", "carState", create_selfdrived, lambda d: d.step(),
+                  ["data_sample", "update_events", "update_alerts", "publish_selfdriveState"], {"carState": "car_state_sock"}),
+  BenchmarkConfig("card", "can", create_card, lambda d: d.step(),
+                  ["state_update", "state_publish", "controls_update", "CI.update", "RI.update"], {"can": "can_sock"}),
+]
+
+
+def get_cycles(msgs: list[capnp._DynamicStructReader], trigger: str, services: set[str], socks: dict[str, str]) -> Iterator[Cycle]:
+  cycle = Cycle(0.)
+  for msg in msgs:
+    which = msg.which()
+    if which in socks:
+      cycle.raw[which].append(msg.as_builder().to_bytes())
+    elif which in services:
+      cycle.msgs.append(msg)
+    else:
+      continue
+
+    if which == trigger:
+      cycle.cur_time = msg.logMonoTime * 1e-9
+      yield cycle
+      cycle = Cycle(0.)
+
+
+def setup_env(msgs: list[capnp._DynamicStructReader]) -> None:
+  # as ProcessContainer does for process replay
+  CP = next(m.carParams for m in msgs if m.which() == "carParams")
+  for k, v in generate_environ_config(CP=CP).items():
+    if len(v) != 0:
+      os.environ[k] = v
+    else:
+      os.environ.pop(k, None)
+
+  params = Params()
+  for k, v in generate_params_config(lr=msgs, CP=CP).items():
+    if isinstance(v, bool):
+      params.put_bool(k, v)
+    else:
+      params.put(k, v)
+
+
+def run_daemon(cfg: BenchmarkConfig, msgs: list[capnp._DynamicStructReader], trace_alloc: bool) -> CycleProfiler:
+  environ = os.environ.copy()
+  try:
+    with OpenpilotPrefix():
+      setup_env(msgs)
+      if cfg.name != "card":
+        get_car_params_callback(None, None, msgs, None)
+
+      daemon = cfg.create(msgs)
+      inputs = ReplayInputs(daemon, cfg.socks)
+      cycles = list(get_cycles(msgs, cfg.trigger, set(inputs.sm.services), cfg.socks))
+
+      profiler = CycleProfiler(trace_alloc)
+      for path in cfg.functions:
+        profiler.instrument(daemon, path)
+
+      if trace_alloc:
+        tracemalloc.start()
+      try:
+        for cycle in cycles:
+          inputs.feed(cycle)
+          profiler.measure("cycle", cfg.step, daemon)
+      finally:
+        tracemalloc.stop()
+  finally:
+    os.environ.clear()
+    os.environ.update(environ)
+  return profiler
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+  if not len(values):
+    return {"p50": 0., "p99": 0., "max": 0.}
+  return {"p50": float(np.percentile(values, 50)), "p99": float(np.percentile(values, 99)), "max": float(np.max(values))}
+
+
+def benchmark(cfg: BenchmarkConfig, all_msgs: list[list[capnp._DynamicStructReader]]) -> dict[str, Any]:
+  times: defaultdict[str, list[float]] = defaultdict(list)
+  allocs: defaultdict[str, list[float]] = defaultdict(list)
+  blocks: defaultdict[str, list[float]] = defaultdict(list)
+  for msgs in all_msgs:
+    for name, values in run_daemon(cfg, msgs, trace_alloc=False).times.items():
+      times[name].extend(values)
+    profiler = run_daemon(cfg, msgs, trace_alloc=True)
+    for name, values in profiler.allocs.items():
+      allocs[name].extend(values)
+      blocks[name].extend(profiler.blocks[name])
+
+  return {
+    "cycles": len(times["cycle"]),
+    "cycle_ms": summarize(times["cycle"]),
+    "alloc_kb": summarize(allocs["cycle"]),
+    "alloc_blocks": summarize(blocks["cycle"]),
+    "functions": {name: {"calls": len(times[name]), "ms": summarize(times[name]), "alloc_kb": summarize(allocs[name]),
+                         "alloc_blocks": summarize(blocks[name])}
+                  for name in cfg.functions if len(times[name])},
+  }
+
+
+def format_results(results: dict[str, Any]) -> str:
+  def row(name: str, calls: int, ms: dict[str, float], kb: dict[str, float], blk: dict[str, float]) -> str:
+    return f"{name:38s} {calls:7d} {ms['p50']:8.3f} {ms['p99']:8.3f} {ms['max']:8.3f} {kb['p50']:8.1f} {kb['max']:8.1f} {blk['p50']:8.0f}"
+
+  lines = [f"{'':38s} {'calls':>7s} {'p50 ms':>8s} {'p99 ms':>8s} {'max ms':>8s} {'p50 KiB':>8s} {'max KiB':>8s} {'p50 blk':>8s}"]
+  for daemon, res in results.items():
+    lines.append(row(daemon, res["cycles"], res["cycle_ms"], res["alloc_kb"], res["alloc_blocks"]))
+    for name, func in res["functions"].items():
+      lines.append(row(f"  {name}", func["calls"], func["ms"], func["alloc_kb"], func["alloc_blocks"]))
+  return "\n".join(lines)
+
+
+def check_regressions(results: dict[str, Any], baseline: dict[str, Any]) -> list[str]:
+  regressions = []
+  for daemon, res in results.items():
+    if daemon not in baseline:
+      continue
+    base = baseline[daemon]
+    for metric, stat, tolerance, slack in (("cycle_ms", "p50", TIME_TOLERANCE, TIME_SLACK_MS),
+                                           ("alloc_kb", "p50", ALLOC_TOLERANCE, ALLOC_SLACK_KB)):
+      value, limit = res[metric][stat], base[metric][stat] * tolerance + slack
+      if value > limit:
+        regressions.append(f"{daemon} {metric} {stat}: {value:.3f} > {limit:.3f} (baseline {base[metric][stat]:.3f})")
+  return regressions
+
+
+if __name__ == "__main__":
+  all_cars = {car for car, _ in segments}
+  all_daemons = [cfg.name for cfg in CONFIGS]
+
+  parser = argparse.ArgumentParser(description="Benchmark the cycle time and allocations of the controls daemons, replaying segments in-process")
+  parser.add_argument("--whitelist-procs", type=str, nargs="*", default=all_daemons, help="Daemons to benchmark (e.g. controlsd)")
+  parser.add_argument("--whitelist-cars", type=str, nargs="*", default=["TOYOTA"], help="Segments to replay (e.g. HONDA)")
+  parser.add_argument("--baseline", type=str, default=BASELINE_FN, help="Results to check for regressions against")
+  parser.add_argument("--update-baseline", action="store_true", help="Save the results as the new baseline")
+  parser.add_argument("--output", type=str, help="Save the results as JSON")
+  args = parser.parse_args()
+
+  tested_cars = [c.upper() for c in args.whitelist_cars]
+  assert set(tested_cars) <= all_cars, f"Unknown cars: {set(tested_cars) - all_cars}"
+
+  all_msgs = []
+  for car_brand, segment in segments:
+    if car_brand in tested_cars:
+      lr = LogReader(get_url(*segment.rsplit("--", 1), "rlog.zst"))
+      all_msgs.append(sorted(migrate_all(lr, manager_states=True, panda_states=True), key=lambda m: m.logMonoTime))
+
+  results = {}
+  for cfg in CONFIGS:
+    if cfg.name in args.whitelist_procs:
+      print(f"benchmarking {cfg.name}")
+      results[cfg.name] = benchmark(cfg, all_msgs)
+  print(format_results(results))
+
+  if args.output is not None:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+
+  if args.update_baseline:
+    with atomic_write(args.baseline, mode="w", overwrite=True) as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    print(f"updated baseline {args.baseline}")
+    sys.exit(0)
+
+  if not os.path.exists(args.baseline):
+    print(f"BENCHMARK FAILED, no baseline at {args.baseline}, run with --update-baseline to create it")
+    sys.exit(1)
+
+  with open(args.baseline) as f:
+    regressions = check_regressions(results, json.load(f))
+  if len(regressions):
+    print("BENCHMARK FAILED, regressions against the baseline:")
+    print("\n".join(f"  {r}" for r in regressions))
+    sys.exit(1)
+  print("BENCHMARK SUCCEEDED")
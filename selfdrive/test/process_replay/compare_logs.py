@@ -4,11 +4,19 @@ import math
 import capnp
 import numbers
 import dictdiffer
+import numpy as np
 from collections import Counter
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from itertools import zip_longest
 
 from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.log_time_series import NO_DISCRIMINANT, SCALAR_TYPES, SchemaExtractor
 
 EPSILON = sys.float_info.epsilon
+FLOAT_TYPES = {'float32', 'float64'}
+INT_TYPES = {'bool', 'int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64'}
+CHUNK_SIZE = 1000  # differing message pairs kept in memory before they're compared
 
 
 def remove_ignored_fields(msg, ignore):
@@ -39,54 +47,273 @@ def remove_ignored_fields(msg, ignore):
   return msg
 
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+def outside_tolerance(diff, tolerance):
+  # Dictdiffer only supports relative tolerance, we also want to check for absolute
+  # TODO: add this to dictdiffer
+  try:
+    if diff[0] == "change":
+      a, b = diff[2]
+      finite = math.isfinite(a) and math.isfinite(b)
+      if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+        return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+  except TypeError:
+    pass
+  return True
+
+
+def dict_diff(msg1, msg2, ignore_fields, tolerance):
+  msg1_dict = msg1.to_dict(verbose=True)
+  msg2_dict = msg2.to_dict(verbose=True)
+  dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
+  return [d for d in dd if outside_tolerance(d, tolerance)]
+
+
+def fully_extracted(schema, seen=None) -> bool:
+  """Whether SchemaExtractor columns cover every field of schema, so equal columns mean equal messages"""
+  seen = set() if seen is None else seen
+  if schema.node.id in seen:
+    return True
+  seen.add(schema.node.id)
+
+  for field in schema.fields_list:
+    proto = field.proto
+    if proto.which() == 'group':
+      if not fully_extracted(field.schema, seen):
+        return False
+      continue
+
+    typ = proto.slot.type.which()
+    if typ == 'struct':
+      if not fully_extracted(field.schema, seen):
+        return False
+    elif typ == 'list':
+      elem = proto.slot.type.list.elementType.which()
+      if elem == 'struct':
+        if not fully_extracted(field.schema.elementType, seen):
+          return False
+      elif elem not in SCALAR_TYPES:
+        return False
+    elif typ == 'void':
+      # switching between void union members leaves no column behind
+      if proto.discriminantValue != NO_DISCRIMINANT:
+        return False
+    elif typ not in SCALAR_TYPES:
+      return False
+  return True
+
+
+def _dense(values: list, rows: list[int] | None, n: int) -> tuple[np.ndarray, np.ndarray]:
+  """Spreads a column over n rows as an object array, with a mask of the rows it's set in"""
+  dense = np.empty(n, dtype=object)
+  present = np.zeros(n, dtype=bool)
+  idx = np.arange(n) if rows is None else np.asarray(rows, dtype=np.int64)
+  dense[idx] = values
+  present[idx] = True
+  return dense, present
+
+
+def _float_outside_tolerance(a: np.ndarray, b: np.ndarray, tolerance: float) -> np.ndarray:
+  """Vectorized dictdiffer.diff + outside_tolerance for pairs of floats"""
+  with np.errstate(invalid='ignore', over='ignore'):
+    finite = np.isfinite(a) & np.isfinite(b)
+    changed = (a != b) & ~(np.isnan(a) & np.isnan(b))
+    err = np.abs(a - b)
+    scale = np.maximum(np.abs(a), np.abs(b))
+    # dictdiffer reports values that aren't within EPSILON relative, then outside_tolerance drops finite ones within tolerance
+    close = finite & (err <= EPSILON * scale)
+    within = finite & (err <= np.maximum(tolerance, tolerance * scale))
+  return changed & ~close & ~within
+
+
+class ServiceComparator:
+  """
+    Collects the differing message pairs of one service into columns, which are compared in one pass at the end to find
+    the pairs with differences outside tolerance. Only those are diffed with dictdiffer, so the output is unchanged.
+  """
+  def __init__(self, which: str, event_schema, schema):
+    self.which = which
+    self.top_level = [(f.proto.name, f.proto.slot.type.which()) for f in event_schema.fields_list
+                      if f.proto.discriminantValue == NO_DISCRIMINANT and f.proto.slot.type.which() in SCALAR_TYPES]
+    self.extractors = (SchemaExtractor(schema), SchemaExtractor(schema))
+    self.top_values: tuple[list, list] = ([], [])
+    self.indices: list[int] = []
+
+  def add(self, idx: int, msg1, msg2) -> None:
+    """Adds a pair of messages to compare. If reading either fails, neither is added"""
+    top = [tuple(getattr(msg, name) for name, _ in self.top_level) for msg in (msg1, msg2)]
+    self.extractors[0].extract(msg1._get(self.which))
+    try:
+      self.extractors[1].extract(msg2._get(self.which))
+    except Exception:
+      self.extractors[0].drop_last()
+      raise
+
+    for values, t in zip(self.top_values, top, strict=True):
+      values.append(t)
+    self.indices.append(idx)
+
+  def _columns(self, side: int) -> dict[str, tuple[str, list, list[int] | None]]:
+    cols = {}
+    for j, (name, typ) in enumerate(self.top_level):
+      cols[name] = (typ, [v[j] for v in self.top_values[side]], None)
+    for path, col in self.extractors[side].columns().items():
+      cols[f"{self.which}/{path}"] = col
+    return cols
+
+  def differing(self, tolerance: float) -> list[int]:
+    """Returns the message indices of the pairs that dict_diff would find differences outside tolerance in"""
+    n = len(self.indices)
+    cols1, cols2 = self._columns(0), self._columns(1)
+    differs = np.zeros(n, dtype=bool)
+    for path in cols1.keys() | cols2.keys():
+      typ = (cols1.get(path) or cols2[path])[0]
+      a, present1 = _dense(*cols1[path][1:], n) if path in cols1 else (np.empty(n, dtype=object), np.zeros(n, dtype=bool))
+      b, present2 = _dense(*cols2[path][1:], n) if path in cols2 else (np.empty(n, dtype=object), np.zeros(n, dtype=bool))
+
+      # fields only set on one side, e.g. different union members or list lengths
+      differs |= present1 ^ present2
+
+      both = np.flatnonzero(present1 & present2 & ~differs)
+      a, b = a[both], b[both]
+      if typ in FLOAT_TYPES:
+        changed = np.flatnonzero(_float_outside_tolerance(a.astype(np.float64), b.astype(np.float64), tolerance))
+      else:
+        # ints are exact and text, data and enums have no tolerance, so only the few unequal pairs are checked in python
+        changed = np.flatnonzero(a != b)
+        if typ in INT_TYPES:
+          changed = [i for i in changed if outside_tolerance(('change', path, (a[i], b[i])), tolerance)]
+      differs[both[changed]] = True
+    return [self.indices[row] for row in np.flatnonzero(differs)]
+
+  def clear(self) -> None:
+    for extractor in self.extractors:
+      extractor.clear()
+    self.top_values = ([], [])
+    self.indices = []
+
+
+def _check_lengths(cnt1: Counter, cnt2: Counter) -> None:
+  len1, len2 = cnt1.total(), cnt2.total()
+  if len1 != len2:
+    raise Exception(f"logs are not same length: {len1} VS {len2}\n\t\t{cnt1}\n\t\t{cnt2}")
+
+
+def iter_diff(log1: Iterable, log2: Iterable, ignore_fields=None, ignore_msgs=None, tolerance=None,
+              chunk_size: int = CHUNK_SIZE) -> Iterator[tuple[int, tuple]]:
+  """
+    Yields the differences outside tolerance between two logs as dictdiffer entries, with the index of their message pair.
+    Both logs are only iterated once: identical messages are skipped by comparing bytes, the others are buffered and
+    checked per field every chunk_size pairs, and only the pairs with differences outside tolerance are diffed as dicts.
+  """
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
   tolerance = EPSILON if tolerance is None else tolerance
 
-  log1, log2 = (
-    [m for m in log if m.which() not in ignore_msgs]
-    for log in (log1, log2)
-  )
-
-  if len(log1) != len(log2):
-    cnt1 = Counter(m.which() for m in log1)
-    cnt2 = Counter(m.which() for m in log2)
-    raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
-
-  diff = []
-  for msg1, msg2 in zip(log1, log2, strict=True):
-    if msg1.which() != msg2.which():
+  comparators: dict[str, ServiceComparator | None] = {}
+  pending: dict[int, tuple] = {}
+  to_diff: list[int] = []
+
+  def flush() -> Iterator[tuple[int, tuple]]:
+    for cmp in comparators.values():
+      if cmp is not None:
+        to_diff.extend(cmp.differing(tolerance))
+        cmp.clear()
+    for idx in sorted(to_diff):
+      for d in dict_diff(*pending[idx], ignore_fields, tolerance):
+        yield idx, d
+    pending.clear()
+    to_diff.clear()
+
+  counts: tuple[Counter, Counter] = (Counter(), Counter())
+  pairs = zip_longest(*((m for m in log if m.which() not in ignore_msgs) for log in (log1, log2)))
+  for idx, (msg1, msg2) in enumerate(pairs):
+    for cnt, msg in zip(counts, (msg1, msg2), strict=True):
+      if msg is not None:
+        cnt[msg.which()] += 1
+
+    if msg1 is None or msg2 is None or msg1.which() != msg2.which():
+      for rest in pairs:
+        for cnt, msg in zip(counts, rest, strict=True):
+          if msg is not None:
+            cnt[msg.which()] += 1
+      _check_lengths(*counts)
       raise Exception("msgs not aligned between logs")
 
+    which = msg1.which()
     msg1 = remove_ignored_fields(msg1, ignore_fields)
     msg2 = remove_ignored_fields(msg2, ignore_fields)
+    if msg1.to_bytes() == msg2.to_bytes():
+      continue
+
+    msg1, msg2 = msg1.as_reader(), msg2.as_reader()
+    pending[idx] = (msg1, msg2)
+    if which not in comparators:
+      sub_msg = msg1._get(which)
+      # services that are lists, or have fields the extractor can't read, are always diffed as dicts
+      fully = hasattr(sub_msg, 'to_dict') and fully_extracted(sub_msg.schema)
+      comparators[which] = ServiceComparator(which, msg1.schema, sub_msg.schema) if fully else None
+
+    cmp = comparators[which]
+    added = False
+    if cmp is not None:
+      try:
+        cmp.add(idx, msg1, msg2)
+        added = True
+      except Exception:
+        pass  # fields the extractor can't read, e.g. from an older schema
+    if not added:
+      to_diff.append(idx)
+
+    if len(pending) >= chunk_size:
+      yield from flush()
+
+  yield from flush()
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+  return [d for _, d in iter_diff(log1, log2, ignore_fields, ignore_msgs, tolerance)]
+
+
+@dataclass
+class FieldDiff:
+  """Summary of the differences outside tolerance at one path"""
+  count: int = 0
+  first_msg: int = -1  # index of the first message pair the path differs in
+  max_abs_err: float = 0.  # of numeric changes, inf if only one side is finite
+  max_rel_err: float = 0.
+
+
+def diff_report(diff: Iterable[tuple[int, tuple]]) -> dict[str, FieldDiff]:
+  """Summarizes the entries from iter_diff by path, without keeping them"""
+  report: dict[str, FieldDiff] = {}
+  for idx, d in diff:
+    field = report.get(str(d[1]))
+    if field is None:
+      field = report[str(d[1])] = FieldDiff(first_msg=idx)
+    field.count += 1
 
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
+    if d[0] == "change" and all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in d[2]):
+      a, b = d[2]
+      if math.isfinite(a) and math.isfinite(b):
+        err = abs(a - b)
+        field.max_abs_err = max(field.max_abs_err, err)
+        field.max_rel_err = max(field.max_rel_err, err / max(abs(a), abs(b)))
+      elif not (math.isnan(a) and math.isnan(b)):
+        field.max_abs_err = field.max_rel_err = math.inf
+  return report
 
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
 
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
+def compare_logs_report(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None) -> dict[str, FieldDiff]:
+  return diff_report(iter_diff(log1, log2, ignore_fields, ignore_msgs, tolerance))
 
-      dd = list(filter(outside_tolerance, dd))
 
-      diff.extend(dd)
-  return diff
+def format_report(report: dict[str, FieldDiff]) -> str:
+  lines = [f"{'path':<60} {'count':>8} {'first':>8} {'max abs':>10} {'max rel':>10}"]
+  for path, field in sorted(report.items()):
+    lines.append(f"{path:<60} {field.count:>8} {field.first_msg:>8} {field.max_abs_err:>10.3g} {field.max_rel_err:>10.3g}")
+  return "\n".join(lines)
 
 
 def format_process_diff(diff):
@@ -139,12 +366,12 @@ def format_diff(results, log_paths, ref_commit):
 
 
 if __name__ == "__main__":
-  log1 = list(LogReader(sys.argv[1]))
-  log2 = list(LogReader(sys.argv[2]))
   ignore_fields = sys.argv[3:] or ["logMonoTime"]
-  results = {"segment": {"proc": compare_logs(log1, log2, ignore_fields)}}
+  diff = list(iter_diff(LogReader(sys.argv[1]), LogReader(sys.argv[2]), ignore_fields))
+  results = {"segment": {"proc": [d for _, d in diff]}}
   log_paths = {"segment": {"proc": {"ref": sys.argv[1], "new": sys.argv[2]}}}
   diff_short, diff_long, failed = format_diff(results, log_paths, None)
 
   print(diff_long)
   print(diff_short)
+  print(format_report(diff_report(diff)))
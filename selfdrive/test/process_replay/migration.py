@@ -3,6 +3,8 @@ from collections.abc import Callable
 from typing import cast
 import capnp
 import functools
+import heapq
+import itertools
 import traceback
 
 from cereal import messaging, car, log
@@ -62,28 +64,30 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
   for i, msg in enumerate(lr):
     grouped[msg.which()].append(i)
 
-  replace_ops, add_ops, del_ops = [], [], []
+  replace_ops: dict[int, capnp.lib.capnp._DynamicStructReader] = {}
+  add_ops: list[list[capnp.lib.capnp._DynamicStructReader]] = []
+  del_ops: set[int] = set()
   for migration in migration_funcs:
     assert hasattr(migration, "inputs") and hasattr(migration, "product"), "Migration functions must use @migration decorator"
     if migration.product in grouped: # skip if product already exists
       continue
 
-    sorted_indices = sorted(ii for i in cast(list[str], migration.inputs) for ii in grouped.get(i, []))
-    msg_gen = [(i, lr[i]) for i in sorted_indices]
+    indices = heapq.merge(*(grouped.get(i, []) for i in cast(list[str], migration.inputs)))
+    msg_gen = [(i, lr[i]) for i in indices]
     r_ops, a_ops, d_ops = migration(msg_gen)
-    replace_ops.extend(r_ops)
-    add_ops.extend(a_ops)
-    del_ops.extend(d_ops)
-
-  for index, msg in replace_ops:
-    lr[index] = msg
-  for index in sorted(del_ops, reverse=True):
-    del lr[index]
-  for msg in add_ops:
-    lr.append(msg)
-  lr = sorted(lr, key=lambda x: x.logMonoTime)
-
-  return lr
+    replace_ops.update(r_ops)
+    # migrations mostly emit in log order already, so this sort is close to linear
+    add_ops.append(sorted(a_ops, key=lambda x: x.logMonoTime))
+    del_ops.update(d_ops)
+
+  # apply replacements and deletions in a single pass, keeping the original order
+  migrated = [replace_ops.get(i, msg) for i, msg in enumerate(lr) if i not in del_ops]
+  if any(a.logMonoTime > b.logMonoTime for a, b in itertools.pairwise(migrated)):
+    migrated.extend(msg for ops in add_ops for msg in ops)
+    return sorted(migrated, key=lambda x: x.logMonoTime)
+
+  # merge the added messages in, same order as appending them and sorting everything
+  return list(heapq.merge(migrated, *add_ops, key=lambda x: x.logMonoTime))
 
 
 def migration(inputs: list[str], product: str|None=None):
@@ -208,15 +208,17 @@ def get_frames():
     except Exception as e:
       print(f"Failed to load frames from cache {cache_name}: {e}")
 
+  # the decoded frames are kept when pickled, so the cache file holds them
+  fr_kwargs = dict(pix_fmt='nv12', cache_size=END_FRAME - START_FRAME, pickle_cache=True)
   frs = {
-    'roadCameraState': FrameReader(get_url(TEST_ROUTE, SEGMENT, "fcamera.hevc"), pix_fmt='nv12', cache_size=END_FRAME - START_FRAME),
-    'driverCameraState': FrameReader(get_url(TEST_ROUTE, SEGMENT, "dcamera.hevc"), pix_fmt='nv12', cache_size=END_FRAME - START_FRAME),
-    'wideRoadCameraState': FrameReader(get_url(TEST_ROUTE, SEGMENT, "ecamera.hevc"), pix_fmt='nv12', cache_size=END_FRAME - START_FRAME),
+    'roadCameraState': FrameReader(get_url(TEST_ROUTE, SEGMENT, "fcamera.hevc"), **fr_kwargs),
+    'driverCameraState': FrameReader(get_url(TEST_ROUTE, SEGMENT, "dcamera.hevc"), **fr_kwargs),
+    'wideRoadCameraState': FrameReader(get_url(TEST_ROUTE, SEGMENT, "ecamera.hevc"), **fr_kwargs),
   }
   for fr in frs.values():
     for fidx in range(START_FRAME, END_FRAME):
       fr.get(fidx)
-    fr.it = None
+    fr.close()
   print(f"Dumping frame cache {cache_name}")
   pickle.dump(frs, open(cache_name, "wb"))
   return frs
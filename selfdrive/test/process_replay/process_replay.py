@@ -4,7 +4,7 @@ import time
 import copy
 import heapq
 import signal
-from collections import Counter
+from collections import Counter, deque
 from dataclasses import dataclass, field
 from itertools import islice
 from typing import Any
@@ -334,29 +334,34 @@ def card_fingerprint_callback(rc, pm, msgs, fingerprint):
     rc.wait_for_next_recv(True)
 
 
-def get_car_params_callback(rc, pm, msgs, fingerprint):
+def get_car_from_logs(msgs: LogIterable):
+  """Fingerprints the car from the CAN messages in msgs, returning its CarInterface"""
   params = Params()
+  can_msgs = ([CanData(can.address, can.dat, can.src) for can in m.can] for m in msgs if m.which() == "can")
+  cached_params_raw = params.get("CarParamsCache")
+  assert next(can_msgs, None), "CAN messages are required for fingerprinting"
+  assert os.environ.get("SKIP_FW_QUERY", False) or cached_params_raw is not None, \
+          "CarParamsCache is required for fingerprinting. Make sure to keep carParams msgs in the logs."
+
+  def can_recv(wait_for_one: bool = False) -> list[list[CanData]]:
+    return [next(can_msgs, [])]
+
+  cached_params = None
+  if cached_params_raw is not None:
+    with car.CarParams.from_bytes(cached_params_raw) as _cached_params:
+      cached_params = _cached_params
+
+  return get_car(can_recv, lambda _msgs: None, lambda obd: None, params.get_bool("AlphaLongitudinalEnabled"), False, cached_params=cached_params)
+
+
+def get_car_params_callback(rc, pm, msgs, fingerprint):
   if fingerprint:
     CarInterface = interfaces[fingerprint]
     CP = CarInterface.get_non_essential_params(fingerprint)
   else:
-    can_msgs = ([CanData(can.address, can.dat, can.src) for can in m.can] for m in msgs if m.which() == "can")
-    cached_params_raw = params.get("CarParamsCache")
-    assert next(can_msgs, None), "CAN messages are required for fingerprinting"
-    assert os.environ.get("SKIP_FW_QUERY", False) or cached_params_raw is not None, \
-            "CarParamsCache is required for fingerprinting. Make sure to keep carParams msgs in the logs."
-
-    def can_recv(wait_for_one: bool = False) -> list[list[CanData]]:
-      return [next(can_msgs, [])]
-
-    cached_params = None
-    if cached_params_raw is not None:
-      with car.CarParams.from_bytes(cached_params_raw) as _cached_params:
-        cached_params = _cached_params
-
-    CP = get_car(can_recv, lambda _msgs: None, lambda obd: None, params.get_bool("AlphaLongitudinalEnabled"), False, cached_params=cached_params).CP
+    CP = get_car_from_logs(msgs).CP
 
-  params.put("CarParams", CP.to_bytes())
+  Params().put("CarParams", CP.to_bytes())
 
 
 def card_rcv_callback(msg, cfg, frame):
@@ -674,7 +679,7 @@ def _replay_multi_process(
 
     pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
     # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
-    external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
+    external_pub_queue: deque[capnp._DynamicStructReader] = deque(pub_msgs)
     internal_pub_queue: list[capnp._DynamicStructReader] = []
     # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
     internal_pub_index_heap: list[tuple[int, int]] = []
@@ -682,7 +687,7 @@ def _replay_multi_process(
     pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
     while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
       if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
-        msg = external_pub_queue.pop(0)
+        msg = external_pub_queue.popleft()
         pbar.update(1)
       else:
         _, index = heapq.heappop(internal_pub_index_heap)
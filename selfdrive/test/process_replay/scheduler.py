@@ -0,0 +1,85 @@
+import concurrent.futures
+import json
+import math
+import os
+import time
+from collections.abc import Callable, Sequence
+from typing import Any
+from tqdm import tqdm
+
+from openpilot.common.prefix import OpenpilotPrefix
+from openpilot.common.utils import atomic_write
+
+
+def load_timings(path: str | None) -> dict[str, float]:
+  if path is None or not os.path.exists(path):
+    return {}
+  try:
+    with open(path) as f:
+      return {str(k): float(v) for k, v in json.load(f).items()}
+  except (OSError, ValueError):
+    return {}
+
+
+def save_timings(path: str, timings: dict[str, float]) -> None:
+  os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+  with atomic_write(path, mode="w", overwrite=True) as f:
+    json.dump(timings, f, indent=2, sort_keys=True)
+
+
+def run_isolated(func: Callable, args: tuple) -> tuple[Any, float]:
+  # every job gets its own msgq/params namespace, but downloads are shared between jobs
+  st = time.monotonic()
+  comma_cache = os.environ.get("COMMA_CACHE")
+  try:
+    with OpenpilotPrefix(shared_download_cache=True):
+      ret = func(*args)
+  finally:
+    # the prefix leaves COMMA_CACHE set, which would leak into the caller when jobs run in this process
+    if comma_cache is None:
+      os.environ.pop("COMMA_CACHE", None)
+    else:
+      os.environ["COMMA_CACHE"] = comma_cache
+  return ret, time.monotonic() - st
+
+
+def run_jobs(func: Callable, jobs: Sequence[tuple], names: Sequence[str], n_jobs: int = 1,
+             desc: str | None = None, timings_path: str | None = None) -> tuple[list[Any], dict[str, float]]:
+  """
+  Runs func(*args) for each job in a pool of n_jobs worker processes, each inside its own OpenpilotPrefix.
+
+  Jobs that took longest on the previous run (per timings_path) are scheduled first, new jobs before all of them,
+  so the pool isn't left waiting on a single long job at the end. Results are returned in the order of jobs
+  regardless of scheduling, along with the wall time of each job by name.
+  """
+  assert len(jobs) == len(names)
+  previous = load_timings(timings_path)
+  order = sorted(range(len(jobs)), key=lambda i: -previous.get(names[i], math.inf))
+
+  results: list[Any] = [None] * len(jobs)
+  timings: dict[str, float] = {}
+  with tqdm(total=len(jobs), desc=desc) as pbar:
+    if n_jobs <= 1:
+      for i in order:
+        results[i], timings[names[i]] = run_isolated(func, jobs[i])
+        pbar.update(1)
+    else:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = {pool.submit(run_isolated, func, jobs[i]): i for i in order}
+        for fut in concurrent.futures.as_completed(futures):
+          i = futures[fut]
+          results[i], timings[names[i]] = fut.result()
+          pbar.update(1)
+
+  if timings_path is not None:
+    save_timings(timings_path, {**previous, **timings})
+  return results, timings
+
+
+def format_timings(timings: dict[str, float], wall_time: float, n_jobs: int, top: int = 10) -> str:
+  total = sum(timings.values())
+  utilization = total / max(wall_time * n_jobs, 1e-9)
+  lines = [f"{len(timings)} jobs in {wall_time:.1f}s on {n_jobs} workers, {total:.1f}s of work ({utilization:.0%} utilization)"]
+  for name, t in sorted(timings.items(), key=lambda x: -x[1])[:top]:
+    lines.append(f"  {t:7.1f}s  {name}")
+  return "\n".join(lines)
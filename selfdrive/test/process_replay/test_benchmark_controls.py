@@ -0,0 +1,99 @@
+import tracemalloc
+from types import SimpleNamespace
+
+import cereal.messaging as messaging
+from openpilot.selfdrive.test.process_replay.benchmark_controls import CycleProfiler, ReplayInputs, check_regressions, get_cycles
+
+
+class TestBenchmarkControls:
+  def test_nested_allocs(self):
+    profiler = CycleProfiler(trace_alloc=True)
+
+    def inner():
+      return bytearray(100 * 1024)
+
+    def outer():
+      profiler.measure("inner", inner)
+      return bytearray(10 * 1024)
+
+    tracemalloc.start()
+    try:
+      profiler.measure("outer", outer)
+    finally:
+      tracemalloc.stop()
+
+    # the outer call includes the peak of the inner one, even though it's freed by then
+    assert 100 <= profiler.allocs["inner"][0] < 110
+    assert 100 <= profiler.allocs["outer"][0] < 120
+    assert not len(profiler.times)
+
+  def test_peak_before_nested(self):
+    profiler = CycleProfiler(trace_alloc=True)
+
+    def outer():
+      buf = bytearray(200 * 1024)
+      del buf
+      profiler.measure("inner", bytearray, 10 * 1024)
+
+    tracemalloc.start()
+    try:
+      profiler.measure("outer", outer)
+    finally:
+      tracemalloc.stop()
+
+    # the outer call's peak from before the nested call isn't lost when that one starts
+    assert 10 <= profiler.allocs["inner"][0] < 20
+    assert 200 <= profiler.allocs["outer"][0] < 220
+
+  def test_alloc_blocks(self):
+    profiler = CycleProfiler(trace_alloc=True)
+    kept = []
+
+    tracemalloc.start()
+    try:
+      profiler.measure("keep", lambda: kept.extend(object() for _ in range(1000)))
+      profiler.measure("free", lambda: len([object() for _ in range(1000)]))
+    finally:
+      tracemalloc.stop()
+
+    assert 1000 <= profiler.blocks["keep"][0] < 1100
+    assert abs(profiler.blocks["free"][0]) < 100
+
+  def test_instrument(self):
+    profiler = CycleProfiler()
+    obj = SimpleNamespace(child=SimpleNamespace(update=lambda x: x + 1))
+    profiler.instrument(obj, "child.update")
+    assert obj.child.update(1) == 2
+    assert len(profiler.times["child.update"]) == 1
+
+  def test_cycles(self):
+    msgs = []
+    for i in range(6):
+      msg = messaging.new_message('carState' if i % 3 == 2 else 'modelV2')
+      msg.logMonoTime = i * 10**9
+      msgs.append(msg.as_reader())
+
+    cycles = list(get_cycles(msgs, 'carState', {'modelV2'}, {'carState': 'car_state_sock'}))
+    assert [c.cur_time for c in cycles] == [2., 5.]
+    assert all(len(c.msgs) == 2 and len(c.raw['carState']) == 1 for c in cycles)
+
+    daemon = SimpleNamespace(sm=messaging.SubMaster(['modelV2']), pm=None, car_state_sock=None)
+    inputs = ReplayInputs(daemon, {'carState': 'car_state_sock'})
+    inputs.feed(cycles[0])
+    daemon.sm.update()
+    assert daemon.sm.updated['modelV2'] and daemon.sm.logMonoTime['modelV2'] == 10**9
+    daemon.sm.update()
+    assert not daemon.sm.updated['modelV2']
+    assert messaging.recv_one(daemon.car_state_sock).logMonoTime == 2 * 10**9
+    assert messaging.recv_one(daemon.car_state_sock) is None
+
+  def test_regressions(self):
+    def result(p50, p99, alloc):
+      return {"cycle_ms": {"p50": p50, "p99": p99, "max": p99}, "alloc_kb": {"p50": alloc, "max": alloc}, "alloc_blocks": {"p50": 0., "max": 0.}}
+
+    baseline = {"controlsd": result(1., 2., 100.)}
+    assert check_regressions({"controlsd": result(1.2, 2.5, 110.), "card": result(10., 20., 1e3)}, baseline) == []
+    # tail latencies aren't gated on
+    assert check_regressions({"controlsd": result(1., 10., 100.)}, baseline) == []
+    regressions = check_regressions({"controlsd": result(2., 2., 150.)}, baseline)
+    assert len(regressions) == 2 and regressions[0].startswith("controlsd cycle_ms p50")
@@ -0,0 +1,144 @@
+import math
+import random
+import pytest
+
+import cereal.messaging as messaging
+from openpilot.selfdrive.test.process_replay.compare_logs import EPSILON, ServiceComparator, compare_logs, compare_logs_report, \
+                                                                 dict_diff, fully_extracted, iter_diff, remove_ignored_fields
+
+VALUES = [0., 1., -2.5, 1e-9, 1e6, math.nan, math.inf]
+SCALES = [0., 1e-12, 1e-6, 1e-2]
+IGNORE_FIELDS = ["logMonoTime"]
+
+
+def dict_compare_logs(log1, log2, ignore_fields, tolerance):
+  # every message pair diffed as dicts
+  diff = []
+  for msg1, msg2 in zip(log1, log2, strict=True):
+    msg1, msg2 = (remove_ignored_fields(m, ignore_fields).as_reader() for m in (msg1, msg2))
+    diff.extend(dict_diff(msg1, msg2, ignore_fields, tolerance))
+  return diff
+
+
+def make_log(rng, n):
+  msgs = []
+  for i in range(n):
+    which = ('liveCalibration', 'radarState', 'managerState')[i % 3]
+    msg = messaging.new_message(which)
+    msg.logMonoTime = i
+    if which == 'liveCalibration':
+      msg.liveCalibration.calStatus = rng.choice(['uncalibrated', 'calibrated'])
+      msg.liveCalibration.validBlocks = rng.randint(0, 2)
+      msg.liveCalibration.rpyCalib = [rng.choice(VALUES) for _ in range(rng.randint(0, 3))]
+    elif which == 'radarState':
+      msg.radarState.leadOne.dRel = rng.choice(VALUES)
+      msg.radarState.leadOne.status = rng.random() < 0.5
+    else:
+      procs = msg.managerState.init('processes', rng.randint(0, 3))
+      for j, proc in enumerate(procs):
+        proc.name = f"proc{j}"
+        proc.pid = rng.randint(0, 2)
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+def perturb(rng, msg):
+  msg = msg.as_builder()
+  k = rng.randrange(4)
+  if msg.which() == 'liveCalibration':
+    cal = msg.liveCalibration
+    if k == 0:
+      cal.rpyCalib = [v * (1 + rng.choice(SCALES)) for v in cal.rpyCalib]
+    elif k == 1:
+      cal.rpyCalib = list(cal.rpyCalib) + [rng.choice(VALUES)]
+    elif k == 2:
+      cal.rpyCalib = list(cal.rpyCalib)[:-1]
+    else:
+      cal.calStatus = 'invalid'
+  elif msg.which() == 'radarState':
+    lead = msg.radarState.leadOne
+    if k < 2:
+      lead.dRel = lead.dRel * (1 + rng.choice(SCALES))
+    elif k == 2:
+      lead.dRel = math.nan
+    else:
+      lead.status = not lead.status
+  else:
+    procs = [(p.name, p.pid) for p in msg.managerState.processes]
+    procs = procs[:-1] if k < 2 else procs + [("new", k)]
+    new_procs = msg.managerState.init('processes', len(procs))
+    for proc, (name, pid) in zip(new_procs, procs, strict=True):
+      proc.name, proc.pid = name, pid
+  msg.valid = rng.random() > 0.1
+  return msg.as_reader()
+
+
+class TestCompareLogs:
+  @pytest.mark.parametrize("tolerance", [None, 1e-5, 1e-2])
+  def test_matches_dict_diff(self, tolerance):
+    rng = random.Random(0)
+    log1 = make_log(rng, 600)
+    log2 = [perturb(rng, m) for m in log1]
+    assert all(fully_extracted(m._get(m.which()).schema) for m in log1[:3])
+
+    diff = compare_logs(log1, log2, IGNORE_FIELDS, tolerance=tolerance)
+    expected = dict_compare_logs(log1, log2, IGNORE_FIELDS, EPSILON if tolerance is None else tolerance)
+    assert len(diff) > 0
+    # NaNs don't compare equal, so the diffs are compared by their repr
+    assert repr(diff) == repr(expected)
+
+  @pytest.mark.parametrize("chunk_size", [1, 7, 10**6])
+  def test_streaming(self, chunk_size):
+    rng = random.Random(1)
+    log1 = make_log(rng, 300)
+    log2 = [perturb(rng, m) for m in log1]
+
+    # logs are consumed as iterators, in chunks that don't change the output
+    diff = list(iter_diff(iter(log1), iter(log2), IGNORE_FIELDS, chunk_size=chunk_size))
+    assert repr([d for _, d in diff]) == repr(compare_logs(log1, log2, IGNORE_FIELDS))
+    assert [idx for idx, _ in diff] == sorted(idx for idx, _ in diff)
+
+    with pytest.raises(Exception, match="not same length"):
+      list(iter_diff(iter(log1), iter(log2[:-1]), IGNORE_FIELDS, chunk_size=chunk_size))
+    with pytest.raises(Exception, match="not aligned"):
+      list(iter_diff(iter(log1[1:]), iter(log2[:-1]), IGNORE_FIELDS, chunk_size=chunk_size))
+
+  def test_report(self):
+    log1 = [m.as_builder() for m in make_log(random.Random(0), 6)]
+    for msg in (log1[1], log1[4]):
+      msg.radarState.leadOne.dRel = 1.
+      msg.radarState.leadOne.status = False
+    log2 = [m.as_reader().as_builder() for m in log1]
+    log2[1].radarState.leadOne.dRel = 1.5
+    log2[4].radarState.leadOne.dRel = 4.
+    log2[4].radarState.leadOne.status = True
+    log2[5].valid = not log1[5].valid
+
+    report = compare_logs_report([m.as_reader() for m in log1], [m.as_reader() for m in log2], IGNORE_FIELDS)
+    assert report.keys() == {"radarState.leadOne.dRel", "radarState.leadOne.status", "valid"}
+    d_rel = report["radarState.leadOne.dRel"]
+    assert (d_rel.count, d_rel.first_msg, d_rel.max_abs_err, d_rel.max_rel_err) == (2, 1, 3., 0.75)
+    status = report["radarState.leadOne.status"]
+    assert (status.count, status.first_msg, status.max_abs_err) == (1, 4, 0.)
+
+  def test_failed_add(self):
+    msg = messaging.new_message('liveCalibration').as_reader()
+    cmp = ServiceComparator('liveCalibration', msg.schema, msg.liveCalibration.schema)
+
+    # the top level fields are readable, the service isn't
+    class Unreadable:
+      def __getattr__(self, name):
+        return getattr(msg, name)
+
+      def _get(self, which):
+        raise ValueError
+
+    with pytest.raises(ValueError):
+      cmp.add(0, msg, Unreadable())
+    assert cmp.extractors[0].num_rows == cmp.extractors[1].num_rows == 0
+    assert cmp.indices == [] and cmp.top_values == ([], [])
+
+    cmp.add(1, msg, msg)
+    assert cmp.extractors[0].num_rows == cmp.extractors[1].num_rows == 1
+    assert cmp.differing(0.) == []
+
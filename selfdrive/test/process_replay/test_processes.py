@@ -1,10 +1,9 @@
 #!/usr/bin/env python3
 import argparse
-import concurrent.futures
 import os
 import sys
+import time
 from collections import defaultdict
-from tqdm import tqdm
 from typing import Any
 
 from opendbc.car.car_helpers import interface_names
@@ -13,6 +12,7 @@ from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
                                                                    check_most_messages_valid
+from openpilot.selfdrive.test.process_replay.scheduler import format_timings, run_jobs
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.logreader import LogReader, save_log
 
@@ -67,6 +67,7 @@ excluded_interfaces = ["mock", "body", "psa"]
 BASE_URL = "https://commadataci.blob.core.windows.net/openpilotci/"
 REF_COMMIT_FN = os.path.join(PROC_REPLAY_DIR, "ref_commit")
 EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
+TIMINGS_FN = os.path.join(FAKEDATA, "job_timings.json")
 
 
 def run_test_process(data):
@@ -178,45 +179,49 @@ if __name__ == "__main__":
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
-  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
-    if not args.upload_only:
-      download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
-
-    pool_args: Any = []
-    for car_brand, segment in segments:
-      if car_brand not in tested_cars:
+  log_data: dict[str, bytes] = {}
+  if not args.upload_only:
+    download_segments = [seg for car, seg in segments if car in tested_cars]
+    downloaded, _ = run_jobs(get_log_data, [(seg,) for seg in download_segments], download_segments, args.jobs, "Getting Logs")
+    log_data = dict(downloaded)
+
+  pool_args: Any = []
+  job_names = []
+  for car_brand, segment in segments:
+    if car_brand not in tested_cars:
+      continue
+
+    for cfg in CONFIGS:
+      if cfg.proc_name not in tested_procs:
         continue
 
-      for cfg in CONFIGS:
-        if cfg.proc_name not in tested_procs:
-          continue
-
-        # to speed things up, we only test all segments on card
-        if cfg.proc_name not in ('card', 'controlsd', 'lagd') and car_brand not in ('HYUNDAI', 'TOYOTA'):
-          continue
-
-        cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.zst")
-        if args.update_refs:  # reference logs will not exist if routes were just regenerated
-          ref_log_path = get_url(*segment.rsplit("--", 1,), "rlog.zst")
-        else:
-          ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
-          ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
-
-        dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
-
-        log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
-        log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
+      # to speed things up, we only test all segments on card
+      if cfg.proc_name not in ('card', 'controlsd', 'lagd') and car_brand not in ('HYUNDAI', 'TOYOTA'):
+        continue
 
-    results: Any = defaultdict(dict)
-    p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
-      if not args.upload_only:
-        results[segment][proc] = result
+      cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.zst")
+      if args.update_refs:  # reference logs will not exist if routes were just regenerated
+        ref_log_path = get_url(*segment.rsplit("--", 1,), "rlog.zst")
+      else:
+        ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
+        ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
+
+      dat = None if args.upload_only else log_data[segment]
+      pool_args.append(((segment, cfg, args, cur_log_fn, ref_log_path, dat),))
+      job_names.append(f"{segment}/{cfg.proc_name}")
+
+      log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
+      log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
+
+  results: Any = defaultdict(dict)
+  st = time.monotonic()
+  job_results, timings = run_jobs(run_test_process, pool_args, job_names, args.jobs, "Running Tests",
+                                  timings_path=None if args.upload_only else TIMINGS_FN)
+  for (segment, proc, result) in job_results:
+    if not args.upload_only:
+      results[segment][proc] = result
+  if not args.upload_only:
+    print(format_timings(timings, time.monotonic() - st, args.jobs))
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
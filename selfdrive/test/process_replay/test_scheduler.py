@@ -0,0 +1,38 @@
+import os
+import time
+
+from openpilot.selfdrive.test.process_replay.scheduler import load_timings, run_jobs, save_timings
+
+calls: list[str] = []
+
+
+def job(name, duration):
+  calls.append(name)
+  time.sleep(duration)
+  return name.upper(), os.environ["COMMA_CACHE"]
+
+
+class TestScheduler:
+  def test_order(self, tmp_path, monkeypatch):
+    monkeypatch.delenv("COMMA_CACHE", raising=False)
+    timings_path = str(tmp_path / "timings.json")
+    save_timings(timings_path, {"a": 1., "b": 3., "c": 2., "removed": 5.})
+
+    # longest jobs on the previous run go first, new ones before all of them
+    calls.clear()
+    names = ["a", "b", "c", "d"]
+    results, timings = run_jobs(job, [(name, 0.01 * i) for i, name in enumerate(names)], names, timings_path=timings_path)
+    assert calls == ["d", "b", "c", "a"]
+    assert [r[0] for r in results] == ["A", "B", "C", "D"]
+    assert "COMMA_CACHE" not in os.environ
+
+    assert timings.keys() == set(names)
+    assert all(timings[name] >= 0.01 * i for i, name in enumerate(names))
+    assert load_timings(timings_path) == {**timings, "removed": 5.}
+
+  def test_parallel(self):
+    names = [f"job{i}" for i in range(6)]
+    results, timings = run_jobs(job, [(name, 0.05) for name in names], names, n_jobs=3)
+    assert [r[0] for r in results] == [name.upper() for name in names]
+    assert timings.keys() == set(names)
+    assert all(t >= 0.05 for t in timings.values())
@@ -293,12 +293,16 @@ def upload_handler(end_event: threading.Event) -> None:
 
         cloudlog.event("athena.upload_handler.upload_start", fn=fn, sz=sz, network_type=network_type, metered=metered, retry_count=item.retry_count)
 
+        start_time = time.monotonic()
         with _do_upload(item, partial(cb, sm, item, tid, end_event)) as response:
           if response.status_code not in (200, 201, 401, 403, 412):
             cloudlog.event("athena.upload_handler.retry", status_code=response.status_code, fn=fn, sz=sz, network_type=network_type, metered=metered)
             retry_upload(tid, end_event)
           else:
-            cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, network_type=network_type, metered=metered)
+            content_length = int(response.request.headers.get("Content-Length", 0))
+            speed = (content_length / 1e6) / max(time.monotonic() - start_time, 1e-6)
+            cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, content_length=content_length,
+                           network_type=network_type, metered=metered, speed=speed)
 
         UploadQueueCache.cache(upload_queue)
       except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
@@ -325,7 +329,7 @@ def _do_upload(upload_item: UploadItem, callback: Callable | None = None) -> req
 
   stream = None
   try:
-    stream, content_length = get_upload_stream(path, compress)
+    stream, content_length = get_upload_stream(path, compress, Paths.upload_spool_root())
     response = UPLOAD_SESS.put(upload_item.url,
                                data=CallbackReader(stream, callback, content_length) if callback else stream,
                                headers={**upload_item.headers, 'Content-Length': str(content_length)},
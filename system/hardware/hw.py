@@ -51,6 +51,20 @@ class Paths:
     else:
       return "/data/stats/"
 
+  @staticmethod
+  def upload_spool_root() -> str:
+    if PC:
+      return str(Path(Paths.comma_home()) / "upload_spool")
+    else:
+      return "/data/upload_spool/"
+
+  @staticmethod
+  def xattr_cache_root() -> str:
+    if PC:
+      return str(Path(Paths.comma_home()) / "xattr_cache")
+    else:
+      return "/data/xattr_cache/"
+
   @staticmethod
   def config_root() -> str:
     if PC:
@@ -17,6 +17,11 @@ CAIBX_URL = "https://commadist.azureedge.net/agnosupdate/"
 
 AGNOS_MANIFEST_FILE = "system/hardware/tici/agnos.json"
 
+# downloaded chunks are kept around, so a failed or interrupted update doesn't download them again
+CASYNC_STORE_PATH = "/data/casync_store"
+CASYNC_STORE_MAX_BYTES = 1024 * 1024 * 1024
+CASYNC_STORE_MIN_FREE_BYTES = 5 * 1024 * 1024 * 1024  # don't fill up /data, it's also used for logs
+
 
 class StreamingDecompressor:
   def __init__(self, url: str) -> None:
@@ -211,6 +216,10 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
   # Second source is the target partition, this allows for resuming
   sources += [('target', casync.FileChunkReader(path), casync.build_chunk_dict(target))]
 
+  # Then chunks downloaded by previous attempts
+  store = casync.LocalChunkStore(CASYNC_STORE_PATH, CASYNC_STORE_MAX_BYTES, CASYNC_STORE_MIN_FREE_BYTES)
+  sources += [('store', store, store.build_chunk_dict(target))]
+
   # Finally we add the remote source to download any missing chunks
   sources += [('remote', casync.RemoteChunkReader(partition['casync_store']), casync.build_chunk_dict(target))]
 
@@ -223,8 +232,12 @@ def extract_casync_image(target_slot_number: int, partition: dict, cloudlog):
       last_p = p
       print(f"Installing {partition['name']}: {p}", flush=True)
 
-  stats = casync.extract(target, sources, path, progress)
-  cloudlog.error(f'casync done {json.dumps(stats)}')
+  t = time.monotonic()
+  try:
+    stats = casync.extract(target, sources, path, progress, store)
+  finally:
+    store.prune()
+  cloudlog.error(f'casync done in {time.monotonic() - t:.1f}s {json.dumps(stats)}')
 
   os.sync()
   if not verify_partition(target_slot_number, partition, force_full_check=True):
@@ -4,8 +4,8 @@ import shutil
 import threading
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
 from openpilot.system.loggerd.uploader import listdir_by_creation
+from openpilot.system.loggerd import xattr_cache
 from openpilot.system.loggerd.xattr_cache import getxattr
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
@@ -45,26 +45,95 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> set[str]:
   return preserved
 
 
-def deleter_thread(exit_event: threading.Event):
-  while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+def get_bytes_to_free() -> int:
+  """Bytes to delete to get back above both MIN_BYTES and MIN_PERCENT of free space"""
+  try:
+    statvfs = os.statvfs(Paths.log_root())
+  except OSError:
+    return 0
+
+  available_bytes = statvfs.f_bavail * statvfs.f_frsize
+  min_percent_bytes = int(statvfs.f_blocks * statvfs.f_frsize * MIN_PERCENT / 100)
+  return max(MIN_BYTES - available_bytes, min_percent_bytes - available_bytes, 0)
+
+
+def delete_dir(path: str) -> None:
+  # unlink the biggest files first, so most space is freed early on if deleting is slow
+  with os.scandir(path) as it:
+    entries = sorted(it, key=lambda e: e.stat(follow_symlinks=False).st_size, reverse=True)
+
+  for entry in entries:
+    if entry.is_dir(follow_symlinks=False):
+      shutil.rmtree(entry.path)
+    else:
+      os.unlink(entry.path)
+  os.rmdir(path)
+
+
+class DeletionPlanner:
+  """Picks the directories to delete to free a number of bytes, in the order of deletion.
+  The size of a directory is only computed once it has no more .lock files."""
+
+  def __init__(self, root: str):
+    self.root = root
+    self.sizes: dict[str, int] = {}
+
+  def dir_size(self, d: str) -> int | None:
+    """Size on disk of a directory, or None if it's still being written or gone"""
+    if d in self.sizes:
+      return self.sizes[d]
 
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
-      preserved_dirs = get_preserved_segments(dirs)
+    size = 0
+    try:
+      with os.scandir(os.path.join(self.root, d)) as it:
+        for entry in it:
+          if entry.name.endswith(".lock"):
+            return None
+          st = entry.stat(follow_symlinks=False)
+          size += st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+    except OSError:
+      return None
+
+    self.sizes[d] = size
+    return size
+
+  def plan(self, bytes_to_free: int) -> list[str]:
+    dirs = listdir_by_creation(self.root)
+    preserved_dirs = get_preserved_segments(dirs)
+
+    existing = set(dirs)
+    self.sizes = {d: size for d, size in self.sizes.items() if d in existing}
+
+    # remove the earliest directories we can
+    batch = []
+    for d in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
+      if bytes_to_free <= 0:
+        break
+
+      size = self.dir_size(d)
+      if size is None:
+        continue
 
-      # remove the earliest directory we can
-      for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
+      batch.append(d)
+      bytes_to_free -= size
+    return batch
+
+
+def deleter_thread(exit_event: threading.Event):
+  planner = DeletionPlanner(Paths.log_root())
+
+  while not exit_event.is_set():
+    bytes_to_free = get_bytes_to_free()
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
+    if bytes_to_free > 0:
+      for delete_dir_name in planner.plan(bytes_to_free):
+        delete_path = os.path.join(Paths.log_root(), delete_dir_name)
 
         try:
           cloudlog.info(f"deleting {delete_path}")
-          shutil.rmtree(delete_path)
-          break
+          delete_dir(delete_path)
+          # only invalidates the cache of the deleter, the uploader drops its entries once it sees the directory is gone
+          xattr_cache.invalidate(delete_path)
         except OSError:
           cloudlog.exception(f"issue deleting {delete_path}")
       exit_event.wait(.1)
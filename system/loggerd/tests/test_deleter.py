@@ -1,3 +1,4 @@
+import pytest
 import time
 import threading
 from collections import namedtuple
@@ -6,6 +7,7 @@ from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
 from openpilot.common.timeout import Timeout, TimeoutException
+from openpilot.system.hardware.hw import Paths
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
@@ -19,7 +21,10 @@ class TestDeleter(UploaderTestCase):
     self.f_type = "fcamera.hevc"
     super().setup_method()
     self.fake_stats = Stats(f_bavail=0, f_blocks=10, f_frsize=4096)
-    deleter.os.statvfs = self.fake_statvfs
+
+  @pytest.fixture(autouse=True)
+  def patch_statvfs(self, monkeypatch):
+    monkeypatch.setattr(deleter.os, "statvfs", self.fake_statvfs)
 
   def start_thread(self):
     self.end_event = threading.Event()
@@ -44,25 +49,28 @@ class TestDeleter(UploaderTestCase):
       self.join_thread()
 
   def assertDeleteOrder(self, f_paths: Sequence[Path], timeout: int = 5) -> None:
+    # a whole batch can be deleted between two checks of the files, so the order is taken from the delete_dir calls
     deleted_order = []
+    delete_dir = deleter.delete_dir
+
+    def record_delete_dir(path):
+      deleted_order.append(Path(path))
+      delete_dir(path)
+    deleter.delete_dir = record_delete_dir
 
     self.start_thread()
     try:
       with Timeout(timeout, "Timeout waiting for files to be deleted"):
-        while True:
-          for f in f_paths:
-            if not f.exists() and f not in deleted_order:
-              deleted_order.append(f)
-          if len(deleted_order) == len(f_paths):
-            break
+        while any(f.exists() for f in f_paths):
           time.sleep(0.01)
     except TimeoutException:
-      print("Not deleted:", [f for f in f_paths if f not in deleted_order])
+      print("Not deleted:", [f for f in f_paths if f.exists()])
       raise
     finally:
       self.join_thread()
+      deleter.delete_dir = delete_dir
 
-    assert deleted_order == f_paths, "Files not deleted in expected order"
+    assert deleted_order == [f.parent for f in f_paths], "Files not deleted in expected order"
 
   def test_delete_order(self):
     self.assertDeleteOrder([
@@ -115,3 +123,51 @@ class TestDeleter(UploaderTestCase):
     self.join_thread()
 
     assert f_path.exists(), "File deleted when locked"
+
+  def test_bytes_to_free(self):
+    self.fake_stats = Stats(f_bavail=0, f_blocks=10, f_frsize=4096)
+    assert deleter.get_bytes_to_free() == deleter.MIN_BYTES
+
+    # 1GB free of 100GB is under both limits, the percentage is further off
+    gb = 1024 ** 3 // 4096
+    self.fake_stats = Stats(f_bavail=gb, f_blocks=100 * gb, f_frsize=4096)
+    assert deleter.get_bytes_to_free() == 9 * 1024 ** 3
+
+    self.fake_stats = Stats(f_bavail=20 * gb, f_blocks=100 * gb, f_frsize=4096)
+    assert deleter.get_bytes_to_free() == 0
+
+  def test_plan(self):
+    segs = [self.seg_format.format(i) for i in range(5)]
+    self.make_file_with_data(segs[0], self.f_type, 1, preserve_xattr=deleter.PRESERVE_ATTR_VALUE)
+    self.make_file_with_data(segs[1], self.f_type, 1)
+    self.make_file_with_data(segs[2], self.f_type, 1, lock=True)
+    for seg in segs[3:]:
+      self.make_file_with_data(seg, self.f_type, 1)
+
+    planner = deleter.DeletionPlanner(str(Path(Paths.log_root())))
+    mb = 1024 * 1024
+    assert planner.plan(1) == [segs[1]]
+    assert planner.plan(mb + 1) == [segs[1], segs[3]]
+    assert planner.plan(10 * mb) == [segs[1], segs[3], segs[4], segs[0]]
+    assert segs[2] not in planner.sizes
+    assert planner.sizes[segs[1]] >= mb
+
+  def test_delete_batch(self, monkeypatch):
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), self.f_type, 1) for i in range(3)]
+    keep = self.make_file_with_data(self.seg_format.format(3), self.f_type, 1)
+
+    # deleting the three oldest segments frees up enough space
+    def fake_statvfs(d):
+      freed = sum(1024 * 1024 for f in f_paths if not f.exists())
+      return Stats(f_bavail=(deleter.MIN_BYTES - 3 * 1024 * 1024 + freed) // 4096, f_blocks=10, f_frsize=4096)
+    monkeypatch.setattr(deleter.os, "statvfs", fake_statvfs)
+
+    self.start_thread()
+    try:
+      with Timeout(2, "Timeout waiting for files to be deleted"):
+        while any(f.exists() for f in f_paths):
+          time.sleep(0.01)
+      time.sleep(0.2)
+    finally:
+      self.join_thread()
+    assert keep.exists()
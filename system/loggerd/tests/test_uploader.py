@@ -3,13 +3,15 @@ import time
 import threading
 import logging
 import json
+import shutil
 from pathlib import Path
 from openpilot.system.hardware.hw import Paths
 
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.system.loggerd.uploader import main, UploadIndex, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.system.loggerd.xattr_cache import setxattr
 
-from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase, create_random_file
 
 
 class FakeLogHandler(logging.Handler):
@@ -182,3 +184,82 @@ class TestUploader(UploaderTestCase):
     for f_path in f_paths:
       lock_path = f_path.with_suffix(f_path.suffix + ".lock")
       assert not lock_path.is_file(), "File lock not cleared on startup"
+
+
+class TestUploadIndex:
+  def make_index(self, root):
+    return UploadIndex(str(root), ["crash/", "boot/"], {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1})
+
+  def make_segment(self, root, seg, names=("qlog", "qcamera.ts", "rlog"), lock=False):
+    for name in names:
+      create_random_file(root / seg / name, 0.01, lock=lock)
+
+  def drain(self, index, metered=False, routes=()):
+    keys = []
+    while (f := index.next(metered, list(routes))) is not None:
+      keys.append(f[1])
+      index.remove(f[1])
+    return keys
+
+  def test_order(self, tmp_path):
+    segs = [f"00000004--0ac3964c96--{i}" for i in (0, 2, 10)]
+    for seg in reversed(segs):
+      self.make_segment(tmp_path, seg)
+    create_random_file(tmp_path / "boot" / "a", 0.01)
+
+    index = self.make_index(tmp_path)
+    index.update()
+    assert index.depth == 7
+    assert index.bytes_pending == sum(os.path.getsize(tmp_path / k) for _, k in index.immediate + index.priority)
+    assert self.drain(index) == ["boot/a"] + [f"{seg}/{n}" for seg in segs for n in ("qlog", "qcamera.ts")]
+    assert index.depth == 0 and index.bytes_pending == 0
+
+  def test_metered(self, tmp_path):
+    for seg in ("00000004--0ac3964c96--0", "00000005--4c4e99b08b--0"):
+      self.make_segment(tmp_path, seg)
+    index = self.make_index(tmp_path)
+    index.update()
+    assert self.drain(index, True, ["dongle|00000005--4c4e99b08b"]) == [
+      "00000004--0ac3964c96--0/qlog", "00000005--4c4e99b08b--0/qlog", "00000005--4c4e99b08b--0/qcamera.ts"]
+
+  def test_incremental(self, tmp_path):
+    seg = "00000004--0ac3964c96--0"
+    self.make_segment(tmp_path, seg, lock=True)
+    self.make_segment(tmp_path, "00000004--0ac3964c96--1", names=("qlog",))
+    setxattr(str(tmp_path / "00000004--0ac3964c96--1" / "qlog"), UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+
+    index = self.make_index(tmp_path)
+    index.update()
+    assert index.next(False, []) is None
+
+    # segment closes
+    for name in os.listdir(tmp_path / seg):
+      if name.endswith(".lock"):
+        os.unlink(tmp_path / seg / name)
+    index.update()
+    assert index.next(False, [])[1] == f"{seg}/qlog"
+
+    # new segment, listed before loggerd creates its lock files
+    new_seg = "00000004--0ac3964c96--2"
+    os.mkdir(tmp_path / new_seg)
+    index.update()
+    assert new_seg in index.open_dirs
+    self.make_segment(tmp_path, new_seg, names=("qlog",), lock=True)
+    index.update()
+    assert new_seg in index.open_dirs
+    os.unlink(tmp_path / new_seg / "qlog.lock")
+    index.update()
+    assert new_seg not in index.open_dirs
+    assert self.drain(index) == [f"{seg}/qlog", f"{seg}/qcamera.ts", f"{new_seg}/qlog"]
+
+    # new boot log
+    create_random_file(tmp_path / "boot" / "b", 0.01)
+    index.update()
+    assert index.next(False, [])[1] == "boot/b"
+
+    # deleter removes the segment
+    shutil.rmtree(tmp_path / seg)
+    index.RESYNC_INTERVAL = 0
+    index.update()
+    assert seg not in index.dirs
+    assert self.drain(index) == ["boot/b"]
@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+
+from openpilot.system.loggerd.xattr_cache import XattrCache
+
+ATTR = 'user.upload'
+
+
+def make_files(root, n):
+  paths = []
+  for i in range(n):
+    fn = root / f"seg--{i // 4}" / f"file{i}"
+    fn.parent.mkdir(exist_ok=True)
+    fn.touch()
+    paths.append(str(fn))
+  return paths
+
+
+class TestXattrCache:
+  def test_bounded(self, tmp_path):
+    paths = make_files(tmp_path, 20)
+    cache = XattrCache(max_entries=8)
+    for p in paths:
+      assert cache.get(p, ATTR) is None
+    assert len(cache) == 8
+
+    # most recently used entries are kept
+    cache.get(paths[12], ATTR)
+    cache.set(paths[0], ATTR, b'1')
+    assert {p for p, _ in cache._entries} == {paths[0]} | set(paths[12:20]) - {paths[13]}
+
+  def test_set(self, tmp_path):
+    p, = make_files(tmp_path, 1)
+    cache = XattrCache()
+    assert cache.get(p, ATTR) is None
+    cache.set(p, ATTR, b'1')
+    assert cache.get(p, ATTR) == b'1'
+    assert os.getxattr(p, ATTR) == b'1'
+
+  def test_invalidate(self, tmp_path):
+    paths = make_files(tmp_path, 8)
+    cache = XattrCache()
+    for p in paths:
+      cache.set(p, ATTR, b'1')
+    cache.get(os.path.dirname(paths[0]), ATTR)
+
+    # path gets reused after the deleter removed it
+    cache.invalidate(os.path.dirname(paths[0]) + "/")
+    assert len(cache) == 4
+    os.setxattr(paths[4], ATTR, b'0')
+    assert cache.get(paths[4], ATTR) == b'1'
+    cache.invalidate(paths[4])
+    assert cache.get(paths[4], ATTR) == b'0'
+
+  def test_persist(self, tmp_path):
+    paths = make_files(tmp_path, 4)
+    fn = str(tmp_path / "cache" / "xattrs.json")
+    cache = XattrCache(persist_path=fn)
+    cache.set(paths[0], ATTR, b'1')
+    cache.get(paths[1], ATTR)
+    cache.save()
+
+    # only set attributes are persisted
+    os.setxattr(paths[0], ATTR, b'0')
+    os.setxattr(paths[1], ATTR, b'1')
+    cache = XattrCache(persist_path=fn)
+    assert len(cache) == 1
+    assert cache.get(paths[0], ATTR) == b'1'
+    assert cache.get(paths[1], ATTR) == b'1'
+
+  def test_persist_deleted(self, tmp_path):
+    paths = make_files(tmp_path, 8)
+    fn = tmp_path / "xattrs.json"
+    cache = XattrCache(persist_path=str(fn))
+    for p in paths:
+      cache.set(p, ATTR, b'1')
+    cache.save()
+
+    # the deleter removed a segment while nothing invalidated this cache
+    shutil.rmtree(os.path.dirname(paths[0]))
+    cache = XattrCache(persist_path=str(fn))
+    assert {p for p, _ in cache._entries} == set(paths[4:])
+    cache.save()
+    assert len(json.loads(fn.read_text())) == 4
+
+  def test_save_if_changed(self, tmp_path):
+    paths = make_files(tmp_path, 4)
+    fn = tmp_path / "xattrs.json"
+    cache = XattrCache(max_entries=3, persist_path=str(fn))
+    cache.get(paths[0], ATTR)
+    cache.save()
+    assert not fn.exists()
+
+    cache.set(paths[0], ATTR, b'1')
+    cache.save()
+    assert fn.exists()
+
+    # loaded entries and unset attributes don't change what's persisted, so the file isn't rewritten
+    cache = XattrCache(max_entries=3, persist_path=str(fn))
+    fn.unlink()
+    assert cache.get(paths[0], ATTR) == b'1'
+    cache.get(paths[1], ATTR)
+    cache.save()
+    assert not fn.exists()
+
+    # evicting or invalidating a set attribute does
+    for p in paths[1:]:
+      cache.get(p, ATTR)
+    cache.save()
+    assert fn.exists()
+    fn.unlink()
+    cache.set(paths[1], ATTR, b'1')
+    cache.save()
+    fn.unlink()
+    cache.invalidate(paths[1])
+    cache.save()
+    assert fn.exists()
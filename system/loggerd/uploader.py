@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import bisect
 import json
 import os
 import random
@@ -7,7 +8,6 @@ import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
 
 from cereal import log
 import cereal.messaging as messaging
@@ -16,6 +16,7 @@ from openpilot.common.utils import get_upload_stream
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
+from openpilot.system.loggerd import xattr_cache
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 
@@ -33,6 +34,8 @@ allow_sleep = bool(int(os.getenv("UPLOADER_SLEEP", "1")))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
+XATTR_CACHE_SAVE_INTERVAL = 300.
+
 
 class FakeRequest:
   def __init__(self):
@@ -73,71 +76,168 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
-class Uploader:
-  def __init__(self, dongle_id: str, root: str):
-    self.dongle_id = dongle_id
-    self.api = Api(dongle_id)
+class UploadIndex:
+  """Files the uploader still has to upload, kept up to date incrementally instead of rescanning every
+  file on every step. Segment directories are scanned once when they close (i.e. once they have files
+  to upload and no more .lock files), only directories that are still open are listed again on later updates.
+  Directories removed by the deleter are noticed from the root listing, which is only read again when
+  the root's mtime changes, or at least every RESYNC_INTERVAL seconds."""
+
+  RESYNC_INTERVAL = 60.
+
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
     self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
 
-    self.params = Params()
+    self.root_mtime: int | None = None
+    self.last_resync = 0.
+    self.dirs: dict[str, set[str]] = {}  # logdir -> keys of its files in the index
+    self.open_dirs: set[str] = set()
 
-    # stats for last successfully uploaded file
-    self.last_filename = ""
+    # (sort key, key) in upload order, files in the immediate folders go first
+    self.immediate: list[tuple[tuple, str]] = []
+    self.priority: list[tuple[tuple, str]] = []
+    self.files: dict[str, tuple[tuple, float, int]] = {}  # key -> (sort key, ctime, size)
 
-    self.immediate_folders = ["crash/", "boot/"]
-    self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self.bytes_pending = 0
 
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes")
-    requested_routes = [] if r is None else [route for route in r.split(",") if route]
+  @property
+  def depth(self) -> int:
+    return len(self.files)
 
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
-          continue
+  def update(self) -> None:
+    try:
+      root_mtime = os.stat(self.root).st_mtime_ns
+    except OSError:
+      root_mtime = None
+
+    if root_mtime != self.root_mtime or time.monotonic() - self.last_resync > self.RESYNC_INTERVAL:
+      self.root_mtime = root_mtime
+      self.last_resync = time.monotonic()
+
+      logdirs = set(listdir_by_creation(self.root))
+      for logdir in self.dirs.keys() - logdirs:
+        self.remove_dir(logdir)
+      for logdir in logdirs - self.dirs.keys():
+        self.dirs[logdir] = set()
+        self.open_dirs.add(logdir)
+
+    for logdir in list(self.open_dirs):
+      self._scan_dir(logdir)
+
+  def _scan_dir(self, logdir: str) -> None:
+    path = os.path.join(self.root, logdir)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      self.remove_dir(logdir)
+      return
+
+    # files in a segment are only uploaded once it's closed
+    if any(name.endswith(".lock") for name in names):
+      for key in list(self.dirs[logdir]):
+        self.remove(key)
+      return
+
+    # loggerd creates the directory before its lock files, so it's only closed once it has files to upload
+    has_candidates = any(name in self.immediate_priority for name in names)
+    if has_candidates and not any(f in os.path.join(path, "") for f in self.immediate_folders):
+      self.open_dirs.discard(logdir)
+
+    for key in self.dirs[logdir] - {os.path.join(logdir, name) for name in names}:
+      self.remove(key)
+
+    for name in names:
+      key = os.path.join(logdir, name)
+      if key not in self.dirs[logdir]:
+        self._add(logdir, name)
+
+  def _add(self, logdir: str, name: str) -> None:
+    key = os.path.join(logdir, name)
+    fn = os.path.join(self.root, key)
+    if any(f in fn for f in self.immediate_folders):
+      queue = self.immediate
+    elif name in self.immediate_priority:
+      queue = self.priority
+    else:
+      return
+
+    # skip files already uploaded
+    try:
+      st = os.stat(fn)
+      is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+    except OSError:
+      cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
+      # deleter could have deleted, so skip
+      return
+    if is_uploaded:
+      return
+
+    sort_key = (queue is self.immediate, get_directory_sort(logdir), self.immediate_priority.get(name, 1000), name)
+    bisect.insort(queue, (sort_key, key))
+    self.files[key] = (sort_key, st.st_ctime, st.st_size)
+    self.dirs[logdir].add(key)
+    self.bytes_pending += st.st_size
+
+  def remove(self, key: str) -> None:
+    if key not in self.files:
+      return
+
+    sort_key, _, size = self.files.pop(key)
+    queue = self.immediate if sort_key[0] else self.priority
+    del queue[bisect.bisect_left(queue, (sort_key, key))]
+    self.dirs[os.path.dirname(key)].discard(key)
+    self.bytes_pending -= size
+
+  def remove_dir(self, logdir: str) -> None:
+    for key in list(self.dirs.get(logdir, ())):
+      self.remove(key)
+    self.dirs.pop(logdir, None)
+    self.open_dirs.discard(logdir)
+    xattr_cache.invalidate(os.path.join(self.root, logdir))
+
+  def next(self, metered: bool, requested_routes: list[str]) -> tuple[str, str, str] | None:
+    for queue in (self.immediate, self.priority):
+      for _, key in queue:
+        logdir, name = os.path.split(key)
 
         # limit uploading on metered connections
         if metered:
           dt = datetime.timedelta(hours=12)
+          ctime = self.files[key][1]
           if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
             continue
 
           if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
             continue
 
-        yield name, key, fn
+        return name, key, os.path.join(self.root, key)
 
-  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
+    return None
 
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
 
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
+class Uploader:
+  def __init__(self, dongle_id: str, root: str):
+    self.dongle_id = dongle_id
+    self.api = Api(dongle_id)
+    self.root = root
 
-    return None
+    self.params = Params()
+
+    # stats for last successfully uploaded file
+    self.last_filename = ""
+
+    self.immediate_folders = ["crash/", "boot/"]
+    self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self.index = UploadIndex(root, self.immediate_folders, self.immediate_priority)
+
+  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
+    r = self.params.get("AthenadRecentlyViewedRoutes")
+    requested_routes = [] if r is None else [route for route in r.split(",") if route]
+
+    self.index.update()
+    return self.index.next(metered, requested_routes)
 
   def do_upload(self, key: str, fn: str):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -155,7 +255,7 @@ class Uploader:
     stream = None
     try:
       compress = key.endswith('.zst') and not fn.endswith('.zst')
-      stream, _ = get_upload_stream(fn, compress)
+      stream, _ = get_upload_stream(fn, compress, Paths.upload_spool_root())
       response = requests.put(url, data=stream, headers=headers, timeout=10)
       return response
     finally:
@@ -167,9 +267,11 @@ class Uploader:
       sz = os.path.getsize(fn)
     except OSError:
       cloudlog.exception("upload: getsize failed")
+      self.index.remove(os.path.relpath(fn, self.root))
       return False
 
-    cloudlog.event("upload_start", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
+    cloudlog.event("upload_start", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered,
+                   queue_depth=self.index.depth, bytes_pending=self.index.bytes_pending)
 
     if sz == 0:
       # tag files of 0 size as uploaded
@@ -195,8 +297,9 @@ class Uploader:
         else:
           content_length = int(stat.request.headers.get("Content-Length", 0))
           speed = (content_length / 1e6) / dt
+          raw_speed = (sz / 1e6) / dt
           cloudlog.event("upload_success", key=key, fn=fn, sz=sz, content_length=content_length,
-                         network_type=network_type, metered=metered, speed=speed)
+                         network_type=network_type, metered=metered, speed=speed, raw_speed=raw_speed)
         success = True
       else:
         success = False
@@ -208,6 +311,7 @@ class Uploader:
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
       except OSError:
         cloudlog.event("uploader_setxattr_failed", exc=last_exc, key=key, fn=fn, sz=sz)
+      self.index.remove(os.path.relpath(fn, self.root))
 
     return success
 
@@ -237,6 +341,10 @@ def main(exit_event: threading.Event | None = None) -> None:
 
   clear_locks(Paths.log_root())
 
+  # don't read the xattrs of all files already uploaded again after a restart
+  xattr_cache.set_persist_path(os.path.join(Paths.xattr_cache_root(), "uploader.json"))
+  last_xattr_save = time.monotonic()
+
   params = Params()
   dongle_id = params.get("DongleId")
 
@@ -265,9 +373,16 @@ def main(exit_event: threading.Event | None = None) -> None:
     else:
       cloudlog.info("upload backoff %r", backoff)
       backoff = min(backoff*2, 120)
+
+    if time.monotonic() - last_xattr_save > XATTR_CACHE_SAVE_INTERVAL:
+      xattr_cache.save()
+      last_xattr_save = time.monotonic()
+
     if allow_sleep:
       time.sleep(backoff + random.uniform(0, backoff))
 
+  xattr_cache.save()
+
 
 if __name__ == "__main__":
   main()
@@ -1,12 +1,48 @@
 import errno
+import json
+import os
+from collections import OrderedDict
 
 import xattr
 
-_cached_attributes: dict[tuple, bytes | None] = {}
+from openpilot.common.utils import atomic_write
+
+MAX_ENTRIES = 1 << 15
+
+
+class XattrCache:
+  """LRU cache of extended attributes, holding at most max_entries (path, attr_name) entries.
+
+  Entries are only kept coherent with changes made through this cache, so anything deleting files
+  should call invalidate. That only drops the entries of the cache of the calling process, other
+  processes have to invalidate their own when they notice the files are gone.
+  With a persist_path, set attributes are saved there by save(), and loaded back on start, without
+  the entries of directories deleted meanwhile. Unset attributes aren't persisted, since another
+  process may set them meanwhile. save() only writes the file when the persisted entries changed
+  since they were last loaded or saved."""
+
+  def __init__(self, max_entries: int = MAX_ENTRIES, persist_path: str | None = None):
+    self.max_entries = max_entries
+    self.persist_path = persist_path
+
+    self._entries: OrderedDict[tuple[str, str], bytes | None] = OrderedDict()
+    self._attrs: dict[str, set[str]] = {}  # path -> cached attributes
+    self._children: dict[str, set[str]] = {}  # directory -> cached paths in it
+    self._dirty = False  # set attributes changed since the last load or save
+
+    if persist_path is not None:
+      self.load()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def get(self, path: str, attr_name: str) -> bytes | None:
+    path = os.path.normpath(path)
+    key = (path, attr_name)
+    if key in self._entries:
+      self._entries.move_to_end(key)
+      return self._entries[key]
 
-def getxattr(path: str, attr_name: str) -> bytes | None:
-  key = (path, attr_name)
-  if key not in _cached_attributes:
     try:
       response = xattr.getxattr(path, attr_name)
     except OSError as e:
@@ -15,9 +51,107 @@ def getxattr(path: str, attr_name: str) -> bytes | None:
         response = None
       else:
         raise
-    _cached_attributes[key] = response
-  return _cached_attributes[key]
+    self._put(path, attr_name, response)
+    return response
+
+  def set(self, path: str, attr_name: str, attr_value: bytes) -> None:
+    path = os.path.normpath(path)
+    self._pop((path, attr_name))
+    xattr.setxattr(path, attr_name, attr_value)
+    self._put(path, attr_name, attr_value)
+
+  def invalidate(self, path: str) -> None:
+    """Drops all entries of path, and of the files directly in it if it's a directory"""
+    path = os.path.normpath(path)
+    for child in list(self._children.get(path, ())):
+      self.invalidate(child)
+    for attr_name in list(self._attrs.get(path, ())):
+      self._pop((path, attr_name))
+
+  def clear(self) -> None:
+    if any(value is not None for value in self._entries.values()):
+      self._dirty = True
+    self._entries.clear()
+    self._attrs.clear()
+    self._children.clear()
+
+  def load(self) -> None:
+    assert self.persist_path is not None
+    try:
+      with open(self.persist_path) as f:
+        entries = json.load(f)
+    except (OSError, ValueError):
+      return
+
+    # files may have been deleted by other processes since, only checking their directory is still there
+    dirty = self._dirty
+    dir_exists: dict[str, bool] = {}
+    for path, attr_name, value in entries[-self.max_entries:]:
+      path = os.path.normpath(path)
+      d = os.path.dirname(path)
+      if d not in dir_exists:
+        dir_exists[d] = os.path.isdir(d)
+      if dir_exists[d]:
+        self._put(path, attr_name, bytes.fromhex(value))
+      else:
+        dirty = True
+    self._dirty = dirty
+
+  def save(self) -> None:
+    assert self.persist_path is not None
+    if not self._dirty:
+      return
+    entries = [(path, attr_name, value.hex()) for (path, attr_name), value in self._entries.items() if value is not None]
+    os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+    with atomic_write(self.persist_path, overwrite=True) as f:
+      json.dump(entries, f)
+    self._dirty = False
+
+  def _put(self, path: str, attr_name: str, value: bytes | None) -> None:
+    self._entries[(path, attr_name)] = value
+    self._entries.move_to_end((path, attr_name))
+    if value is not None:
+      self._dirty = True
+    self._attrs.setdefault(path, set()).add(attr_name)
+    self._children.setdefault(os.path.dirname(path), set()).add(path)
+
+    while len(self._entries) > self.max_entries:
+      self._pop(next(iter(self._entries)))
+
+  def _pop(self, key: tuple[str, str]) -> None:
+    if self._entries.pop(key, None) is not None:
+      self._dirty = True
+
+    path, attr_name = key
+    attrs = self._attrs.get(path)
+    if attrs is None:
+      return
+    attrs.discard(attr_name)
+    if not attrs:
+      del self._attrs[path]
+      children = self._children[os.path.dirname(path)]
+      children.discard(path)
+      if not children:
+        del self._children[os.path.dirname(path)]
+
+
+_cache = XattrCache()
+
+def getxattr(path: str, attr_name: str) -> bytes | None:
+  return _cache.get(path, attr_name)
 
 def setxattr(path: str, attr_name: str, attr_value: bytes) -> None:
-  _cached_attributes.pop((path, attr_name), None)
-  xattr.setxattr(path, attr_name, attr_value)
+  _cache.set(path, attr_name, attr_value)
+
+def invalidate(path: str) -> None:
+  _cache.invalidate(path)
+
+def set_persist_path(path: str | None) -> None:
+  """Persists the process-wide cache at path, loading what's already there"""
+  _cache.persist_path = path
+  if path is not None:
+    _cache.load()
+
+def save() -> None:
+  if _cache.persist_path is not None:
+    _cache.save()
@@ -1,11 +1,74 @@
 #!/usr/bin/env python3
+import json
+import queue
+import threading
+import time
 import zmq
+from collections import defaultdict
 from typing import NoReturn
 
 import cereal.messaging as messaging
 from openpilot.common.logging_extra import SwagLogFileFormatter
 from openpilot.system.hardware.hw import Paths
-from openpilot.common.swaglog import get_file_handler
+from openpilot.common.swaglog import cloudlog, get_file_handler
+from openpilot.system.statsd import statlog
+
+MAX_BATCH_SIZE = 1000
+WRITE_QUEUE_SIZE = 100  # in batches
+
+# records published per daemon. errors are never rate limited, and everything is still written to disk
+RATE_LIMIT = 200
+RATE_LIMIT_BURST = 1000
+
+STATS_INTERVAL = 10.
+
+_json_decoder = json.JSONDecoder()
+
+
+class TokenBucket:
+  def __init__(self, rate: float, burst: float):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last = time.monotonic()
+
+  def consume(self, now: float) -> bool:
+    self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return True
+    return False
+
+
+class DaemonStats:
+  def __init__(self):
+    self.records = 0
+    self.bytes = 0
+    self.dropped = 0
+
+
+def get_daemon(record: str) -> str:
+  # ctx comes after msg, which can hold anything, and nothing after it has unescaped keys. so only ctx is parsed
+  idx = record.rfind('"ctx":')
+  if idx == -1:
+    return "unknown"
+  start = idx + len('"ctx":')
+  if record.startswith(' ', start):
+    start += 1
+
+  try:
+    ctx, _ = _json_decoder.raw_decode(record, start)
+  except ValueError:
+    return "unknown"
+  daemon = ctx.get("daemon") if isinstance(ctx, dict) else None
+  return daemon if isinstance(daemon, str) else "unknown"
+
+
+def writer_thread(log_handler, write_queue: queue.Queue) -> None:
+  while (batch := write_queue.get()) is not None:
+    for record in batch:
+      log_handler.emit(record)
 
 
 def main() -> NoReturn:
@@ -21,30 +84,85 @@ def main() -> NoReturn:
   log_message_sock = messaging.pub_sock('logMessage')
   error_log_message_sock = messaging.pub_sock('errorLogMessage')
 
+  # writing to disk can stall, so it doesn't hold up publishing
+  write_queue: queue.Queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+  writer = threading.Thread(target=writer_thread, args=(log_handler, write_queue), daemon=True)
+  writer.start()
+  write_dropped = 0
+
+  buckets: dict[str, TokenBucket] = {}
+  stats: dict[str, DaemonStats] = defaultdict(DaemonStats)
+  last_stats_time = time.monotonic()
+
   try:
     while True:
-      dat = b''.join(sock.recv_multipart())
-      level = dat[0]
-      record = dat[1:].decode("utf-8")
-      if level >= log_level:
-        log_handler.emit(record)
-
-      if len(record) > 2*1024*1024:
-        print("WARNING: log too big to publish", len(record))
-        print(record[:100])
-        continue
-
-      # then we publish them
-      msg = messaging.new_message(None, valid=True, logMessage=record)
-      log_message_sock.send(msg.to_bytes())
-
-      if level >= 40:  # logging.ERROR
-        msg = messaging.new_message(None, valid=True, errorLogMessage=record)
-        error_log_message_sock.send(msg.to_bytes())
+      batch = []
+      if sock.poll(1000):
+        while len(batch) < MAX_BATCH_SIZE:
+          try:
+            batch.append(b''.join(sock.recv_multipart(zmq.NOBLOCK)))
+          except zmq.error.Again:
+            break
+
+      now = time.monotonic()
+      to_write = []
+      for dat in batch:
+        level = dat[0]
+        record = dat[1:].decode("utf-8")
+        if level >= log_level:
+          to_write.append(record)
+
+        daemon = get_daemon(record)
+        if daemon not in buckets:
+          buckets[daemon] = TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+
+        daemon_stats = stats[daemon]
+        daemon_stats.records += 1
+        daemon_stats.bytes += len(dat)
+        if level < 40 and not buckets[daemon].consume(now):  # logging.ERROR
+          daemon_stats.dropped += 1
+          continue
+
+        if len(record) > 2*1024*1024:
+          print("WARNING: log too big to publish", len(record))
+          print(record[:100])
+          continue
+
+        # then we publish them
+        msg = messaging.new_message(None, valid=True, logMessage=record)
+        log_message_sock.send(msg.to_bytes())
+
+        if level >= 40:  # logging.ERROR
+          msg = messaging.new_message(None, valid=True, errorLogMessage=record)
+          error_log_message_sock.send(msg.to_bytes())
+
+      if to_write:
+        try:
+          write_queue.put_nowait(to_write)
+        except queue.Full:
+          write_dropped += len(to_write)
+
+      if now - last_stats_time > STATS_INTERVAL:
+        dt = now - last_stats_time
+        for daemon, daemon_stats in stats.items():
+          statlog.gauge(f"logmessaged.{daemon}.records_per_s", daemon_stats.records / dt)
+          statlog.gauge(f"logmessaged.{daemon}.bytes_per_s", daemon_stats.bytes / dt)
+          if daemon_stats.dropped:
+            statlog.gauge(f"logmessaged.{daemon}.dropped", daemon_stats.dropped)
+            cloudlog.warning(f"logmessaged: rate limited {daemon}, didn't publish {daemon_stats.dropped} records")
+        if write_dropped:
+          cloudlog.warning(f"logmessaged: disk writes falling behind, dropped {write_dropped} records")
+
+        stats.clear()
+        write_dropped = 0
+        last_stats_time = now
   finally:
     sock.close()
     ctx.term()
 
+    write_queue.put(None)
+    writer.join()
+
     # can hit this if interrupted during a rollover
     try:
       log_handler.close()
@@ -9,6 +9,10 @@ from openpilot.common.swaglog import cloudlog
 JIFFY = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
 PAGE_SIZE = os.sysconf(os.sysconf_names['SC_PAGE_SIZE'])
 
+# only publish processes that used this much CPU time (s) or changed their RSS by this much (bytes) since last published
+MIN_CPU_DELTA = float(os.getenv("PROCLOG_MIN_CPU_DELTA", "0"))
+MIN_RSS_DELTA = int(os.getenv("PROCLOG_MIN_RSS_DELTA", "0"))
+
 
 def _cpu_times() -> list[dict[str, float]]:
   cpu_times: list[dict[str, float]] = []
@@ -64,6 +68,10 @@ _STAT_POS = {
   'rss': 24,
   'processor': 39,
 }
+# fields after the name, which is the only one that can contain spaces
+_STAT_FIELDS = tuple((k, _STAT_POS[k] - 3) for k in ('ppid', 'utime', 'stime', 'cutime', 'cstime', 'priority', 'nice', 'num_threads',
+                                                     'starttime', 'vsize', 'rss', 'processor'))
+_STAT_NUM_FIELDS = 52
 
 class ProcStat(TypedDict):
   name: str
@@ -88,28 +96,27 @@ def _parse_proc_stat(stat: str) -> ProcStat | None:
   close_paren = stat.rfind(')')
   if open_paren == -1 or close_paren == -1 or open_paren > close_paren:
     return None
-  name = stat[open_paren + 1:close_paren]
-  stat = stat[:open_paren] + stat[open_paren:close_paren].replace(' ', '_') + stat[close_paren:]
-  parts = stat.split()
-  if len(parts) < 52:
+  parts = stat[close_paren + 2:].split()
+  if len(parts) < _STAT_NUM_FIELDS - 2:
     return None
   try:
+    fields = {k: int(parts[i]) for k, i in _STAT_FIELDS}
     return {
-      'name': name,
-      'pid': int(parts[_STAT_POS['pid'] - 1]),
-      'state': parts[_STAT_POS['state'] - 1][0],
-      'ppid': int(parts[_STAT_POS['ppid'] - 1]),
-      'utime': int(parts[_STAT_POS['utime'] - 1]),
-      'stime': int(parts[_STAT_POS['stime'] - 1]),
-      'cutime': int(parts[_STAT_POS['cutime'] - 1]),
-      'cstime': int(parts[_STAT_POS['cstime'] - 1]),
-      'priority': int(parts[_STAT_POS['priority'] - 1]),
-      'nice': int(parts[_STAT_POS['nice'] - 1]),
-      'num_threads': int(parts[_STAT_POS['num_threads'] - 1]),
-      'starttime': int(parts[_STAT_POS['starttime'] - 1]),
-      'vms': int(parts[_STAT_POS['vsize'] - 1]),
-      'rss': int(parts[_STAT_POS['rss'] - 1]),
-      'processor': int(parts[_STAT_POS['processor'] - 1]),
+      'name': stat[open_paren + 1:close_paren],
+      'pid': int(stat[:open_paren]),
+      'state': parts[0][0],
+      'ppid': fields['ppid'],
+      'utime': fields['utime'],
+      'stime': fields['stime'],
+      'cutime': fields['cutime'],
+      'cstime': fields['cstime'],
+      'priority': fields['priority'],
+      'nice': fields['nice'],
+      'num_threads': fields['num_threads'],
+      'starttime': fields['starttime'],
+      'vms': fields['vsize'],
+      'rss': fields['rss'],
+      'processor': fields['processor'],
     }
   except Exception:
     cloudlog.exception("failed to parse /proc/<pid>/stat")
@@ -144,26 +151,100 @@ def _get_proc_extra(pid: int, name: str) -> ProcExtra:
   return cache
 
 
-def _procs() -> list[ProcStat]:
-  stats: list[ProcStat] = []
-  for pid_str in os.listdir('/proc'):
-    if not pid_str.isdigit():
-      continue
+class ProcSampler:
+  """Reads /proc/<pid>/stat of all processes, keeping the stat files of known processes open between samples.
+
+  To publish less, processes can be left out of a sample unless they've used min_cpu_delta seconds of CPU,
+  or their RSS changed by min_rss_delta bytes since they were last published. New processes are always
+  published, and every full_interval samples all processes are."""
+
+  MAX_OPEN_FILES = 512
+  READ_SIZE = 1024
+
+  def __init__(self, min_cpu_delta: float = 0., min_rss_delta: int = 0, full_interval: int = 15):
+    self.min_cpu_delta = min_cpu_delta
+    self.min_rss_delta = min_rss_delta
+    self.full_interval = full_interval
+
+    self.fds: dict[int, int] = {}
+    self.published: dict[int, tuple[float, int]] = {}  # pid -> (cpu time, rss) when last published
+    self.samples = 0
+
+  def __del__(self):
+    self.close()
+
+  def close(self) -> None:
+    for fd in self.fds.values():
+      os.close(fd)
+    self.fds.clear()
+
+  def _read_stat(self, pid: int) -> str | None:
+    fd = self.fds.get(pid)
     try:
-      with open(f'/proc/{pid_str}/stat') as f:
-        stat = f.read()
-      parsed = _parse_proc_stat(stat)
-      if parsed is not None:
-        stats.append(parsed)
+      if fd is None:
+        fd = os.open(f'/proc/{pid}/stat', os.O_RDONLY)
+        if len(self.fds) >= self.MAX_OPEN_FILES:
+          try:
+            return os.pread(fd, self.READ_SIZE, 0).decode(errors='replace')
+          finally:
+            os.close(fd)
+        self.fds[pid] = fd
+      return os.pread(fd, self.READ_SIZE, 0).decode(errors='replace')
     except OSError:
-      continue
-  return stats
+      # the process exited, and its pid may get reused
+      if pid in self.fds:
+        os.close(self.fds.pop(pid))
+      return None
+
+  def procs(self) -> list[ProcStat]:
+    pids = {int(p) for p in os.listdir('/proc') if p.isdigit()}
+
+    for pid in self.fds.keys() - pids:
+      os.close(self.fds.pop(pid))
+    for pid in _proc_cache.keys() - pids:
+      del _proc_cache[pid]
+    for pid in self.published.keys() - pids:
+      del self.published[pid]
+
+    stats: list[ProcStat] = []
+    for pid in sorted(pids):
+      stat = self._read_stat(pid)
+      if stat is not None:
+        parsed = _parse_proc_stat(stat)
+        if parsed is not None:
+          stats.append(parsed)
+    return stats
+
+  def sample(self) -> list[ProcStat]:
+    """The processes to publish"""
+    procs = self.procs()
+    full = self.samples % self.full_interval == 0
+    self.samples += 1
+
+    selected = []
+    for r in procs:
+      cpu_time = (r['utime'] + r['stime']) / JIFFY
+      rss = r['rss'] * PAGE_SIZE
+      last = self.published.get(r['pid'])
+      if full or last is None or cpu_time - last[0] >= self.min_cpu_delta or abs(rss - last[1]) >= self.min_rss_delta:
+        self.published[r['pid']] = (cpu_time, rss)
+        selected.append(r)
+    return selected
+
+
+_sampler: ProcSampler | None = None
+
 
+def build_proc_log_message(msg, sampler: ProcSampler | None = None) -> None:
+  global _sampler
+  if sampler is None:
+    if _sampler is None:
+      _sampler = ProcSampler()
+    sampler = _sampler
 
-def build_proc_log_message(msg) -> None:
   pl = msg.procLog
 
-  procs = _procs()
+  procs = sampler.sample()
   l = pl.init('procs', len(procs))
   for i, r in enumerate(procs):
     proc = l[i]
@@ -216,9 +297,10 @@ def build_proc_log_message(msg) -> None:
 def main() -> NoReturn:
   pm = messaging.PubMaster(['procLog'])
   rk = Ratekeeper(0.5)
+  sampler = ProcSampler(MIN_CPU_DELTA, MIN_RSS_DELTA)
   while True:
     msg = messaging.new_message('procLog', valid=True)
-    build_proc_log_message(msg)
+    build_proc_log_message(msg, sampler)
     pm.send('procLog', msg)
     rk.keep_time()
 
@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
+import math
 import os
 import zmq
 import time
 import uuid
 from pathlib import Path
-from collections import defaultdict
 from datetime import datetime, UTC
 from typing import NoReturn
 
@@ -17,6 +17,10 @@ from openpilot.common.utils import atomic_write
 from openpilot.system.version import get_build_metadata
 from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET, STATS_FLUSH_TIME_S
 
+# metrics are sent in batches of up to this many, or at least once per interval
+STATS_BATCH_SIZE = 100
+STATS_BATCH_INTERVAL_S = 1.
+
 
 class METRIC_TYPE:
   GAUGE = 'g'
@@ -28,6 +32,11 @@ class StatLog:
     self.zctx = None
     self.sock = None
 
+    # gauges only keep their last value
+    self.gauges: dict[str, float] = {}
+    self.samples: list[bytes] = []
+    self.last_send_time = time.monotonic()
+
   def connect(self) -> None:
     self.zctx = zmq.Context()
     self.sock = self.zctx.socket(zmq.PUSH)
@@ -37,27 +46,110 @@ class StatLog:
 
   def __del__(self):
     if self.sock is not None:
+      if os.getpid() == self.pid:
+        self.flush()
       self.sock.close()
     if self.zctx is not None:
       self.zctx.term()
 
-  def _send(self, metric: str) -> None:
+  def _maybe_flush(self) -> None:
+    if len(self.gauges) + len(self.samples) >= STATS_BATCH_SIZE or time.monotonic() - self.last_send_time > STATS_BATCH_INTERVAL_S:
+      self.flush()
+
+  def flush(self) -> None:
+    """Sends all buffered metrics as a single multipart message"""
     if os.getpid() != self.pid:
       self.connect()
 
+    metrics = [f"{name}:{value}|{METRIC_TYPE.GAUGE}".encode() for name, value in self.gauges.items()] + self.samples
+    self.gauges.clear()
+    self.samples = []
+    self.last_send_time = time.monotonic()
+    if not metrics:
+      return
+
     try:
-      self.sock.send_string(metric, zmq.NOBLOCK)
+      self.sock.send_multipart(metrics, zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
 
   def gauge(self, name: str, value: float) -> None:
-    self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
+    self.gauges[name] = value
+    self._maybe_flush()
 
-  # Samples will be recorded in a buffer and at aggregation time,
+  # Samples will be recorded in a sketch and at aggregation time,
   # statistical properties will be logged (mean, count, percentiles, ...)
   def sample(self, name: str, value: float):
-    self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
+    self.samples.append(f"{name}:{value}|{METRIC_TYPE.SAMPLE}".encode())
+    self._maybe_flush()
+
+
+class QuantileSketch:
+  """DDSketch: samples are counted in buckets with logarithmically growing widths, so quantiles are
+  within relative_accuracy of the exact value, with memory that doesn't grow with the number of samples.
+  Beyond max_buckets, the buckets closest to the minimum are merged, losing accuracy only there."""
+
+  MIN_INDEXABLE = 1e-9
+
+  def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_buckets = max_buckets
+
+    self.positive: dict[int, int] = {}
+    self.negative: dict[int, int] = {}  # indexed by magnitude
+    self.zero_count = 0
+
+    self.count = 0
+    self.sum = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  def add(self, value: float) -> None:
+    self.count += 1
+    self.sum += value
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+
+    if value > self.MIN_INDEXABLE:
+      store = self.positive
+    elif value < -self.MIN_INDEXABLE:
+      store = self.negative
+    else:
+      self.zero_count += 1
+      return
+
+    key = math.ceil(math.log(abs(value)) / self.log_gamma)
+    store[key] = store.get(key, 0) + 1
+    if len(self.positive) + len(self.negative) > self.max_buckets:
+      self._collapse()
+
+  def _collapse(self) -> None:
+    # the lowest values are the largest magnitude negative ones, or else the smallest positive ones
+    if len(self.negative) > 1:
+      store, keys = self.negative, sorted(self.negative, reverse=True)
+    else:
+      store, keys = self.positive, sorted(self.positive)
+
+    n = min(len(keys) - 1, len(self.positive) + len(self.negative) - self.max_buckets)
+    for key in keys[:n]:
+      store[keys[n]] += store.pop(key)
+
+  def _value(self, key: int) -> float:
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def quantile(self, q: float) -> float:
+    rank = int(round(q * (self.count - 1)))
+    seen = 0
+    buckets = [(-self._value(k), self.negative[k]) for k in sorted(self.negative, reverse=True)]
+    buckets.append((0., self.zero_count))
+    buckets += [(self._value(k), self.positive[k]) for k in sorted(self.positive)]
+    for value, count in buckets:
+      seen += count
+      if seen > rank:
+        return min(max(value, self.min), self.max)
+    return self.max
 
 
 def main() -> NoReturn:
@@ -106,7 +198,7 @@ def main() -> NoReturn:
   boot_uid = str(uuid.uuid4())[:8]
   last_flush_time = time.monotonic()
   gauges = {}
-  samples: dict[str, list[float]] = defaultdict(list)
+  samples: dict[str, QuantileSketch] = {}
   try:
     while True:
       started_prev = sm['deviceState'].started
@@ -115,7 +207,12 @@ def main() -> NoReturn:
       # Update metrics
       while True:
         try:
-          metric = sock.recv_string(zmq.NOBLOCK)
+          batch = sock.recv_multipart(zmq.NOBLOCK)
+        except zmq.error.Again:
+          break
+
+        for frame in batch:
+          metric = frame.decode(errors="replace")
           try:
             metric_type = metric.split('|')[1]
             metric_name = metric.split(':')[0]
@@ -124,13 +221,13 @@ def main() -> NoReturn:
             if metric_type == METRIC_TYPE.GAUGE:
               gauges[metric_name] = metric_value
             elif metric_type == METRIC_TYPE.SAMPLE:
-              samples[metric_name].append(metric_value)
+              if metric_name not in samples:
+                samples[metric_name] = QuantileSketch()
+              samples[metric_name].add(metric_value)
             else:
               cloudlog.event("unknown metric type", metric_type=metric_type)
           except Exception:
             cloudlog.event("malformed metric", metric=metric)
-        except zmq.error.Again:
-          break
 
       # flush when started state changes or after FLUSH_TIME_S
       if (time.monotonic() > last_flush_time + STATS_FLUSH_TIME_S) or (sm['deviceState'].started != started_prev):
@@ -141,20 +238,15 @@ def main() -> NoReturn:
         for key, value in gauges.items():
           result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
 
-        for key, values in samples.items():
-          values.sort()
-          sample_count = len(values)
-          sample_sum = sum(values)
-
+        for key, sketch in samples.items():
           stats = {
-            'count': sample_count,
-            'min': values[0],
-            'max': values[-1],
-            'mean': sample_sum / sample_count,
+            'count': sketch.count,
+            'min': sketch.min,
+            'max': sketch.max,
+            'mean': sketch.sum / sketch.count,
           }
           for percentile in [0.05, 0.5, 0.95]:
-            value = values[int(round(percentile * (sample_count - 1)))]
-            stats[f"p{int(percentile * 100)}"] = value
+            stats[f"p{int(percentile * 100)}"] = sketch.quantile(percentile)
 
           result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
 
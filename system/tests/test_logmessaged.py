@@ -3,6 +3,7 @@ import os
 import time
 
 import cereal.messaging as messaging
+from openpilot.system import logmessaged
 from openpilot.system.manager.process_config import managed_processes
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog, ipchandler
@@ -53,3 +54,52 @@ class TestLogmessaged:
     logsize = sum([os.path.getsize(f) for f in self._get_log_files()])
     assert (n*len(msg)) < logsize < (n*(len(msg)+1024))
 
+  def test_rate_limit(self):
+    n = logmessaged.RATE_LIMIT_BURST * 2
+    for i in range(n):
+      cloudlog.info(f"spam {i}")
+      if i % 500 == 0:
+        time.sleep(0.05)  # don't fill up the socket itself
+    time.sleep(1)
+
+    # the burst and what the bucket refilled in the meantime gets published, the rest isn't
+    msgs = messaging.drain_sock(self.sock)
+    assert 0 < len(msgs) <= logmessaged.RATE_LIMIT_BURST + 2 * logmessaged.RATE_LIMIT < n
+
+    # but everything is written to disk
+    written = 0
+    for fn in self._get_log_files():
+      with open(fn) as f:
+        written += f.read().count('"spam ')
+    assert written == n
+
+  def test_rate_limit_errors(self):
+    n = logmessaged.RATE_LIMIT_BURST * 2
+    for i in range(n):
+      cloudlog.info(f"spam {i}")
+      if i % 500 == 0:
+        time.sleep(0.05)
+    for i in range(10):
+      cloudlog.error(f"error {i}")
+    time.sleep(1)
+
+    # errors still get through once the daemon is rate limited
+    msgs = messaging.drain_sock(self.sock)
+    assert sum('"error ' in m.logMessage for m in msgs) == 10
+
+
+class TestRateLimit:
+  def test_get_daemon(self):
+    assert logmessaged.get_daemon('{"msg": "a", "ctx": {"daemon": "controlsd", "dirty": true}, "level": "INFO"}') == "controlsd"
+    assert logmessaged.get_daemon('{"msg":"\\"ctx\\": {\\"daemon\\": \\"x\\"}","ctx":{"daemon":"loggerd"}}') == "loggerd"
+    # events are dicts, that can have their own daemon or ctx
+    assert logmessaged.get_daemon('{"msg": {"event": "e", "daemon": "x", "ctx": {"daemon": "y"}}, "ctx": {"daemon": "pandad"}}') == "pandad"
+    assert logmessaged.get_daemon('{"msg": "a", "ctx": {}}') == "unknown"
+    assert logmessaged.get_daemon('{"msg": "a", "ctx": {"daemon": ') == "unknown"
+
+  def test_token_bucket(self):
+    bucket = logmessaged.TokenBucket(rate=10, burst=5)
+    t = bucket.last
+    assert sum(bucket.consume(t) for _ in range(10)) == 5
+    assert sum(bucket.consume(t + 0.5) for _ in range(10)) == 5
+    assert sum(bucket.consume(t + 0.6) for _ in range(10)) == 1
@@ -0,0 +1,66 @@
+import os
+import subprocess
+
+from openpilot.system import proclogd
+
+
+def parse_proc_stat_split(stat: str):
+  # reference parser, splitting the whole line
+  name = stat[stat.find('(') + 1:stat.rfind(')')]
+  parts = stat[stat.rfind(')') + 2:].split()
+  return name, int(stat.split()[0]), [int(parts[i]) for _, i in proclogd._STAT_FIELDS]
+
+
+class TestProcSampler:
+  def test_parse(self):
+    stat = "1234 (a (b) c) S 1 " + " ".join(str(i) for i in range(60))
+    r = proclogd._parse_proc_stat(stat)
+    assert r is not None
+    assert r['name'] == "a (b) c"
+    assert (r['pid'], r['state'], r['ppid']) == (1234, 'S', 1)
+    assert r['utime'] == 9 and r['rss'] == 19 and r['processor'] == 34
+    assert proclogd._parse_proc_stat("1234 (a) S 1 2 3") is None
+
+  def test_procs(self):
+    sampler = proclogd.ProcSampler()
+    procs = {r['pid']: r for r in sampler.procs()}
+    assert os.getpid() in procs
+    assert os.getpid() in sampler.fds
+
+    with open(f"/proc/{os.getpid()}/stat") as f:
+      name, pid, _ = parse_proc_stat_split(f.read())
+    assert procs[pid]['name'] == name
+
+  def test_exited(self):
+    sampler = proclogd.ProcSampler()
+    p = subprocess.Popen(["sleep", "10"])
+    try:
+      assert p.pid in {r['pid'] for r in sampler.procs()}
+      assert p.pid in sampler.fds
+    finally:
+      p.kill()
+      p.wait()
+
+    assert p.pid not in {r['pid'] for r in sampler.procs()}
+    assert p.pid not in sampler.fds
+    assert p.pid not in proclogd._proc_cache
+    sampler.close()
+
+  def test_threshold(self):
+    sampler = proclogd.ProcSampler(min_cpu_delta=1e6, min_rss_delta=1 << 60, full_interval=3)
+
+    # other processes come and go while the test runs, so only this one and its child are checked
+    def sample(*pids):
+      return [r['pid'] for r in sampler.sample() if r['pid'] in pids]
+
+    # all processes are published on the first and every full_interval'th sample, and new processes always
+    assert sample(os.getpid()) == [os.getpid()]
+    assert sample(os.getpid()) == []
+    p = subprocess.Popen(["sleep", "10"])
+    try:
+      assert sample(os.getpid(), p.pid) == [p.pid]
+      assert sorted(sample(os.getpid(), p.pid)) == sorted([os.getpid(), p.pid])
+    finally:
+      p.kill()
+      p.wait()
+    sampler.close()
@@ -0,0 +1,80 @@
+import math
+import random
+import pytest
+import zmq
+
+from openpilot.system import statsd
+
+
+def exact_quantile(values, q):
+  values = sorted(values)
+  return values[int(round(q * (len(values) - 1)))]
+
+
+class TestQuantileSketch:
+  @pytest.mark.parametrize("dist", ["uniform", "lognormal", "signed"])
+  def test_accuracy(self, dist):
+    random.seed(0)
+    gen = {
+      "uniform": lambda: random.uniform(0, 10),
+      "lognormal": lambda: random.lognormvariate(0, 3),
+      "signed": lambda: random.choice((0., random.gauss(0, 100))),
+    }[dist]
+    values = [gen() for _ in range(20000)]
+
+    sketch = statsd.QuantileSketch(relative_accuracy=0.01)
+    for v in values:
+      sketch.add(v)
+
+    assert sketch.count == len(values)
+    assert sketch.min == min(values) and sketch.max == max(values)
+    assert sketch.sum == pytest.approx(sum(values))
+    for q in (0, 0.05, 0.5, 0.95, 1):
+      assert sketch.quantile(q) == pytest.approx(exact_quantile(values, q), rel=0.01, abs=1e-9)
+
+  def test_bounded(self):
+    # 1 to 10 spans ~116 buckets, the top 63 left after collapsing cover values above ~2.8, so well below p95
+    rng = random.Random(0)
+    sketch = statsd.QuantileSketch(relative_accuracy=0.01, max_buckets=64)
+    values = [rng.uniform(1, 10) for _ in range(5000)]
+    for v in values:
+      sketch.add(v)
+
+    assert len(sketch.positive) == 64
+    lowest = min(sketch.positive)
+    assert lowest > math.ceil(math.log(min(values)) / sketch.log_gamma)
+    assert exact_quantile(values, 0.95) > sketch._value(lowest + 1)
+
+    # only the lowest quantiles lose accuracy
+    assert sketch.quantile(0.95) == pytest.approx(exact_quantile(values, 0.95), rel=0.01)
+    assert sketch.quantile(0.5) == pytest.approx(exact_quantile(values, 0.5), rel=0.01)
+    assert sketch.quantile(0.01) != pytest.approx(exact_quantile(values, 0.01), rel=0.01)
+
+
+class TestStatLog:
+  @pytest.fixture
+  def sock(self, tmp_path, monkeypatch):
+    addr = f"ipc://{tmp_path}/stats"
+    monkeypatch.setattr(statsd, "STATS_SOCKET", addr)
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PULL)
+    sock.bind(addr)
+    sock.setsockopt(zmq.RCVTIMEO, 1000)
+    yield sock
+    sock.close()
+    ctx.term()
+
+  def test_batching(self, sock, monkeypatch):
+    monkeypatch.setattr(statsd, "STATS_BATCH_INTERVAL_S", 1e6)
+    statlog = statsd.StatLog()
+    for i in range(statsd.STATS_BATCH_SIZE):
+      statlog.gauge("g", i)
+      statlog.sample("s", i)
+
+    # gauges only send their last value
+    batch = sock.recv_multipart()
+    assert batch == [f"g:{statsd.STATS_BATCH_SIZE - 2}|g".encode()] + [f"s:{i}|sa".encode() for i in range(statsd.STATS_BATCH_SIZE - 1)]
+
+    statlog.flush()
+    assert sock.recv_multipart() == [f"g:{statsd.STATS_BATCH_SIZE - 1}|g".encode(), f"s:{statsd.STATS_BATCH_SIZE - 1}|sa".encode()]
+    del statlog
@@ -3,12 +3,16 @@ import io
 import lzma
 import os
 import pathlib
+import shutil
 import struct
 import sys
+import tempfile
+import threading
 import time
 from abc import ABC, abstractmethod
 from collections import defaultdict, namedtuple
 from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from typing import IO
 
 import requests
@@ -28,6 +32,9 @@ CA_TABLE_MIN_LEN = CA_TABLE_HEADER_LEN + CA_TABLE_ENTRY_LEN
 
 CHUNK_DOWNLOAD_TIMEOUT = 60
 CHUNK_DOWNLOAD_RETRIES = 3
+CHUNK_DOWNLOAD_RETRY_DELAY = 1  # doubled after every failed attempt
+
+EXTRACT_WORKERS = 8
 
 CAIBX_DOWNLOAD_TIMEOUT = 120
 
@@ -42,14 +49,23 @@ class ChunkReader(ABC):
 
 
 class BinaryChunkReader(ChunkReader):
-  """Reads chunks from a local file"""
+  """Reads chunks from a local file. Safe to call from multiple threads"""
   def __init__(self, file_like: IO[bytes]) -> None:
     super().__init__()
     self.f = file_like
+    self.lock = threading.Lock()
+    try:
+      self.fd: int | None = file_like.fileno()
+    except (AttributeError, OSError):
+      self.fd = None
 
   def read(self, chunk: Chunk) -> bytes:
-    self.f.seek(chunk.offset)
-    return self.f.read(chunk.length)
+    if self.fd is not None:
+      return os.pread(self.fd, chunk.length, chunk.offset)
+
+    with self.lock:
+      self.f.seek(chunk.offset)
+      return self.f.read(chunk.length)
 
 
 class FileChunkReader(BinaryChunkReader):
@@ -66,7 +82,14 @@ class RemoteChunkReader(ChunkReader):
   def __init__(self, url: str) -> None:
     super().__init__()
     self.url = url
-    self.session = requests.Session()
+    self.local = threading.local()
+
+  @property
+  def session(self) -> requests.Session:
+    # requests sessions aren't thread safe, keep one per extraction worker
+    if not hasattr(self.local, "session"):
+      self.local.session = requests.Session()
+    return self.local.session
 
   def read(self, chunk: Chunk) -> bytes:
     sha_hex = chunk.sha.hex()
@@ -83,7 +106,7 @@ class RemoteChunkReader(ChunkReader):
         except Exception:
           if i == CHUNK_DOWNLOAD_RETRIES - 1:
             raise
-          time.sleep(CHUNK_DOWNLOAD_TIMEOUT)
+          time.sleep(CHUNK_DOWNLOAD_RETRY_DELAY * 2 ** i)
 
       resp.raise_for_status()
       contents = resp.content
@@ -92,6 +115,108 @@ class RemoteChunkReader(ChunkReader):
     return decompressor.decompress(contents)
 
 
+class LocalChunkStore(ChunkReader):
+  """Content addressed store of verified, uncompressed chunks on local disk.
+
+  Chunks downloaded during an extraction are added here, so an interrupted or repeated update
+  doesn't need to download them again. The store is kept under max_bytes as chunks are added, by evicting
+  the least recently written chunks that aren't part of the current target, and no chunks are added
+  while the filesystem has less than min_free_bytes free."""
+
+  def __init__(self, path: str, max_bytes: int | None = None, min_free_bytes: int = 0) -> None:
+    super().__init__()
+    self.path = path
+    self.max_bytes = max_bytes
+    self.min_free_bytes = min_free_bytes
+
+    self.lock = threading.Lock()
+    self.size: int | None = None  # bytes in the store, scanned on the first put
+    self.evictable: list[tuple[float, int, str]] = []  # (mtime, size, path) of the chunks found by that scan, newest first
+    self.keep: set[str] = set()  # chunks of the current target, never evicted by put
+
+  def chunk_path(self, sha: bytes) -> str:
+    sha_hex = sha.hex()
+    return os.path.join(self.path, sha_hex[:4], sha_hex + ".chunk")
+
+  def read(self, chunk: Chunk) -> bytes:
+    with open(self.chunk_path(chunk.sha), 'rb') as f:
+      return f.read()
+
+  def _scan(self) -> list[tuple[float, int, str]]:
+    entries = []
+    if os.path.isdir(self.path):
+      for d in os.scandir(self.path):
+        if d.is_dir():
+          entries += [(e.stat().st_mtime, e.stat().st_size, e.path) for e in os.scandir(d.path) if e.is_file()]
+    return entries
+
+  def _reserve(self, length: int) -> bool:
+    """Makes room for a chunk of length bytes within max_bytes, returns False if it shouldn't be stored"""
+    if self.min_free_bytes and shutil.disk_usage(self.path).free - length < self.min_free_bytes:
+      return False
+
+    with self.lock:
+      if self.size is None:
+        entries = self._scan()
+        self.size = sum(size for _, size, _ in entries)
+        self.evictable = sorted((e for e in entries if e[2] not in self.keep), reverse=True)
+
+      if self.max_bytes is not None:
+        while self.size + length > self.max_bytes and self.evictable:
+          _, size, path = self.evictable.pop()
+          try:
+            os.unlink(path)
+          except FileNotFoundError:
+            pass
+          self.size -= size
+
+        if self.size + length > self.max_bytes:
+          return False
+
+      self.size += length
+      return True
+
+  def put(self, sha: bytes, data: bytes) -> None:
+    path = self.chunk_path(sha)
+    if os.path.isfile(path):
+      return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not self._reserve(len(data)):
+      return
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+      f.write(data)
+    os.replace(f.name, path)
+
+  def build_chunk_dict(self, chunks: list[Chunk]) -> ChunkDict:
+    """Like build_chunk_dict, but only for the chunks present in the store. These are kept until the next prune"""
+    r = {sha: c for sha, c in build_chunk_dict(chunks).items() if os.path.isfile(self.chunk_path(sha))}
+    with self.lock:
+      self.keep |= {self.chunk_path(sha) for sha in r}
+      self.evictable = [e for e in self.evictable if e[2] not in self.keep]
+    return r
+
+  def prune(self) -> None:
+    if self.max_bytes is None or not os.path.isdir(self.path):
+      return
+
+    entries = self._scan()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+
+    with self.lock:
+      self.size = None
+      self.keep.clear()
+
+
 class DirectoryTarChunkReader(BinaryChunkReader):
   """creates a tar archive of a directory and reads chunks from it"""
 
@@ -165,41 +290,81 @@ def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
   return r
 
 
+def read_verified(chunk: Chunk, sources: list[tuple[str, ChunkReader, ChunkDict]]) -> tuple[str, ChunkReader, bytes]:
+  """Reads a chunk from the first source that has it with the right length and hash"""
+  for name, chunk_reader, store_chunks in sources:
+    if chunk.sha in store_chunks:
+      bts = chunk_reader.read(store_chunks[chunk.sha])
+
+      # Check length
+      if len(bts) != chunk.length:
+        continue
+
+      # Check hash
+      if SHA512.new(bts, truncate="256").digest() != chunk.sha:
+        continue
+
+      return name, chunk_reader, bts
+
+  raise RuntimeError("Desired chunk not found in provided stores")
+
+
 def extract(target: list[Chunk],
             sources: list[tuple[str, ChunkReader, ChunkDict]],
             out_path: str,
-            progress: Callable[[int], None] | None = None):
+            progress: Callable[[int], None] | None = None,
+            store: LocalChunkStore | None = None,
+            workers: int = EXTRACT_WORKERS):
+  """Writes the target chunks to out_path, reading each from the first source that has it.
+
+  Chunks are read, decompressed and verified in a pool of workers, and written in whatever order they
+  complete using positioned writes. Every distinct chunk is only read once, further copies of it are
+  reported as 'reused'. Chunks that came from a remote source are added to store, if given."""
   stats: dict[str, int] = defaultdict(int)
 
-  mode = 'rb+' if os.path.exists(out_path) else 'wb'
-  with open(out_path, mode) as out:
-    for cur_chunk in target:
-
-      # Find source for desired chunk
-      for name, chunk_reader, store_chunks in sources:
-        if cur_chunk.sha in store_chunks:
-          bts = chunk_reader.read(store_chunks[cur_chunk.sha])
+  offsets: dict[bytes, list[Chunk]] = defaultdict(list)
+  for c in target:
+    offsets[c.sha].append(c)
 
-          # Check length
-          if len(bts) != cur_chunk.length:
-            continue
+  fd = os.open(out_path, os.O_RDWR | os.O_CREAT, 0o644)
 
-          # Check hash
-          if SHA512.new(bts, truncate="256").digest() != cur_chunk.sha:
-            continue
+  def process(chunks: list[Chunk]) -> tuple[str, int, int]:
+    name, chunk_reader, bts = read_verified(chunks[0], sources)
 
-          # Write to output
-          out.seek(cur_chunk.offset)
-          out.write(bts)
+    for c in chunks:
+      os.pwrite(fd, bts, c.offset)
 
-          stats[name] += cur_chunk.length
+    if store is not None and isinstance(chunk_reader, RemoteChunkReader):
+      store.put(chunks[0].sha, bts)
 
-          if progress is not None:
-            progress(sum(stats.values()))
+    return name, len(bts), len(bts) * (len(chunks) - 1)
 
+  pool = ThreadPoolExecutor(max_workers=workers)
+  try:
+    pending: set[Future] = set()
+    todo = iter(offsets.values())
+    while True:
+      # keep the number of chunks in flight bounded, since all of them are held in memory
+      for chunks in todo:
+        pending.add(pool.submit(process, chunks))
+        if len(pending) >= 2 * workers:
           break
-      else:
-        raise RuntimeError("Desired chunk not found in provided stores")
+
+      if not pending:
+        break
+
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for fut in done:
+        name, length, reused = fut.result()
+        stats[name] += length
+        if reused:
+          stats['reused'] += reused
+
+        if progress is not None:
+          progress(sum(stats.values()))
+  finally:
+    pool.shutdown(wait=True, cancel_futures=True)
+    os.close(fd)
 
   return stats
 
@@ -208,10 +373,11 @@ def extract_directory(target: list[Chunk],
             sources: list[tuple[str, ChunkReader, ChunkDict]],
             out_path: str,
             tmp_file: str,
-            progress: Callable[[int], None] | None = None):
+            progress: Callable[[int], None] | None = None,
+            store: LocalChunkStore | None = None):
   """extract a directory stored as a casync tar archive"""
 
-  stats = extract(target, sources, tmp_file, progress)
+  stats = extract(target, sources, tmp_file, progress, store)
 
   with open(tmp_file, "rb") as f:
     tar.extract_tar_archive(f, pathlib.Path(out_path))
@@ -1,8 +1,11 @@
 import pytest
+import lzma
 import os
 import pathlib
+import random
 import tempfile
 import subprocess
+from Crypto.Hash import SHA512
 
 from openpilot.system.updated.casync import casync
 from openpilot.system.updated.casync import tar
@@ -69,7 +72,7 @@ class TestCasync:
     with open(self.target_fn, 'rb') as target_f:
       assert target_f.read() == self.contents
 
-    assert stats['remote'] == len(self.contents)
+    assert stats['remote'] + stats['reused'] == len(self.contents)
 
   def test_seed(self):
     target = casync.parse_caibx(self.manifest_fn)
@@ -103,7 +106,8 @@ class TestCasync:
     with open(self.target_fn, 'rb') as f:
       assert f.read() == self.contents
 
-    assert stats['target'] == len(self.contents)
+    assert stats['target'] + stats['reused'] == len(self.contents)
+    assert 'remote' not in stats
 
   def test_chunk_reuse(self):
     """Test that chunks that are reused are only downloaded once"""
@@ -133,7 +137,7 @@ class TestCasync:
     with open(self.target_lo, 'rb') as target_f:
       assert target_f.read(len(self.contents)) == self.contents
 
-    assert stats['remote'] == len(self.contents)
+    assert stats['remote'] + stats['reused'] == len(self.contents)
 
   @pytest.mark.skipif(not LOOPBACK, reason="requires loopback device")
   def test_lo_chunk_reuse(self):
@@ -151,6 +155,116 @@ class TestCasync:
     assert stats['remote'] < len(self.contents)
 
 
+class TestParallelExtract:
+  """Tests the concurrent extractor against a store written by hand, without needing the casync binary"""
+
+  @pytest.fixture(autouse=True)
+  def setup(self, tmp_path):
+    random.seed(0)
+    blobs = [random.randbytes(random.randint(1, 64 * 1024)) for _ in range(40)]
+    blobs += blobs[:10]  # reused chunks
+    random.shuffle(blobs)
+
+    self.remote_path = tmp_path / "remote"
+    self.target = []
+    offset = 0
+    for b in blobs:
+      sha = SHA512.new(b, truncate="256").digest()
+      self.target.append(casync.Chunk(sha, offset, len(b)))
+      offset += len(b)
+
+      chunk_fn = self.remote_path / sha.hex()[:4] / (sha.hex() + ".cacnk")
+      chunk_fn.parent.mkdir(parents=True, exist_ok=True)
+      chunk_fn.write_bytes(lzma.compress(b))
+
+    self.contents = b"".join(blobs)
+    self.out_fn = str(tmp_path / "out.bin")
+    self.store = casync.LocalChunkStore(str(tmp_path / "store"))
+
+  def remote_source(self):
+    return ('remote', casync.RemoteChunkReader(str(self.remote_path)), casync.build_chunk_dict(self.target))
+
+  @pytest.mark.parametrize("workers", [1, 4, 32])
+  def test_extract(self, workers):
+    progress = []
+    stats = casync.extract(self.target, [self.remote_source()], self.out_fn, progress.append, self.store, workers)
+
+    with open(self.out_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert stats['remote'] + stats['reused'] == len(self.contents)
+    assert stats['reused'] > 0
+    assert progress[-1] == len(self.contents)
+    assert len(self.store.build_chunk_dict(self.target)) == len(casync.build_chunk_dict(self.target))
+
+  def test_seed_from_store(self):
+    casync.extract(self.target, [self.remote_source()], self.out_fn, store=self.store)
+    os.unlink(self.out_fn)
+
+    sources = [('store', self.store, self.store.build_chunk_dict(self.target)), self.remote_source()]
+    stats = casync.extract(self.target, sources, self.out_fn)
+
+    with open(self.out_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert 'remote' not in stats
+
+  def test_corrupt_source(self):
+    # the seed has the right length but wrong contents, so everything should come from the remote
+    with open(self.out_fn, 'wb') as f:
+      f.write(bytes(len(self.contents)))
+
+    sources = [('seed', casync.FileChunkReader(self.out_fn), casync.build_chunk_dict(self.target)), self.remote_source()]
+    stats = casync.extract(self.target, sources, self.out_fn)
+
+    with open(self.out_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert 'seed' not in stats
+
+  def test_missing_chunk(self):
+    chunks = casync.build_chunk_dict(self.target)
+    del chunks[self.target[0].sha]
+    with pytest.raises(RuntimeError):
+      casync.extract(self.target, [('remote', casync.RemoteChunkReader(str(self.remote_path)), chunks)], self.out_fn)
+
+  def test_prune(self):
+    casync.extract(self.target, [self.remote_source()], self.out_fn, store=self.store)
+
+    self.store.max_bytes = len(self.contents) // 4
+    self.store.prune()
+    remaining = self.store.build_chunk_dict(self.target)
+    assert 0 < len(remaining) < len(casync.build_chunk_dict(self.target))
+    assert sum(c.length for c in remaining.values()) <= self.store.max_bytes
+
+  def test_store_max_bytes(self):
+    # chunks from an older target are evicted to make room, the ones of the current target are kept
+    old_chunk = random.randbytes(len(self.contents) // 8)
+    old_sha = SHA512.new(old_chunk, truncate="256").digest()
+    self.store.put(old_sha, old_chunk)
+    seed = self.target[0]
+    self.store.put(seed.sha, self.contents[seed.offset:seed.offset + seed.length])
+
+    self.store = casync.LocalChunkStore(self.store.path, len(self.contents) // 4)
+    sources = [('store', self.store, self.store.build_chunk_dict(self.target)), self.remote_source()]
+    stats = casync.extract(self.target, sources, self.out_fn, store=self.store)
+
+    with open(self.out_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert stats['store'] == seed.length
+    assert not os.path.isfile(self.store.chunk_path(old_sha))
+
+    stored = self.store.build_chunk_dict(self.target)
+    assert seed.sha in stored
+    assert 1 < len(stored) < len(casync.build_chunk_dict(self.target))
+    assert sum(c.length for c in stored.values()) <= self.store.max_bytes
+
+  def test_store_min_free_bytes(self):
+    self.store.min_free_bytes = 2 ** 62
+    casync.extract(self.target, [self.remote_source()], self.out_fn, store=self.store)
+
+    with open(self.out_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert len(self.store.build_chunk_dict(self.target)) == 0
+
+
 @pytest.mark.skip("not used yet")
 class TestCasyncDirectory:
   """Tests extracting a directory stored as a casync tar archive"""
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.tools.jotpluggler.data import msgs_to_time_series
+from openpilot.tools.lib.logreader import LogReader
+
+DEMO_SEGMENT = "a2a0ccea32023010|2023-07-27--13-01-19/0"
+
+
+def flatten(obj, prefix, out):
+  if isinstance(obj, dict):
+    for key, val in obj.items():
+      flatten(val, f"{prefix}/{key}" if prefix else key, out)
+  elif isinstance(obj, list):
+    for i, val in enumerate(obj):
+      flatten(val, f"{prefix}/{i}", out)
+  else:
+    out[prefix] = obj
+
+
+def to_dict_baseline(msgs):
+  # what extraction cost before the schema extractor, without the column bookkeeping
+  for msg in msgs:
+    sub_msg = getattr(msg, msg.which())
+    if hasattr(sub_msg, 'to_dict'):
+      flatten(sub_msg.to_dict(verbose=True), None, {})
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark jotpluggler field extraction on a recorded segment")
+  parser.add_argument("segment", nargs='?', default=DEMO_SEGMENT, help="Segment to load")
+  parser.add_argument("--runs", type=int, default=3)
+  args = parser.parse_args()
+
+  msgs = list(migrate_all(LogReader(args.segment, sort_by_time=True)))
+  print(f"{len(msgs)} messages in {args.segment}")
+
+  results = {}
+  for name, func in (("to_dict + flatten", to_dict_baseline), ("msgs_to_time_series", msgs_to_time_series)):
+    times = []
+    for _ in range(args.runs):
+      st = time.monotonic()
+      func(msgs)
+      times.append(time.monotonic() - st)
+    results[name] = min(times)
+    print(f"{name:>20}: {results[name]:.3f}s, {len(msgs) / results[name]:.0f} msgs/s")
+
+  print(f"speedup: {results['to_dict + flatten'] / results['msgs_to_time_series']:.2f}x")
@@ -2,72 +2,28 @@ import numpy as np
 import threading
 import multiprocessing
 import bisect
+import functools
+import glob
+import hashlib
+import os
+import tempfile
 from collections import defaultdict
 from tqdm import tqdm
+from cereal import CEREAL_PATH
 from openpilot.common.swaglog import cloudlog
+from openpilot.system.hardware.hw import Paths
+from openpilot.selfdrive.test.process_replay import migration
 from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.tools.lib import log_time_series
+from openpilot.tools.lib.cache import derived_cache_path
 from openpilot.tools.lib.logreader import _LogFileReader, LogReader
+from openpilot.tools.lib.log_time_series import ColumnarFile, SchemaExtractor, save_columnar
 
-
-def flatten_dict(d: dict, sep: str = "/", prefix: str | None = None) -> dict:
-  result = {}
-  stack: list[tuple] = [(d, prefix)]
-
-  while stack:
-    obj, current_prefix = stack.pop()
-
-    if isinstance(obj, dict):
-      for key, val in obj.items():
-        new_prefix = key if current_prefix is None else f"{current_prefix}{sep}{key}"
-        if isinstance(val, (dict, list)):
-          stack.append((val, new_prefix))
-        else:
-          result[new_prefix] = val
-    elif isinstance(obj, list):
-      for i, item in enumerate(obj):
-        new_prefix = f"{current_prefix}{sep}{i}"
-        if isinstance(item, (dict, list)):
-          stack.append((item, new_prefix))
-        else:
-          result[new_prefix] = item
-    else:
-      if current_prefix is not None:
-        result[current_prefix] = obj
-  return result
-
-
-def extract_field_types(schema, prefix, field_types_dict):
-  stack = [(schema, prefix)]
-
-  while stack:
-    current_schema, current_prefix = stack.pop()
-
-    for field in current_schema.fields_list:
-      field_name = field.proto.name
-      field_path = f"{current_prefix}/{field_name}"
-      field_proto = field.proto
-      field_which = field_proto.which()
-
-      field_type = field_proto.slot.type.which() if field_which == 'slot' else field_which
-      field_types_dict[field_path] = field_type
-
-      if field_which == 'slot':
-        slot_type = field_proto.slot.type
-        type_which = slot_type.which()
-
-        if type_which == 'list':
-          element_type = slot_type.list.elementType.which()
-          list_path = f"{field_path}/*"
-          field_types_dict[list_path] = element_type
-
-          if element_type == 'struct':
-            stack.append((field.schema.elementType, list_path))
-
-        elif type_which == 'struct':
-          stack.append((field.schema, field_path))
-
-      elif field_which == 'group':
-        stack.append((field.schema, field_path))
+SEGMENT_CACHE_VERSION = 1
+SPARSE_INDEX_SUFFIX = "@t_index"  # not a valid capnp field name
+META_TYPE = "_meta"
+LOD_FACTOR = 4  # samples per bucket between decimation levels
+LOD_MIN_POINTS = 1024
 
 
 def _convert_to_optimal_dtype(values_list, capnp_type):
@@ -82,16 +38,6 @@ def _convert_to_optimal_dtype(values_list, capnp_type):
   return np.array(values_list, dtype=target_dtype)
 
 
-def _match_field_type(field_path, field_types):
-  if field_path in field_types:
-    return field_types[field_path]
-
-  path_parts = field_path.split('/')
-  template_parts = [p if not p.isdigit() else '*' for p in path_parts]
-  template_path = '/'.join(template_parts)
-  return field_types.get(template_path)
-
-
 def _get_field_times_values(segment, field_name):
   if field_name not in segment:
     return None, None
@@ -109,9 +55,9 @@ def _get_field_times_values(segment, field_name):
 
 def msgs_to_time_series(msgs):
   """Extract scalar fields and return (time_series_data, start_time, end_time)."""
-  collected_data = defaultdict(lambda: {'timestamps': [], 'columns': defaultdict(list), 'sparse_fields': set()})
-  field_types = {}
-  extracted_schemas = set()
+  extractors: dict[str, SchemaExtractor] = {}
+  timestamps: dict[str, list[float]] = defaultdict(list)
+  valid: dict[str, list[bool]] = defaultdict(list)
   min_time = max_time = None
 
   for msg in msgs:
@@ -126,91 +72,211 @@ def msgs_to_time_series(msgs):
     if not hasattr(sub_msg, 'to_dict'):
       continue
 
-    if hasattr(sub_msg, 'schema') and typ not in extracted_schemas:
-      extract_field_types(sub_msg.schema, typ, field_types)
-      extracted_schemas.add(typ)
+    if typ not in extractors:
+      extractors[typ] = SchemaExtractor(sub_msg.schema)
 
     try:
-      msg_dict = sub_msg.to_dict(verbose=True)
+      extractors[typ].extract(sub_msg)
     except Exception as e:
-      cloudlog.warning(f"Failed to convert sub_msg.to_dict() for message of type: {typ}: {e}")
+      cloudlog.warning(f"Failed to extract fields for message of type: {typ}: {e}")
       continue
 
-    flat_dict = flatten_dict(msg_dict)
-    flat_dict['_valid'] = msg.valid
-    field_types[f"{typ}/_valid"] = 'bool'
-
-    type_data = collected_data[typ]
-    columns, sparse_fields = type_data['columns'], type_data['sparse_fields']
-    known_fields = set(columns.keys())
-    missing_fields = known_fields - flat_dict.keys()
-
-    for field, value in flat_dict.items():
-      if field not in known_fields and type_data['timestamps']:
-        sparse_fields.add(field)
-      columns[field].append(value)
-      if value is None:
-        sparse_fields.add(field)
-
-    for field in missing_fields:
-      columns[field].append(None)
-      sparse_fields.add(field)
-
-    type_data['timestamps'].append(timestamp)
+    timestamps[typ].append(timestamp)
+    valid[typ].append(msg.valid)
 
   final_result = {}
-  for typ, data in collected_data.items():
-    if not data['timestamps']:
+  for typ, extractor in extractors.items():
+    if not timestamps[typ]:
       continue
 
-    typ_result = {'t': np.array(data['timestamps'], dtype=np.float64)}
-    sparse_fields = data['sparse_fields']
-
-    for field_name, values in data['columns'].items():
-      if len(values) < len(data['timestamps']):
-        values = [None] * (len(data['timestamps']) - len(values)) + values
-        sparse_fields.add(field_name)
-
-      capnp_type = _match_field_type(f"{typ}/{field_name}", field_types)
-
-      if field_name in sparse_fields:  # extract non-None values and their indices
-        non_none_indices = []
-        non_none_values = []
-        for i, value in enumerate(values):
-          if value is not None:
-            non_none_indices.append(i)
-            non_none_values.append(value)
-
-        if non_none_values: # check if indices > uint16 max, currently would require a 1000+ Hz signal since indices are within segments
-          assert max(non_none_indices) <= 65535, f"Sparse field {typ}/{field_name} has timestamp indices exceeding uint16 max. Max: {max(non_none_indices)}"
+    typ_result = {'t': np.array(timestamps[typ], dtype=np.float64)}
+    for field_name, (capnp_type, values, rows) in extractor.columns().items():
+      if rows is None:  # dense representation
+        typ_result[field_name] = {'values': _convert_to_optimal_dtype(values, capnp_type), 'sparse': False}
+      else:  # sparse fields only store the values that are set and their indices
+        if rows: # check if indices > uint16 max, currently would require a 1000+ Hz signal since indices are within segments
+          assert rows[-1] <= 65535, f"Sparse field {typ}/{field_name} has timestamp indices exceeding uint16 max. Max: {rows[-1]}"
 
         typ_result[field_name] = {
-          'values': _convert_to_optimal_dtype(non_none_values, capnp_type),
+          'values': _convert_to_optimal_dtype(values, capnp_type),
           'sparse': True,
-          't_index': np.array(non_none_indices, dtype=np.uint16),
+          't_index': np.array(rows, dtype=np.uint16),
         }
-      else:  # dense representation
-        typ_result[field_name] = {'values': _convert_to_optimal_dtype(values, capnp_type), 'sparse': False}
 
+    typ_result['_valid'] = {'values': np.array(valid[typ], dtype=np.bool_), 'sparse': False}
     final_result[typ] = typ_result
 
   return final_result, min_time or 0.0, max_time or 0.0
 
 
-def _process_segment(segment_identifier: str):
+@functools.cache
+def segment_cache_version() -> str:
+  """Hash of the migrations, log schema and extraction code, so a cached segment is never read after any of them change"""
+  h = hashlib.md5(str(SEGMENT_CACHE_VERSION).encode())
+  for fn in (migration.__file__, log_time_series.__file__, __file__, *sorted(glob.glob(os.path.join(CEREAL_PATH, "*.capnp")))):
+    with open(fn, "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()[:16]
+
+
+def segment_cache_path(segment_identifier: str) -> str:
+  return derived_cache_path(segment_identifier, f"jotpluggler_{segment_cache_version()}.cols")
+
+
+def save_segment_cache(path: str, segment_data: dict, start_time: float, end_time: float) -> None:
+  columns: dict = {META_TYPE: {'time_range': np.array([start_time, end_time], dtype=np.float64)}}
+  for typ, data in segment_data.items():
+    columns[typ] = {'t': data['t']}
+    for field_name, field_data in data.items():
+      if field_name == 't':
+        continue
+      columns[typ][field_name] = field_data['values']
+      if field_data['sparse']:
+        columns[typ][field_name + SPARSE_INDEX_SUFFIX] = field_data['t_index']
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  save_columnar(path, columns)
+
+
+def load_segment_cache(path: str):
+  """Opens a segment written by save_segment_cache, fields are only loaded once they're requested"""
+  cache_file = ColumnarFile(path)
+  start_time, end_time = cache_file.load(f"{META_TYPE}/time_range").tolist()
+  return SegmentData(cache_file=cache_file), start_time, end_time
+
+
+class SegmentData:
+  """The time series of one segment, either held in memory or loaded field by field from its memory-mapped cache file"""
+  def __init__(self, data: dict | None = None, cache_file: ColumnarFile | None = None):
+    self._data: dict = data if data is not None else {}
+    self._file = cache_file
+    self.fields: dict[str, list[str]] = defaultdict(list)
+    if cache_file is not None:
+      for name in cache_file.columns:
+        typ, field_name = name.split('/', 1)
+        if typ != META_TYPE and field_name != 't' and not field_name.endswith(SPARSE_INDEX_SUFFIX):
+          self.fields[typ].append(field_name)
+    else:
+      for typ, typ_data in self._data.items():
+        self.fields[typ] = [field_name for field_name in typ_data if field_name != 't']
+
+  def __contains__(self, msg_type: str) -> bool:
+    return msg_type in self.fields
+
+  def dtype(self, msg_type: str, field_name: str) -> np.dtype | None:
+    if self._file is None:
+      field_data = self._data.get(msg_type, {}).get(field_name)
+      return None if field_data is None else field_data['values'].dtype
+    col = self._file.columns.get(f"{msg_type}/{field_name}")
+    return None if col is None else np.dtype(object if col['dtype'] == 'object' else col['dtype'])
+
+  def get(self, msg_type: str, field_name: str):
+    """Returns (times, values) of a field, or (None, None) if it's never set in this segment"""
+    if msg_type not in self.fields:
+      return None, None
+    if self._file is not None and field_name not in self._data.get(msg_type, {}) and field_name in self.fields[msg_type]:
+      typ_data = self._data.setdefault(msg_type, {'t': self._file.load(f"{msg_type}/t")})
+      field_data = {'values': self._file.load(f"{msg_type}/{field_name}"), 'sparse': False}
+      if f"{msg_type}/{field_name}{SPARSE_INDEX_SUFFIX}" in self._file.columns:
+        field_data['sparse'] = True
+        field_data['t_index'] = self._file.load(f"{msg_type}/{field_name}{SPARSE_INDEX_SUFFIX}")
+      typ_data[field_name] = field_data
+    return _get_field_times_values(self._data.get(msg_type, {}), field_name)
+
+
+class MinMaxPyramid:
+  """
+    Min/max decimation levels of a numeric series. Each level keeps the lowest and highest sample of every
+    LOD_FACTOR buckets of the level below, so any time range can be drawn from a bounded number of points
+    without losing spikes.
+  """
+  def __init__(self, times: np.ndarray, values: np.ndarray):
+    values = values.astype(np.float64)
+    # per bucket: time and value of its minimum, time and value of its maximum
+    self.levels = [(times, values, times, values)]
+    while len(self.levels[-1][0]) > LOD_MIN_POINTS:
+      self.levels.append(self._reduce(*self.levels[-1]))
+    # first and last sample time of every bucket, to find the buckets in a time range
+    self.bounds = [(times, times)]
+    for level in range(1, len(self.levels)):
+      starts = np.arange(0, len(times), LOD_FACTOR ** level)
+      self.bounds.append((times[starts], times[np.minimum(starts + LOD_FACTOR ** level, len(times)) - 1]))
+
+  @staticmethod
+  def _reduce(t_lo, v_lo, t_hi, v_hi):
+    pad = -len(t_lo) % LOD_FACTOR
+    t_lo, v_lo, t_hi, v_hi = (np.pad(a, (0, pad), mode='edge').reshape(-1, LOD_FACTOR) for a in (t_lo, v_lo, t_hi, v_hi))
+    lo = np.argmin(np.where(np.isnan(v_lo), np.inf, v_lo), axis=1)[:, None]
+    hi = np.argmax(np.where(np.isnan(v_hi), -np.inf, v_hi), axis=1)[:, None]
+    return tuple(np.take_along_axis(a, idx, axis=1)[:, 0] for a, idx in ((t_lo, lo), (v_lo, lo), (t_hi, hi), (v_hi, hi)))
+
+  def query(self, t_min: float, t_max: float, max_points: int):
+    """
+      Returns the finest level with at most max_points points between t_min and t_max, or the coarsest one.
+      Decimated levels return every bucket with samples in the range, so their min or max can lie outside of it.
+    """
+    for level, (first, last) in enumerate(self.bounds):
+      start = np.searchsorted(last, t_min, 'left')
+      end = np.searchsorted(first, t_max, 'right')
+      num_points = (end - start) * (1 if level == 0 else 2)
+      if num_points <= max_points or level == len(self.levels) - 1:
+        break
+
+    t_lo, v_lo, t_hi, v_hi = (a[start:end] for a in self.levels[level])
+    if level == 0:
+      return t_lo, v_lo
+    lo_first = t_lo <= t_hi
+    times = np.column_stack([np.where(lo_first, t_lo, t_hi), np.where(lo_first, t_hi, t_lo)]).ravel()
+    values = np.column_stack([np.where(lo_first, v_lo, v_hi), np.where(lo_first, v_hi, v_lo)]).ravel()
+    return times, values
+
+
+def _process_segment(segment_identifier: str, cache_path: str | None = None):
+  """
+    Returns (time series, start, end). Every field is extracted here, since the log has to be read in full anyway.
+    With a cache_path, the time series is written there and only the path is returned, so fields are loaded once requested.
+  """
   try:
     lr = _LogFileReader(segment_identifier, sort_by_time=True)
     migrated_msgs = migrate_all(lr)
-    return msgs_to_time_series(migrated_msgs)
+    result = msgs_to_time_series(migrated_msgs)
   except Exception as e:
     cloudlog.warning(f"Warning: Failed to process segment {segment_identifier}: {e}")
     return {}, 0.0, 0.0
 
+  if cache_path is not None and result[0]:
+    try:
+      save_segment_cache(cache_path, *result)
+      return cache_path, result[1], result[2]
+    except Exception as e:
+      cloudlog.warning(f"Warning: Failed to cache segment {segment_identifier}: {e}")
+  return result
+
+
+def _process_segment_args(args: tuple[str, str | None]):
+  return _process_segment(*args)
+
+
+def _open_segment(segment_identifier: str, result) -> tuple[SegmentData | None, float, float]:
+  segment_result, start_time, end_time = result
+  if isinstance(segment_result, str):
+    try:
+      return load_segment_cache(segment_result)
+    except Exception as e:
+      cloudlog.warning(f"Warning: Failed to load cached segment {segment_identifier}, reprocessing: {e}")
+      segment_result, start_time, end_time = _process_segment(segment_identifier)
+  return (SegmentData(segment_result) if segment_result else None), start_time, end_time
+
 
 class DataManager:
-  def __init__(self):
-    self._segments = []
+  def __init__(self, use_cache: bool = True):
+    self._use_cache = use_cache
+    self._segments: list[SegmentData] = []
     self._segment_starts = []
+    # concatenated series and their decimation levels, only built for fields that are requested
+    self._series_cache: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+    self._pyramids: dict[str, MinMaxPyramid] = {}
+    # without use_cache, segments are still written to disk so only requested fields are loaded, just not kept after the route
+    self._tmp_dir: tempfile.TemporaryDirectory | None = None
     self._start_time = 0.0
     self._duration = 0.0
     self._paths = set()
@@ -226,15 +292,17 @@ class DataManager:
 
   def get_timeseries(self, path: str):
     with self._lock:
+      if path in self._series_cache:
+        return self._series_cache[path]
+
       msg_type, field = path.split('/', 1)
       times, values = [], []
 
       for segment in self._segments:
-        if msg_type in segment:
-          field_times, field_values = _get_field_times_values(segment[msg_type], field)
-          if field_times is not None:
-            times.append(field_times)
-            values.append(field_values)
+        field_times, field_values = segment.get(msg_type, field)
+        if field_times is not None:
+          times.append(field_times)
+          values.append(field_values)
 
       if not times:
         return np.array([]), np.array([])
@@ -250,8 +318,18 @@ class DataManager:
       else:
         combined_values = values[0] if values else np.array([])
 
+      self._series_cache[path] = (combined_times, combined_values)
       return combined_times, combined_values
 
+  def get_timeseries_lod(self, path: str, t_min: float, t_max: float, max_points: int):
+    """Returns at most about max_points points of a numeric series between t_min and t_max, keeping the min and max of decimated spans"""
+    with self._lock:
+      pyramid = self._pyramids.get(path)
+      if pyramid is None:
+        times, values = self.get_timeseries(path)
+        pyramid = self._pyramids[path] = MinMaxPyramid(times, values)
+      return pyramid.query(t_min, t_max, max_points)
+
   def get_value_at(self, path: str, time: float):
     with self._lock:
       MAX_LOOKBACK = 5.0  # seconds
@@ -261,10 +339,7 @@ class DataManager:
       for index in (current_index, current_index - 1):
         if not 0 <= index < len(self._segments):
           continue
-        segment = self._segments[index].get(message_type)
-        if not segment:
-          continue
-        times, values = _get_field_times_values(segment, field)
+        times, values = self._segments[index].get(message_type, field)
         if times is None or len(times) == 0 or (index != current_index and absolute_time - times[-1] > MAX_LOOKBACK):
           continue
         position = np.searchsorted(times, absolute_time, 'right') - 1
@@ -281,10 +356,13 @@ class DataManager:
       return self._duration
 
   def is_plottable(self, path: str):
-    _, values = self.get_timeseries(path)
-    if len(values) == 0:
+    # decided from the stored dtypes, so browsing fields doesn't load them
+    with self._lock:
+      msg_type, field = path.split('/', 1)
+      dtypes = [dtype for segment in self._segments if (dtype := segment.dtype(msg_type, field)) is not None]
+    if not dtypes or any(dtype != dtypes[0] for dtype in dtypes):
       return False
-    return np.issubdtype(values.dtype, np.number) or np.issubdtype(values.dtype, np.bool_)
+    return np.issubdtype(dtypes[0], np.number) or np.issubdtype(dtypes[0], np.bool_)
 
   def add_observer(self, callback):
     with self._lock:
@@ -300,8 +378,16 @@ class DataManager:
       self._loading = True
       self._segments.clear()
       self._segment_starts.clear()
+      self._series_cache.clear()
+      self._pyramids.clear()
       self._paths.clear()
       self._start_time = self._duration = 0.0
+      if self._tmp_dir is not None:
+        self._tmp_dir.cleanup()
+        self._tmp_dir = None
+      if not self._use_cache:
+        os.makedirs(Paths.download_cache_root(), exist_ok=True)
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="jotpluggler_", dir=Paths.download_cache_root())
       observers = self._observers.copy()
 
     for callback in observers:
@@ -320,30 +406,46 @@ class DataManager:
       for callback in observers:
         callback({'metadata_loaded': True, 'total_segments': total_segments})
 
-      num_processes = max(1, multiprocessing.cpu_count() // 2)
-      with multiprocessing.Pool(processes=num_processes) as pool, tqdm(total=len(lr.logreader_identifiers), desc="Processing Segments") as pbar:
-        for segment_result, start_time, end_time in pool.imap(_process_segment, lr.logreader_identifiers):
-          pbar.update(1)
-          if segment_result:
-            self._add_segment(segment_result, start_time, end_time)
+      identifiers = lr.logreader_identifiers
+      with self._lock:
+        tmp_dir = self._tmp_dir.name if self._tmp_dir is not None else None
+      cache_paths = [segment_cache_path(i) if tmp_dir is None else os.path.join(tmp_dir, f"{n}.cols") for n, i in enumerate(identifiers)]
+      cached = [tmp_dir is None and os.path.exists(p) for p in cache_paths]
+      # only uncached segments go to the pool, cached ones are mapped in as their turn comes so segments stay in order
+      misses = [(i, p) for i, p, hit in zip(identifiers, cache_paths, cached, strict=True) if not hit]
+      num_processes = min(max(1, multiprocessing.cpu_count() // 2), len(misses))
+      pool = multiprocessing.Pool(processes=num_processes) if misses else None
+      try:
+        processed = pool.imap(_process_segment_args, misses) if pool is not None else iter(())
+        with tqdm(total=len(identifiers), desc="Processing Segments") as pbar:
+          for identifier, path, hit in zip(identifiers, cache_paths, cached, strict=True):
+            segment, start_time, end_time = _open_segment(identifier, (path, 0.0, 0.0) if hit else next(processed))
+            pbar.update(1)
+            if segment is not None:
+              self._add_segment(segment, start_time, end_time)
+      finally:
+        if pool is not None:
+          pool.terminate()
+          pool.join()
     except Exception:
       cloudlog.exception(f"Error loading route {route}:")
     finally:
       self._finalize_loading()
 
-  def _add_segment(self, segment_data: dict, start_time: float, end_time: float):
+  def _add_segment(self, segment: SegmentData, start_time: float, end_time: float):
     with self._lock:
-      self._segments.append(segment_data)
+      self._segments.append(segment)
       self._segment_starts.append(start_time)
+      self._series_cache.clear()
+      self._pyramids.clear()
 
       if len(self._segments) == 1:
         self._start_time = start_time
       self._duration = end_time - self._start_time
 
-      for msg_type, data in segment_data.items():
-        for field_name in data.keys():
-          if field_name != 't':
-            self._paths.add(f"{msg_type}/{field_name}")
+      for msg_type, fields in segment.fields.items():
+        for field_name in fields:
+          self._paths.add(f"{msg_type}/{field_name}")
 
       observers = self._observers.copy()
 
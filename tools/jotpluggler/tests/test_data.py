@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from openpilot.tools.jotpluggler.data import LOD_FACTOR, LOD_MIN_POINTS, MinMaxPyramid
+
+
+def make_series(n, seed=0):
+  rng = np.random.default_rng(seed)
+  times = np.cumsum(rng.uniform(0.005, 0.015, n))
+  values = rng.normal(0., 1., n)
+  values[50::101] *= 100.  # spikes
+  values[3::97] = np.nan
+  return times, values
+
+
+class TestMinMaxPyramid:
+  @pytest.mark.parametrize("n", [1, LOD_MIN_POINTS, LOD_MIN_POINTS + 1, 50_000])
+  def test_levels(self, n):
+    times, values = make_series(n)
+    pyramid = MinMaxPyramid(times, values)
+    assert len(pyramid.levels[-1][0]) <= LOD_MIN_POINTS
+    assert len(pyramid.levels) == 1 or len(pyramid.levels[-2][0]) > LOD_MIN_POINTS
+
+    for a, b in zip(pyramid.levels[0], (times, values, times, values), strict=True):
+      np.testing.assert_array_equal(a, b)
+
+    # each bucket of a level holds the min and max of the raw samples it spans, skipping NaNs
+    for level, (t_lo, v_lo, t_hi, v_hi) in enumerate(pyramid.levels[1:], start=1):
+      span = LOD_FACTOR ** level
+      assert len(t_lo) == -(-n // span)
+      for i in range(len(t_lo)):
+        bucket_t, bucket_v = times[i * span:(i + 1) * span], values[i * span:(i + 1) * span]
+        finite = ~np.isnan(bucket_v)
+        assert v_lo[i] == bucket_v[finite].min() and v_hi[i] == bucket_v[finite].max()
+        assert t_lo[i] == bucket_t[finite][np.argmin(bucket_v[finite])]
+        assert t_hi[i] == bucket_t[finite][np.argmax(bucket_v[finite])]
+
+  @pytest.mark.parametrize("max_points", [10**6, 2000, 100])
+  def test_query(self, max_points):
+    times, values = make_series(50_000)
+    pyramid = MinMaxPyramid(times, values)
+    samples = dict(zip(times.tolist(), values.tolist(), strict=True))
+    coarsest = 2 * len(pyramid.levels[-1][0])
+
+    windows = [(times[0], times[-1]), (100., 300.), (times[1000], times[1000]), (times[-1] + 1., times[-1] + 2.), (-2., -1.)]
+    for t_min, t_max in windows:
+      t, v = pyramid.query(t_min, t_max, max_points)
+      in_window = (times >= t_min) & (times <= t_max)
+      if not in_window.any():
+        assert len(t) == 0
+        continue
+
+      assert len(t) <= max(max_points, coarsest)
+      assert np.all(np.diff(t) >= 0)
+      # only real samples, and no spike in the window is lost
+      assert all(samples[ti] == vi or (np.isnan(vi) and np.isnan(samples[ti])) for ti, vi in zip(t, v, strict=True))
+      assert np.nanmax(v) >= np.nanmax(values[in_window])
+      assert np.nanmin(v) <= np.nanmin(values[in_window])
+
+      if max_points >= len(times):
+        # the full resolution level is cut exactly at the window edges
+        np.testing.assert_array_equal(t, times[in_window])
+        np.testing.assert_array_equal(v, values[in_window])
+
+  @pytest.mark.parametrize("max_points", [20_000, 5000, 1100])
+  def test_query_edges(self, max_points):
+    # spikes at the first and last sample of a window that cuts through buckets of every level
+    times, values = make_series(50_000)
+    first, last = 1234 * LOD_FACTOR + 1, 2345 * LOD_FACTOR ** 2 - 1
+    values[first], values[last] = 1000., -1000.
+    pyramid = MinMaxPyramid(times, values)
+
+    t, v = pyramid.query(times[first], times[last], max_points)
+    assert len(t) <= max_points
+    assert times[first] in t and times[last] in t
+    assert np.nanmax(v) == 1000. and np.nanmin(v) == -1000.
+
+  def test_query_buckets(self):
+    # every bucket with samples in the window is returned, even when its min and max lie outside of it
+    times, values = make_series(50_000)
+    pyramid = MinMaxPyramid(times, values)
+    t_lo, _, t_hi, _ = pyramid.levels[-1]
+    span = LOD_FACTOR ** (len(pyramid.levels) - 1)
+    rng = np.random.default_rng(1)
+    for first in rng.integers(0, len(times) - 5000, 100):
+      last = first + rng.integers(0, 5000)
+      t, _ = pyramid.query(times[first], times[last], 1)
+      buckets = np.arange(first // span, last // span + 1)
+      assert set(t.tolist()) == set(t_lo[buckets].tolist()) | set(t_hi[buckets].tolist())
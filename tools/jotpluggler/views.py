@@ -1,7 +1,6 @@
 import uuid
 import threading
 import numpy as np
-from collections import deque
 import dearpygui.dearpygui as dpg
 from abc import ABC, abstractmethod
 
@@ -57,8 +56,8 @@ class TimeSeriesPanel(ViewPanel):
     self._ui_created = False
     self._series_data: dict[str, tuple[np.ndarray, np.ndarray]] = {}
     self._last_plot_duration = 0
+    self._lod_window = (0.0, 0.0)
     self._update_lock = threading.RLock()
-    self._results_deque: deque[tuple[str, list, list]] = deque()
     self._new_data = False
     self._last_x_limits = (0.0, 0.0)
     self._queued_x_sync: tuple | None = None
@@ -124,23 +123,17 @@ class TimeSeriesPanel(ViewPanel):
           self.add_series(series_path, update=True)
 
       current_limits = dpg.get_axis_limits(self.x_axis_tag)
-      # downsample if plot zoom changed significantly
+      # downsample if plot zoom changed significantly, or the view was panned out of the drawn range
       plot_duration = current_limits[1] - current_limits[0]
-      if plot_duration > self._last_plot_duration * 2 or plot_duration < self._last_plot_duration * 0.5:
-        self._downsample_all_series(plot_duration)
+      if plot_duration > self._last_plot_duration * 2 or plot_duration < self._last_plot_duration * 0.5 or \
+         current_limits[0] < self._lod_window[0] or current_limits[1] > self._lod_window[1]:
+        self._downsample_all_series(*current_limits)
       # sync x-axis if changed by user
       if self._last_x_limits != current_limits:
         self.playback_manager.set_x_axis_bounds(current_limits[0], current_limits[1], source_panel=self)
         self._last_x_limits = current_limits
         self._fit_y_axis(current_limits[0], current_limits[1])
 
-      while self._results_deque:  # handle downsampled results in main thread
-        results = self._results_deque.popleft()
-        for series_path, downsampled_time, downsampled_values in results:
-          series_tag = f"series_{self.panel_id}_{series_path}"
-          if dpg.does_item_exist(series_tag):
-            dpg.set_value(series_tag, (downsampled_time, downsampled_values.astype(float)))
-
       # update timeline
       current_time_s = self.playback_manager.current_time_s
       dpg.set_value(self.timeline_indicator_tag, [[current_time_s], [0]])
@@ -195,45 +188,34 @@ class TimeSeriesPanel(ViewPanel):
 
     dpg.set_axis_limits(self.y_axis_tag, y_min, y_max)
 
-  def _downsample_all_series(self, plot_duration):
+  def _downsample_all_series(self, x_min: float, x_max: float):
     plot_width = dpg.get_item_rect_size(self.plot_tag)[0]
+    plot_duration = x_max - x_min
     if plot_width <= 0 or plot_duration <= 0:
       return
 
     self._last_plot_duration = plot_duration
-    target_points_per_second = plot_width / plot_duration
-    work_items = []
-    for series_path, (time_array, value_array) in self._series_data.items():
-      if len(time_array) == 0:
-        continue
-      series_duration = time_array[-1] - time_array[0] if len(time_array) > 1 else 1
-      points_per_second = len(time_array) / series_duration
-      if points_per_second > target_points_per_second * 2:
-        target_points = max(int(target_points_per_second * series_duration), plot_width)
-        work_items.append((series_path, time_array, value_array, target_points))
-      elif dpg.does_item_exist(f"series_{self.panel_id}_{series_path}"):
-        dpg.set_value(f"series_{self.panel_id}_{series_path}", (time_array, value_array.astype(float)))
-
-    if work_items:
-      self.worker_manager.submit_task(
-        TimeSeriesPanel._downsample_worker, work_items, callback=lambda results: self._results_deque.append(results), task_id=f"downsample_{self.panel_id}"
-      )
+    # draw a screen to either side of the view, so panning doesn't immediately need new points
+    self._lod_window = (x_min - plot_duration, x_max + plot_duration)
+    for series_path in self._series_data:
+      series_tag = f"series_{self.panel_id}_{series_path}"
+      if dpg.does_item_exist(series_tag):
+        time_array, value_array = self.data_manager.get_timeseries_lod(series_path, *self._lod_window, 3 * 2 * plot_width)
+        dpg.set_value(series_tag, (time_array, value_array))
 
   def add_series(self, series_path: str, update: bool = False):
     with self._update_lock:
       if update or series_path not in self._series_data:
         self._series_data[series_path] = self.data_manager.get_timeseries(series_path)
 
-      time_array, value_array = self._series_data[series_path]
+      # points are filled in by _downsample_all_series, at the resolution of the current view
       series_tag = f"series_{self.panel_id}_{series_path}"
-      if dpg.does_item_exist(series_tag):
-        dpg.set_value(series_tag, (time_array, value_array.astype(float)))
-      else:
-        line_series_tag = dpg.add_line_series(x=time_array, y=value_array.astype(float), label=series_path, parent=self.y_axis_tag, tag=series_tag)
+      if not dpg.does_item_exist(series_tag):
+        line_series_tag = dpg.add_line_series(x=[], y=[], label=series_path, parent=self.y_axis_tag, tag=series_tag)
         dpg.bind_item_theme(line_series_tag, "line_theme")
+      self._last_plot_duration = 0  # force a redraw, also when the view didn't change
       self._fit_y_axis(*dpg.get_axis_limits(self.x_axis_tag))
-      plot_duration = dpg.get_axis_limits(self.x_axis_tag)[1] - dpg.get_axis_limits(self.x_axis_tag)[0]
-      self._downsample_all_series(plot_duration)
+      self._downsample_all_series(*dpg.get_axis_limits(self.x_axis_tag))
 
   def destroy_ui(self):
     with self._update_lock:
@@ -268,27 +250,3 @@ class TimeSeriesPanel(ViewPanel):
 
   def _on_series_drop(self, sender, app_data, user_data):
     self.add_series(app_data)
-
-  @staticmethod
-  def _downsample_worker(series_path, time_array, value_array, target_points):
-    if len(time_array) <= target_points:
-      return series_path, time_array, value_array
-
-    step = len(time_array) / target_points
-    indices = []
-
-    for i in range(target_points):
-      start_idx = int(i * step)
-      end_idx = int((i + 1) * step)
-      if start_idx == end_idx:
-        indices.append(start_idx)
-      else:
-        bucket_values = value_array[start_idx:end_idx]
-        min_idx = start_idx + np.argmin(bucket_values)
-        max_idx = start_idx + np.argmax(bucket_values)
-        if min_idx != max_idx:
-          indices.extend([min(min_idx, max_idx), max(min_idx, max_idx)])
-        else:
-          indices.append(min_idx)
-    indices = sorted(set(indices))
-    return series_path, time_array[indices], value_array[indices]
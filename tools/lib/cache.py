@@ -1,6 +1,9 @@
+import hashlib
 import os
 import urllib.parse
 
+from openpilot.system.hardware.hw import Paths
+
 DEFAULT_CACHE_DIR = os.getenv("CACHE_ROOT", os.path.expanduser("~/.commacache"))
 
 def cache_path_for_file_path(fn, cache_dir=DEFAULT_CACHE_DIR):
@@ -12,3 +15,11 @@ def cache_path_for_file_path(fn, cache_dir=DEFAULT_CACHE_DIR):
   else:
     cache_fn = f'{fn_parsed.hostname}_{fn_parsed.path.replace("/", "_")}'
   return os.path.join(dir_, cache_fn)
+
+def derived_cache_path(fn: str, suffix: str) -> str:
+  """Cache location for data derived from fn. Local files are keyed by size and mtime so it's rebuilt if they change"""
+  key = fn.split("?")[0]
+  if os.path.isfile(fn):
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return os.path.join(Paths.download_cache_root(), f"{hashlib.md5(key.encode()).hexdigest()}_{suffix}")
@@ -43,6 +43,9 @@ def file_exists(fn):
   return os.path.exists(fn)
 
 class DiskFile(io.BufferedReader):
+  def get_length(self) -> int:
+    return os.fstat(self.fileno()).st_size
+
   def get_multi_range(self, ranges: list[tuple[int, int]]) -> list[bytes]:
     parts = []
     for r in ranges:
@@ -1,11 +1,16 @@
 import os
+import queue
 import subprocess
 import json
 import logging
-from collections.abc import Iterator
+import threading
+from collections.abc import Callable, Iterator
 from collections import OrderedDict
+from operator import attrgetter
 
 import numpy as np
+from openpilot.common.utils import atomic_write
+from openpilot.tools.lib.cache import derived_cache_path
 from openpilot.tools.lib.filereader import FileReader, resolve_name
 from openpilot.tools.lib.exceptions import DataUnreadableError
 from openpilot.tools.lib.vidindex import hevc_index
@@ -16,19 +21,34 @@ HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+VIDEO_INDEX_VERSION = 1
+
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+DECODER_READ_SIZE = 1024 * 1024
+
 class LRUCache:
-  def __init__(self, capacity: int):
+  def __init__(self, capacity: int, sizeof: Callable | None = None):
+    """capacity is in entries, or in the units returned by sizeof when given"""
     self._cache: OrderedDict = OrderedDict()
     self.capacity = capacity
+    self.sizeof = sizeof
+    self.size = 0
+
+  def _sizeof(self, value) -> int:
+    return self.sizeof(value) if self.sizeof is not None else 1
 
   def __getitem__(self, key):
     self._cache.move_to_end(key)
     return self._cache[key]
 
   def __setitem__(self, key, value):
+    if key in self._cache:
+      self.size -= self._sizeof(self._cache.pop(key))
     self._cache[key] = value
-    if len(self._cache) > self.capacity:
-        self._cache.popitem(last=False)
+    self.size += self._sizeof(value)
+    while self.size > self.capacity and len(self._cache):
+      _, evicted = self._cache.popitem(last=False)
+      self.size -= self._sizeof(evicted)
 
   def __contains__(self, key):
     return key in self._cache
@@ -42,9 +62,9 @@ def assert_hvec(fn: str) -> None:
     if 'hevc' not in fn:
       raise NotImplementedError(fn)
 
-def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', hwaccel="auto", loglevel="info") -> np.ndarray:
+def ffmpeg_decode_args(pix_fmt="rgb24", vid_fmt='hevc', hwaccel="auto", loglevel="info") -> list[str]:
   threads = os.getenv("FFMPEG_THREADS", "0")
-  args = ["ffmpeg", "-v", loglevel,
+  return ["ffmpeg", "-v", loglevel,
           "-threads", threads,
           "-hwaccel", hwaccel,
           "-c:v", "hevc",
@@ -55,16 +75,18 @@ def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', hwaccel
           "-f", "rawvideo",
           "-pix_fmt", pix_fmt,
           "-"]
-  dat = subprocess.check_output(args, input=rawdat)
 
-  ret: np.ndarray
+def frame_shape(w: int, h: int, pix_fmt: str) -> tuple[int, ...]:
   if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
+    return (h, w, 3)
   elif pix_fmt in ["nv12", "yuv420p"]:
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  else:
-    raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
-  return ret
+    return (h*w*3//2,)
+  raise NotImplementedError(f"Unsupported pixel format: {pix_fmt}")
+
+def decompress_video_data(rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc', hwaccel="auto", loglevel="info") -> np.ndarray:
+  shape = frame_shape(w, h, pix_fmt)
+  dat = subprocess.check_output(ffmpeg_decode_args(pix_fmt, vid_fmt, hwaccel, loglevel), input=rawdat)
+  return np.frombuffer(dat, dtype=np.uint8).reshape(-1, *shape)
 
 def ffprobe(fn, fmt=None):
   fn = resolve_name(fn)
@@ -88,16 +110,132 @@ def get_index_data(fn: str, index_data: dict|None = None):
   stream = index_data["probe"]["streams"][0]
   return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
 
-def get_video_index(fn):
+def video_index_path(fn: str) -> str:
+  return derived_cache_path(fn, f"video_index_v{VIDEO_INDEX_VERSION}.npz")
+
+def load_video_index(path: str) -> dict:
+  with np.load(path) as dat:
+    assert int(dat['version']) == VIDEO_INDEX_VERSION, f"unsupported video index version in {path}"
+    return {
+      'index': dat['index'],
+      'global_prefix': dat['global_prefix'].tobytes(),
+      'probe': json.loads(str(dat['probe'])),
+    }
+
+def save_video_index(path: str, index_data: dict) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write(path, mode="wb", overwrite=True) as f:
+    np.savez(f, version=VIDEO_INDEX_VERSION, index=index_data['index'],
+             global_prefix=np.frombuffer(index_data['global_prefix'], dtype=np.uint8),
+             probe=np.array(json.dumps(index_data['probe'])))
+
+def get_video_index(fn, use_cache: bool = True):
+  # indexing scans the whole file and runs ffprobe, so the result is kept alongside the download cache
+  path = video_index_path(fn) if use_cache else None
+  if path is not None and os.path.exists(path):
+    try:
+      return load_video_index(path)
+    except Exception:
+      logger.exception(f"failed to load video index {path}, rebuilding")
+
   assert_hvec(fn)
   frame_types, dat_len, prefix = hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
   probe = ffprobe(fn, "hevc")
-  return {
+  index_data = {
     'index': index,
     'global_prefix': prefix,
     'probe': probe
   }
+  if path is not None:
+    save_video_index(path, index_data)
+  return index_data
+
+class DecoderProcess:
+  """
+    A long-lived ffmpeg process decoding a run of GOPs. The file is fed to ffmpeg from a writer thread,
+    and a reader thread decodes ahead of the consumer into a bounded queue.
+  """
+  def __init__(self, fn: str, prefix: bytes, off_b: int, off_e: int, start_fidx: int, frame_count: int,
+               shape: tuple[int, ...], args: list[str], prefetch: int):
+    self.fidx = start_fidx  # next frame returned by next()
+    self.shape = shape
+    self.frame_size = int(np.prod(shape))
+    self._error: Exception | None = None
+    self._stop = threading.Event()
+    self._frames: queue.Queue = queue.Queue(maxsize=max(prefetch, 1))
+
+    self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    self._writer = threading.Thread(target=self._write, args=(fn, prefix, off_b, off_e), daemon=True)
+    self._reader = threading.Thread(target=self._read, args=(frame_count,), daemon=True)
+    self._writer.start()
+    self._reader.start()
+
+  def _write(self, fn: str, prefix: bytes, off_b: int, off_e: int) -> None:
+    assert self.proc.stdin is not None
+    try:
+      self.proc.stdin.write(prefix)
+      with FileReader(fn) as f:
+        f.seek(off_b)
+        remaining = off_e - off_b
+        while remaining > 0 and not self._stop.is_set():
+          dat = f.read(min(DECODER_READ_SIZE, remaining))
+          if not dat:
+            break
+          self.proc.stdin.write(dat)
+          remaining -= len(dat)
+    except (BrokenPipeError, ValueError):
+      pass  # decoder was closed
+    except Exception as e:
+      self._error = e
+    finally:
+      try:
+        self.proc.stdin.close()
+      except OSError:
+        pass
+
+  def _put(self, item) -> bool:
+    while not self._stop.is_set():
+      try:
+        self._frames.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def _read(self, frame_count: int) -> None:
+    assert self.proc.stdout is not None
+    try:
+      for _ in range(frame_count):
+        dat = self.proc.stdout.read(self.frame_size)
+        if len(dat) < self.frame_size or not self._put(np.frombuffer(dat, dtype=np.uint8).reshape(self.shape)):
+          break
+    except (OSError, ValueError):
+      pass
+    finally:
+      self._put(None)
+
+  def next(self) -> np.ndarray | None:
+    """Returns the frame at self.fidx and advances, or None once the run is exhausted"""
+    frame = self._frames.get()
+    if frame is None:
+      self._frames.put(None)
+      if self._error is not None:
+        raise DataUnreadableError(f"failed to read video data: {self._error}") from self._error
+      return None
+    self.fidx += 1
+    return frame
+
+  def close(self) -> None:
+    self._stop.set()
+    if self.proc.poll() is None:
+      self.proc.kill()
+    self.proc.wait()
+    for t in (self._writer, self._reader):
+      t.join()
+    for pipe in (self.proc.stdin, self.proc.stdout):
+      if pipe is not None:
+        pipe.close()
 
 class FfmpegDecoder:
   def __init__(self, fn: str, index_data: dict|None = None,
@@ -108,39 +246,38 @@ class FfmpegDecoder:
     self.iframes = np.where(self.index[:, 0] == HEVC_SLICE_I)[0]
     self.pix_fmt = pix_fmt
     self.loglevel, self.hwaccel = loglevel, hwaccel
-
-  def _gop_bounds(self, frame_idx: int):
-    f_b = frame_idx
-    while f_b > 0 and self.index[f_b, 0] != HEVC_SLICE_I:
-      f_b -= 1
-    f_e = frame_idx + 1
-    while f_e < self.frame_count and self.index[f_e, 0] != HEVC_SLICE_I:
-      f_e += 1
-    return f_b, f_e, self.index[f_b, 1], self.index[f_e, 1]
-
-  def _decode_gop(self, raw: bytes) -> Iterator[np.ndarray]:
-    yield from decompress_video_data(raw, self.w, self.h, pix_fmt=self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel)
+    # read ahead up to a full GOP, so the next one decodes while the current one is consumed
+    self.gop_size = int(np.diff(np.append(self.iframes, self.frame_count)).max()) if len(self.iframes) else self.frame_count
 
   def get_gop_start(self, frame_idx: int):
     return self.iframes[np.searchsorted(self.iframes, frame_idx, side="right") - 1]
 
+  def start(self, start_fidx: int = 0, end_fidx: int|None = None, prefetch: int|None = None) -> DecoderProcess:
+    """Starts decoding at the GOP containing start_fidx, through the GOP containing end_fidx - 1"""
+    end_fidx = end_fidx or self.frame_count
+    f_b = int(self.get_gop_start(start_fidx))
+    end_gop = np.searchsorted(self.iframes, end_fidx, side="left")
+    f_e = int(self.iframes[end_gop]) if end_gop < len(self.iframes) else self.frame_count
+    return DecoderProcess(self.fn, self.prefix, int(self.index[f_b, 1]), int(self.index[f_e, 1]), f_b, f_e - f_b,
+                          frame_shape(self.w, self.h, self.pix_fmt),
+                          ffmpeg_decode_args(self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel),
+                          self.gop_size if prefetch is None else prefetch)
+
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
                    frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
     end_fidx = end_fidx or self.frame_count
-    fidx = start_fidx
-    while fidx < end_fidx:
-      f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
-      # number of frames to discard inside this GOP before the wanted one
-      for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt, hwaccel=self.hwaccel, loglevel=self.loglevel)):
-        fidx = f_b + i
-        if fidx >= end_fidx:
+    proc = self.start(start_fidx, end_fidx)
+    try:
+      while proc.fidx < end_fidx:
+        fidx = proc.fidx
+        frm = proc.next()
+        if frm is None:
           return
-        elif fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
+        # frames before start_fidx in its GOP are decoded, but not returned
+        if fidx >= start_fidx and (fidx - start_fidx) % frame_skip == 0:
           yield fidx, frm
-      fidx += 1
+    finally:
+      proc.close()
 
 def FrameIterator(fn: str, index_data: dict|None=None, pix_fmt: str = "rgb24",
                   start_fidx:int=0, end_fidx=None, frame_skip:int=1, hwaccel="auto", loglevel="quiet") -> Iterator[np.ndarray]:
@@ -149,25 +286,52 @@ def FrameIterator(fn: str, index_data: dict|None=None, pix_fmt: str = "rgb24",
     yield frame
 
 class FrameReader:
-  def __init__(self, fn: str, index_data: dict|None = None, cache_size: int = 30,
-               pix_fmt: str = "rgb24", hwaccel="auto", loglevel="quiet"):
+  def __init__(self, fn: str, index_data: dict|None = None, cache_bytes: int = DEFAULT_CACHE_BYTES,
+               pix_fmt: str = "rgb24", hwaccel="auto", loglevel="quiet", cache_size: int|None = None, pickle_cache: bool = False):
+    """
+      The decoded frame cache holds up to cache_bytes, or cache_size frames when given. Pickling drops the cached frames,
+      unless pickle_cache is set, e.g. to store the decoded frames to disk.
+    """
     self.decoder = FfmpegDecoder(fn, index_data=index_data, pix_fmt=pix_fmt, hwaccel=hwaccel, loglevel=loglevel)
     self.iframes = self.decoder.iframes
-    self._cache: LRUCache = LRUCache(cache_size)
+    self._cache: LRUCache = LRUCache(cache_size) if cache_size is not None else LRUCache(cache_bytes, sizeof=attrgetter('nbytes'))
+    self.pickle_cache = pickle_cache
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
     self.pix_fmt = pix_fmt
 
-    self.it: Iterator[tuple[int, np.ndarray]] | None = None
-    self.fidx = -1
+    self._proc: DecoderProcess | None = None
+
+  def __getstate__(self):
+    # decoded frames can be hundreds of MB, by default they're decoded again on demand instead of being pickled
+    state = self.__dict__.copy()
+    state['_proc'] = None
+    if not self.pickle_cache:
+      state['_cache'] = LRUCache(self._cache.capacity, sizeof=self._cache.sizeof)
+    return state
+
+  def __del__(self):
+    self.close()
+
+  def close(self) -> None:
+    if getattr(self, '_proc', None) is not None:
+      self._proc.close()
+      self._proc = None
 
   def get(self, fidx:int):
     if fidx in self._cache:  # If frame is cached, return it
       return self._cache[fidx]
     read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
-      self.it = self.decoder.get_iterator(read_start)
-      self.fidx = -1
-    while self.fidx < fidx:
-      self.fidx, frame = next(self.it)
-      self._cache[self.fidx] = frame
-    return self._cache[fidx]
+    # keep decoding forward unless the frame's GOP starts beyond the read-ahead: up to a GOP of frames past
+    # the current position are already decoded, so skipping through them is cheaper than restarting
+    # ffmpeg at the frame's GOP. The frames on the way are cached.
+    if self._proc is None or fidx < self._proc.fidx or read_start > self._proc.fidx + self.decoder.gop_size:
+      self.close()
+      self._proc = self.decoder.start(read_start)
+    while True:
+      cur = self._proc.fidx
+      frame = self._proc.next()
+      if frame is None:
+        raise DataUnreadableError(f"frame {fidx} not found in {self.decoder.fn}")
+      self._cache[cur] = frame
+      if cur == fidx:
+        return frame
@@ -1,5 +1,15 @@
+import json
+import mmap
+import operator
+import pickle
 import numpy as np
 
+from collections.abc import Iterable
+from openpilot.common.utils import atomic_write
+
+COLUMNAR_MAGIC = b"OPCOLS01"
+COLUMN_ALIGNMENT = 64
+
 
 def flatten_type_dict(d, sep="/", prefix=None):
   res = {}
@@ -16,33 +26,218 @@ def flatten_type_dict(d, sep="/", prefix=None):
     return {prefix: d}
 
 
-def get_message_dict(message, typ):
-  valid = message.valid
-  message = message._get(typ)
-  if not hasattr(message, 'to_dict') or typ in ('qcomGnss', 'ubloxGnss'):
-    # TODO: support these
-    #print("skipping", typ)
-    return
+NO_DISCRIMINANT = 0xffff
+SCALAR_TYPES = {'bool', 'int8', 'int16', 'int32', 'int64', 'uint8', 'uint16', 'uint32', 'uint64', 'float32', 'float64', 'text', 'data', 'enum'}
+SKIPPED_TYPES = ('qcomGnss', 'ubloxGnss')  # TODO: support these
 
-  msg_dict = message.to_dict(verbose=True)
-  msg_dict = flatten_type_dict(msg_dict)
-  msg_dict['_valid'] = valid
-  return msg_dict
 
+class _StructPlan:
+  """Fields of a capnp struct schema, split into plain scalars, nested structs, lists and union members"""
+  __slots__ = ('scalars', 'getter', 'structs', 'lists', 'union')
 
-def append_dict(path, t, d, values):
-  if path not in values:
-    group = {}
-    group["t"] = []
-    for k in d:
-      group[k] = []
-    values[path] = group
-  else:
-    group = values[path]
+  def __init__(self, schema, plans: dict):
+    plans[schema.node.id] = self
+    self.scalars: list[tuple[str, str]] = []
+    self.structs: list[tuple[str, _StructPlan]] = []
+    self.lists: list[tuple[str, str, _StructPlan | None]] = []
+    self.union: dict[str, tuple[str, object]] = {}
+
+    for field in schema.fields_list:
+      proto = field.proto
+      name = proto.name
+      sub: object = None
+      if proto.which() == 'group':
+        typ, sub = 'struct', _get_plan(field.schema, plans)
+      else:
+        typ = proto.slot.type.which()
+        if typ == 'struct':
+          sub = _get_plan(field.schema, plans)
+        elif typ == 'list':
+          elem = proto.slot.type.list.elementType.which()
+          sub = (elem, _get_plan(field.schema.elementType, plans) if elem == 'struct' else None)
+
+      if proto.discriminantValue != NO_DISCRIMINANT:
+        self.union[name] = (typ, sub)
+      elif typ == 'struct':
+        self.structs.append((name, sub))
+      elif typ == 'list':
+        self.lists.append((name, *sub))
+      elif typ in SCALAR_TYPES:
+        self.scalars.append((name, typ))
+
+    self.getter = operator.attrgetter(*(name for name, _ in self.scalars)) if self.scalars else None
+
+  def get_scalars(self, obj) -> tuple:
+    vals = self.getter(obj)
+    return vals if len(self.scalars) > 1 else (vals,)
+
+
+def _get_plan(schema, plans: dict) -> _StructPlan:
+  plan = plans.get(schema.node.id)
+  return plan if plan is not None else _StructPlan(schema, plans)
+
+
+class _FlatReader:
+  """Reads every scalar of a struct that isn't behind a union or list with a single attrgetter call"""
+  __slots__ = ('fields', 'getter', 'walked')
+
+  def __init__(self, plan: _StructPlan):
+    self.fields: list[tuple[str, str]] = []
+    # structs with lists or a union, which are walked after the flat read
+    self.walked: list[tuple[operator.attrgetter | None, str, _StructPlan]] = []
+    attrs: list[str] = []
+    stack = [(plan, "", "")]
+    while stack:
+      plan, path, attr = stack.pop()
+      for name, typ in plan.scalars:
+        self.fields.append((path + name, typ))
+        attrs.append(attr + name)
+      if plan.lists or plan.union:
+        self.walked.append((operator.attrgetter(attr[:-1]) if attr else None, path, plan))
+      for name, sub in plan.structs:
+        stack.append((sub, f"{path}{name}/", f"{attr}{name}."))
+    self.getter = operator.attrgetter(*attrs) if attrs else None
+
+  def read(self, obj) -> tuple:
+    if self.getter is None:
+      return ()
+    vals = self.getter(obj)
+    return vals if len(self.fields) > 1 else (vals,)
+
+
+class _SparseColumn:
+  """Values of a field that isn't set in every row. List columns hold one list per row and are expanded into per-index columns"""
+  __slots__ = ('typ', 'is_list', 'flat', 'rows', 'values')
+
+  def __init__(self, typ: str, is_list: bool, flat: _FlatReader | None):
+    self.typ = typ
+    self.is_list = is_list
+    self.flat = flat
+    self.rows: list[int] = []
+    self.values: list = []
+
+
+class SchemaExtractor:
+  """
+    Extracts the flattened fields of one message type into columns, without building nested dicts through to_dict().
+    Compiled once from the capnp schema: scalars outside of unions and lists are read with a single attrgetter call
+    per message, lists are read as a whole and expanded into columns once all messages are extracted, and union
+    members are only walked when set.
+    With expand_lists, list elements become "field/i" columns, otherwise each list is kept as a single array value.
+  """
+  def __init__(self, schema, expand_lists: bool = True):
+    self.expand_lists = expand_lists
+    self._flat = _FlatReader(_get_plan(schema, {}))
+    self._element_readers: dict[int, _FlatReader] = {}
+
+    self.num_rows = 0
+    self._rows: list[tuple] = []
+    self._sparse: dict[str, _SparseColumn] = {}
+
+  def extract(self, msg) -> None:
+    """Appends one row. If reading any field fails, nothing is appended"""
+    row = self._flat.read(msg)
+    try:
+      for getter, path, plan in self._flat.walked:
+        self._walk(plan, getter(msg) if getter is not None else msg, path, False)
+    except Exception:
+      self._drop_sparse(self.num_rows)
+      raise
+
+    self._rows.append(row)
+    self.num_rows += 1
+
+  def drop_last(self) -> None:
+    """Removes the last extracted row"""
+    assert self.num_rows > 0
+    self.num_rows -= 1
+    self._rows.pop()
+    self._drop_sparse(self.num_rows)
+
+  def clear(self) -> None:
+    """Removes all extracted rows, keeping the compiled schema"""
+    self.num_rows = 0
+    self._rows = []
+    self._sparse = {}
+
+  def _drop_sparse(self, row: int) -> None:
+    for col in self._sparse.values():
+      while col.rows and col.rows[-1] == row:
+        col.rows.pop()
+        col.values.pop()
+
+  def _append(self, path: str, typ: str, value, is_list: bool = False, flat: _FlatReader | None = None) -> None:
+    col = self._sparse.get(path)
+    if col is None:
+      col = self._sparse[path] = _SparseColumn(typ, is_list, flat)
+    col.rows.append(self.num_rows)
+    col.values.append(value)
+
+  def _walk(self, plan: _StructPlan, obj, path: str, emit_scalars: bool) -> None:
+    # without emit_scalars, only the lists and union of this struct are read, its scalars and nested structs are flat
+    if emit_scalars:
+      for (name, typ), val in zip(plan.scalars, plan.get_scalars(obj) if plan.scalars else (), strict=True):
+        self._append(path + name, typ, val)
+      for name, sub in plan.structs:
+        self._walk(sub, getattr(obj, name), f"{path}{name}/", True)
+
+    for name, elem, sub in plan.lists:
+      self._read_list(getattr(obj, name), elem, sub, path + name)
 
-  group["t"].append(t)
-  for k, v in d.items():
-    group[k].append(v)
+    if plan.union:
+      name = obj.which()
+      typ, sub = plan.union[name]
+      if typ == 'struct':
+        self._walk(sub, getattr(obj, name), f"{path}{name}/", True)
+      elif typ == 'list':
+        self._read_list(getattr(obj, name), sub[0], sub[1], path + name)
+      elif typ in SCALAR_TYPES:
+        self._append(path + name, typ, getattr(obj, name))
+
+  def _read_list(self, lst, elem: str, sub: _StructPlan | None, path: str) -> None:
+    if not self.expand_lists:
+      self._append(path, 'list', np.array([e.to_dict(verbose=True) for e in lst] if sub is not None else list(lst)))
+    elif elem in SCALAR_TYPES:
+      self._append(path, elem, list(lst), True)
+    elif sub is not None:
+      flat = self._element_readers.get(id(sub))
+      if flat is None:
+        flat = self._element_readers[id(sub)] = _FlatReader(sub)
+      self._append(path, 'struct', [flat.read(e) for e in lst], True, flat)
+      for i, e in enumerate(lst):
+        for getter, sub_path, plan in flat.walked:
+          self._walk(plan, getter(e) if getter is not None else e, f"{path}/{i}/{sub_path}", False)
+
+  def columns(self) -> dict[str, tuple[str, list, list[int] | None]]:
+    """Returns {path: (capnp type, values, row indices)}, where row indices is None for fields present in every row"""
+    cols: dict[str, tuple[str, list, list[int] | None]] = {}
+    if self._flat.fields and self.num_rows:
+      flat_values = zip(*self._rows, strict=True)
+      for (path, typ), values in zip(self._flat.fields, flat_values, strict=True):
+        cols[path] = (typ, _python_values(list(values), typ), None)
+
+    for path, col in self._sparse.items():
+      if not col.is_list:
+        cols[path] = (col.typ, _python_values(col.values, col.typ), col.rows)
+      elif col.flat is not None:
+        for i in range(max(map(len, col.values), default=0)):
+          rows = [row for row, v in zip(col.rows, col.values, strict=True) if len(v) > i]
+          elements = [v[i] for v in col.values if len(v) > i]
+          for j, (field, typ) in enumerate(col.flat.fields):
+            cols[f"{path}/{i}/{field}"] = (typ, _python_values([e[j] for e in elements], typ), rows)
+      else:
+        for i in range(max(map(len, col.values), default=0)):
+          rows = [row for row, v in zip(col.rows, col.values, strict=True) if len(v) > i]
+          cols[f"{path}/{i}"] = (col.typ, _python_values([v[i] for v in col.values if len(v) > i], col.typ), rows)
+
+    for path, (typ, values, rows) in cols.items():
+      if rows is not None and len(rows) == self.num_rows:
+        cols[path] = (typ, values, None)
+    return cols
+
+
+def _python_values(values: list, typ: str) -> list:
+  return [str(v) for v in values] if typ == 'enum' else values
 
 
 def potentially_ragged_array(arr, dtype=None, **kwargs):
@@ -56,23 +251,147 @@ def msgs_to_time_series(msgs):
   """
     Convert an iterable of canonical capnp messages into a dictionary of time series.
     Each time series has a value with key "t" which consists of monotonically increasing timestamps
-    in seconds.
+    in seconds. Fields missing from some messages, like inactive union members, are None there.
   """
-  values = {}
+  extractors: dict[str, SchemaExtractor] = {}
+  times: dict[str, list[float]] = {}
+  valid: dict[str, list[bool]] = {}
   for msg in msgs:
     typ = msg.which()
+    if typ in SKIPPED_TYPES:
+      continue
+
+    if typ not in extractors:
+      sub_msg = msg._get(typ)
+      if not hasattr(sub_msg, 'to_dict'):
+        continue
+      extractors[typ] = SchemaExtractor(sub_msg.schema, expand_lists=False)
+      times[typ], valid[typ] = [], []
+
+    extractors[typ].extract(msg._get(typ))
+    times[typ].append(msg.logMonoTime / 1.0e9)
+    valid[typ].append(msg.valid)
+
+  values = {}
+  for typ, extractor in extractors.items():
+    # Sort values by time.
+    order = np.argsort(times[typ])
+    group = {"t": np.array(times[typ])[order]}
+    for name, (_, col, rows) in extractor.columns().items():
+      if rows is not None:
+        full: list = [None] * extractor.num_rows
+        for i, v in zip(rows, col, strict=True):
+          full[i] = v
+        col = full
+      group[name] = potentially_ragged_array(col)[order]
+    group["_valid"] = np.array(valid[typ])[order]
+    values[typ] = group
+
+  return values
+
+
+def select_columns(values, columns: Iterable[str] | None = None):
+  """Filters a time series dict by "type" or "type/field" column names. The "t" column of each selected type is always kept"""
+  if columns is None:
+    return values
+
+  selected: dict = {}
+  for column in columns:
+    typ, _, field = column.partition("/")
+    if typ not in values:
+      continue
+    group = selected.setdefault(typ, {"t": values[typ]["t"]})
+    if not field:
+      group.update(values[typ])
+    elif field in values[typ]:
+      group[field] = values[typ][field]
+  return selected
+
+
+def save_columnar(path: str, values) -> None:
+  """
+    Writes a time series dict to a single file with a JSON header followed by aligned raw columns,
+    so load_columnar can memory-map individual columns. Object columns are pickled.
+  """
+  header = []
+  blobs = []
+  offset = 0
+  for typ, group in values.items():
+    for field, arr in group.items():
+      if arr.dtype == object:
+        blob = pickle.dumps(arr, protocol=pickle.HIGHEST_PROTOCOL)
+        dtype = "object"
+      else:
+        arr = np.ascontiguousarray(arr)
+        blob = arr.tobytes()
+        dtype = arr.dtype.str
+      header.append({"name": f"{typ}/{field}", "dtype": dtype, "shape": list(arr.shape), "offset": offset, "nbytes": len(blob)})
+      blobs.append(blob)
+      offset += -(-len(blob) // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+  header_dat = json.dumps(header).encode()
+  data_start = -(-(len(COLUMNAR_MAGIC) + 8 + len(header_dat)) // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+  with atomic_write(path, mode="wb", overwrite=True) as f:
+    f.write(COLUMNAR_MAGIC + len(header_dat).to_bytes(8, "little") + header_dat)
+    for col, blob in zip(header, blobs, strict=True):
+      f.seek(data_start + col["offset"])
+      f.write(blob)
+    f.truncate(data_start + offset)
+
+
+class ColumnarFile:
+  """A file written by save_columnar, with the header parsed once so columns can be loaded individually on demand"""
+  def __init__(self, path: str):
+    with open(path, "rb") as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    assert self._mm[:len(COLUMNAR_MAGIC)] == COLUMNAR_MAGIC, f"not a columnar time series file: {path}"
+    header_start = len(COLUMNAR_MAGIC) + 8
+    header_len = int.from_bytes(self._mm[len(COLUMNAR_MAGIC):header_start], "little")
+    self.columns: dict[str, dict] = {col["name"]: col for col in json.loads(self._mm[header_start:header_start + header_len])}
+    self._data_start = -(-(header_start + header_len) // COLUMN_ALIGNMENT) * COLUMN_ALIGNMENT
+
+  def load(self, name: str) -> np.ndarray:
+    """Numeric columns are read-only views into a memory map of the file"""
+    col = self.columns[name]
+    start = self._data_start + col["offset"]
+    if col["dtype"] == "object":
+      return pickle.loads(self._mm[start:start + col["nbytes"]])
+    return np.frombuffer(self._mm, dtype=np.dtype(col["dtype"]), count=int(np.prod(col["shape"])), offset=start).reshape(col["shape"])
+
+
+def load_columnar(path: str, columns: Iterable[str] | None = None):
+  """Loads columns written by save_columnar. Numeric columns are read-only views into a memory map of the file"""
+  f = ColumnarFile(path)
+  wanted = None if columns is None else set(columns)
+  wanted_types = None if wanted is None else {c.split("/", 1)[0] for c in wanted}
+  values: dict = {}
+  for name in f.columns:
+    typ, field = name.split("/", 1)
+    if wanted is not None and not (typ in wanted or name in wanted or (field == "t" and typ in wanted_types)):
+      continue
+    values.setdefault(typ, {})[field] = f.load(name)
+  return values
 
-    tm = msg.logMonoTime / 1.0e9
-    msg_dict = get_message_dict(msg, typ)
-    if msg_dict is not None:
-      append_dict(typ, tm, msg_dict, values)
 
-  # Sort values by time.
-  for group in values.values():
-    order = np.argsort(group["t"])
-    for name, group_values in group.items():
-      group[name] = potentially_ragged_array(group_values)[order]
+def concat_time_series(segments):
+  """Concatenates per-segment time series dicts, falling back to object arrays for fields with mismatched shapes"""
+  if len(segments) == 1:
+    return segments[0]
 
+  values: dict = {}
+  for typ in dict.fromkeys(typ for seg in segments for typ in seg):
+    groups = [seg[typ] for seg in segments if typ in seg]
+    values[typ] = {}
+    for field in dict.fromkeys(field for group in groups for field in group):
+      arrs = [group[field] if field in group else np.full(len(group["t"]), None, dtype=object) for group in groups]
+      try:
+        values[typ][field] = np.concatenate(arrs)
+      except ValueError:
+        combined = np.empty(sum(len(arr) for arr in arrs), dtype=object)
+        for i, v in enumerate(v for arr in arrs for v in arr):
+          combined[i] = v
+        values[typ][field] = combined
   return values
 
 
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 import bz2
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
+import heapq
+import io
 import multiprocessing
+import multiprocessing.pool
 import capnp
 import enum
 import os
 import pathlib
+import struct
 import sys
 import tqdm
 import urllib.parse
 import warnings
+import numpy as np
 import zstandard as zstd
 
 from collections.abc import Iterable, Iterator
@@ -17,17 +23,51 @@ from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
 from openpilot.common.swaglog import cloudlog
+from openpilot.common.utils import atomic_write
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.cache import derived_cache_path
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.file_sources import comma_api_source, internal_source, openpilotci_source, comma_car_segments_source, Source
 from openpilot.tools.lib.route import SegmentRange, FileName
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.seekable_zstd import compress_seekable, frame_ranges, read_seek_table
+from openpilot.tools.lib.log_time_series import concat_time_series, load_columnar, msgs_to_time_series, save_columnar, select_columns
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
+BZ2_MAGIC = b'BZh'
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'  # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024  # decompressed bytes parsed at once in stream mode
+REORDER_WINDOW = 1000  # events buffered to sort by logMonoTime in stream mode
+MAX_SEGMENTS = 512  # capnp's default segment limit, anything larger is a corrupted header
+LOG_INDEX_VERSION = 1
+TIME_SERIES_VERSION = 1
+
+
+def _seekable_frames(log_msgs, frame_seconds: float):
+  frame: list[bytes] = []
+  start_time = end_time = frame_start = 0
+  for msg in log_msgs:
+    t = msg.logMonoTime
+    if frame and t - frame_start >= frame_seconds * 1e9:
+      yield b"".join(frame), start_time, end_time
+      frame = []
+    if not frame:
+      start_time = end_time = frame_start = t
+    frame.append(msg.as_builder().to_bytes())
+    start_time, end_time = min(start_time, t), max(end_time, t)
+  if frame:
+    yield b"".join(frame), start_time, end_time
+
+
+def save_log(dest, log_msgs, compress=True, frame_seconds: float | None = None):
+  """Writes log_msgs to dest. With frame_seconds, .zst logs are written as seekable zstd with one frame per frame_seconds of logMonoTime"""
+  if compress and frame_seconds is not None and dest.endswith(".zst"):
+    with open(dest, "wb") as f:
+      f.write(compress_seekable(_seekable_frames(log_msgs, frame_seconds), 10))
+    return
 
-def save_log(dest, log_msgs, compress=True):
   dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
 
   if compress and dest.endswith(".bz2"):
@@ -49,6 +89,147 @@ def decompress_stream(data: bytes):
   return decompressed_data
 
 
+def capnp_message_size(dat, offset: int = 0) -> int | None:
+  """Returns the size of the framed capnp message starting at offset, or None if dat doesn't contain all of it"""
+  avail = len(dat) - offset
+  if avail < 8:
+    return None
+
+  num_segments, first_size = struct.unpack_from("<II", dat, offset)
+  if num_segments == 0:  # fast path, events are almost always a single segment
+    size = 8 + 8 * first_size
+  else:
+    num_segments += 1
+    if num_segments > MAX_SEGMENTS:
+      raise ValueError(f"invalid capnp segment count {num_segments}")
+    header_size = (4 + 4 * num_segments + 7) & ~7
+    if avail < header_size:
+      return None
+    size = header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", dat, offset + 4))
+  return size if size <= avail else None
+
+
+def open_decompressed(f, ext: str | None = None):
+  """Wraps a file-like object with a streaming decompressor based on its extension or magic bytes"""
+  magic = f.read(4)
+  f.seek(0)
+  if ext == ".bz2" or magic.startswith(BZ2_MAGIC):
+    return bz2.BZ2File(f)
+  elif ext == ".zst" or magic.startswith(ZSTD_MAGIC):
+    return zstd.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=False)
+  return f
+
+
+def stream_messages(f, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+  """Reads a decompressed file-like object in chunks, yielding buffers that only contain complete capnp messages"""
+  buf = b""
+  while True:
+    chunk = f.read(chunk_size)
+    if chunk:
+      buf = buf + chunk if buf else chunk
+
+    # find the last complete message in the buffer
+    end = 0
+    try:
+      while (size := capnp_message_size(buf, end)) is not None:
+        end += size
+    except ValueError:
+      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+      chunk = buf = b""
+
+    if end:
+      yield buf[:end]
+      buf = buf[end:]
+
+    if not chunk:
+      if buf:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+      return
+
+
+def stream_events(f, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[capnp._DynamicStructReader]:
+  """Parses events from a decompressed file-like object, holding at most about chunk_size bytes at a time"""
+  for buf in stream_messages(f, chunk_size):
+    yield from capnp_log.Event.read_multiple_bytes(buf)
+
+
+def sorted_within_window(events: Iterable, window: int = REORDER_WINDOW) -> Iterator:
+  """Sorts events by logMonoTime using a bounded reorder buffer. Only events at most window positions out of order are fixed"""
+  heap: list = []
+  for i, evt in enumerate(events):
+    heapq.heappush(heap, (evt.logMonoTime, i, evt))
+    if len(heap) > window:
+      yield heapq.heappop(heap)[2]
+  while heap:
+    yield heapq.heappop(heap)[2]
+
+
+def event_from_bytes(dat) -> capnp._DynamicStructReader:
+  with capnp_log.Event.from_bytes(dat) as evt:
+    return evt
+
+
+class LogIndex:
+  """Byte offset, size, type and logMonoTime of every event in a decompressed log"""
+  DTYPE = np.dtype([('offset', '<u8'), ('size', '<u4'), ('which', '<u2'), ('logMonoTime', '<u8')])
+
+  def __init__(self, events: np.ndarray, types: list[str]):
+    self.events = events
+    self.types = types
+
+  def __len__(self):
+    return len(self.events)
+
+  @staticmethod
+  def build(f) -> 'LogIndex':
+    """Indexes a decompressed file-like object. Events without a valid union type get an empty type"""
+    types: dict[str, int] = {}
+    rows = []
+    offset = 0
+    for buf in stream_messages(f):
+      pos = 0
+      for evt in capnp_log.Event.read_multiple_bytes(buf):
+        size = capnp_message_size(buf, pos)
+        try:
+          typ = evt.which()
+        except capnp.KjException:
+          typ = ""
+        rows.append((offset + pos, size, types.setdefault(typ, len(types)), evt.logMonoTime))
+        pos += size
+      offset += len(buf)
+    return LogIndex(np.array(rows, dtype=LogIndex.DTYPE), list(types))
+
+  @staticmethod
+  def load(path: str) -> 'LogIndex':
+    with np.load(path) as dat:
+      assert int(dat['version']) == LOG_INDEX_VERSION, f"unsupported log index version in {path}"
+      return LogIndex(dat['events'], dat['types'].tolist())
+
+  def save(self, path: str) -> None:
+    with atomic_write(path, mode="wb", overwrite=True) as f:
+      np.savez(f, version=LOG_INDEX_VERSION, events=self.events, types=np.array(self.types, dtype=str))
+
+  def select(self, msg_types: Iterable[str] | None = None, start_time: int | None = None, end_time: int | None = None) -> np.ndarray:
+    """Returns the index rows of events matching msg_types with start_time <= logMonoTime < end_time, in file order"""
+    mask = np.ones(len(self.events), dtype=bool)
+    if msg_types is not None:
+      type_ids = [self.types.index(t) for t in msg_types if t in self.types]
+      mask &= np.isin(self.events['which'], type_ids)
+    if start_time is not None:
+      mask &= self.events['logMonoTime'] >= start_time
+    if end_time is not None:
+      mask &= self.events['logMonoTime'] < end_time
+    return self.events[mask]
+
+
+def log_index_path(fn: str) -> str:
+  return derived_cache_path(fn, f"index_v{LOG_INDEX_VERSION}.npz")
+
+
+def time_series_path(fn: str) -> str:
+  return derived_cache_path(fn, f"time_series_v{TIME_SERIES_VERSION}.cols")
+
+
 class CachedEventReader:
   __slots__ = ('_evt', '_enum')
 
@@ -87,9 +268,11 @@ class CachedEventReader:
 
 
 class _LogFileReader:
-  def __init__(self, fn, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, only_union_types=False, sort_by_time=False, dat=None, stream=False, reorder_window=REORDER_WINDOW):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
+    self._reorder_window = reorder_window
 
     ext = None
     if not dat:
@@ -98,29 +281,155 @@ class _LogFileReader:
         # old rlogs weren't compressed
         raise ValueError(f"unknown extension {ext}")
 
-      with FileReader(fn) as f:
+    # in stream mode, events are decompressed and parsed lazily on every iteration
+    self._fn, self._ext, self._dat = fn, ext, dat
+    self._stream = stream
+    self._ents: list[CachedEventReader] | None = None
+    self._index: LogIndex | None = None
+    self._buf: bytes | None = None  # decompressed log, kept for repeated read_events queries until unload()
+
+  def _load(self) -> list[CachedEventReader]:
+    if self._ents is None:
+      ents = capnp_log.Event.read_multiple_bytes(self._decompressed())
+
+      self._ents = []
+      try:
+        for e in ents:
+          self._ents.append(CachedEventReader(e))
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+      if self._sort_by_time:
+        self._ents.sort(key=lambda x: x.logMonoTime)
+    return self._ents
+
+  def unload(self) -> None:
+    """Frees the parsed events and decompressed log, they are read again on the next iteration"""
+    self._ents = None
+    self._buf = None
+
+  def _open(self):
+    return io.BytesIO(self._dat) if self._dat else FileReader(self._fn)
+
+  def _decompressed(self) -> bytes:
+    if self._buf is None:
+      self._buf = self._decompress()
+    return self._buf
+
+  def _decompress(self) -> bytes:
+    if self._dat:
+      dat = self._dat
+    else:
+      with FileReader(self._fn) as f:
         dat = f.read()
 
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
+    if self._ext == ".bz2" or dat.startswith(BZ2_MAGIC):
       dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+    elif self._ext == ".zst" or dat.startswith(ZSTD_MAGIC):
       dat = decompress_stream(dat)
+    return dat
+
+  def index(self, decompressed: bool = False) -> LogIndex:
+    """
+      Returns the event index, loading it from the download cache or building and caching it on first use.
+      With decompressed, it's built from the decompressed log kept for reading events, instead of decompressing the file again.
+    """
+    if self._index is not None:
+      return self._index
+
+    path = log_index_path(self._fn) if self._fn else None
+    if path is not None and os.path.exists(path):
+      try:
+        self._index = LogIndex.load(path)
+        return self._index
+      except Exception:
+        cloudlog.exception(f"failed to load log index {path}, rebuilding")
 
-    ents = capnp_log.Event.read_multiple_bytes(dat)
-
-    self._ents = []
-    try:
-      for e in ents:
-        self._ents.append(CachedEventReader(e))
-    except capnp.KjException:
-      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
-
-    if sort_by_time:
-      self._ents.sort(key=lambda x: x.logMonoTime)
+    if decompressed:
+      self._index = LogIndex.build(io.BytesIO(self._decompressed()))
+    else:
+      with self._open() as f:
+        self._index = LogIndex.build(open_decompressed(f, self._ext))
+    if path is not None:
+      os.makedirs(Paths.download_cache_root(), exist_ok=True)
+      self._index.save(path)
+    return self._index
+
+  def time_series(self, columns: Iterable[str] | None = None):
+    """Returns this log's time series, cached in a memory-mappable columnar file so only the requested columns are loaded"""
+    if not self._fn:
+      return select_columns(msgs_to_time_series(self), columns)
+
+    path = time_series_path(self._fn)
+    if not os.path.exists(path):
+      os.makedirs(Paths.download_cache_root(), exist_ok=True)
+      save_columnar(path, msgs_to_time_series(self))
+    return load_columnar(path, columns)
+
+  def read_events(self, msg_types: Iterable[str] | None = None, start_time: int | None = None,
+                  end_time: int | None = None) -> Iterator[CachedEventReader]:
+    """Yields only the events matching the index query, without parsing the others"""
+    if start_time is not None or end_time is not None:
+      ents = self._read_time_range(start_time, end_time)
+      if ents is not None:
+        for ent in ents:
+          try:
+            if msg_types is None or ent.which() in msg_types:
+              yield ent
+          except capnp.KjException:
+            if not self._only_union_types:
+              yield ent
+        return
+
+    # the events are read from the decompressed log, so a missing index is built from it too
+    index = self.index(decompressed=True)
+    rows = index.select(msg_types, start_time, end_time)
+    if self._only_union_types and "" in index.types:
+      rows = rows[rows['which'] != index.types.index("")]
+    if self._sort_by_time:
+      rows = rows[np.argsort(rows['logMonoTime'], kind='stable')]
+    if not len(rows):
+      return
+
+    dat = memoryview(self._decompressed())
+    for offset, size, which, _ in rows.tolist():
+      yield CachedEventReader(event_from_bytes(dat[offset:offset + size]), index.types[which] or None)
+
+  def _read_time_range(self, start_time: int | None, end_time: int | None) -> list[CachedEventReader] | None:
+    """Decompresses only the frames of a seekable zstd log covering the time range, or returns None if the log isn't seekable"""
+    if self._dat or self._ext != ".zst":
+      return None
+
+    with FileReader(self._fn) as f:
+      table = read_seek_table(f, f.get_length())
+      if table is None:
+        return None
+      ranges = frame_ranges(table, start_time, end_time)
+      frames = f.get_multi_range(ranges) if ranges else []
+
+    ents = []
+    for frame in frames:
+      for e in capnp_log.Event.read_multiple_bytes(decompress_stream(frame)):
+        if (start_time is None or e.logMonoTime >= start_time) and (end_time is None or e.logMonoTime < end_time):
+          ents.append(CachedEventReader(e))
+
+    if self._sort_by_time:
+      ents.sort(key=lambda x: x.logMonoTime)
+    return ents
+
+  def _stream_events(self) -> Iterator[CachedEventReader]:
+    with self._open() as f:
+      reader = open_decompressed(f, self._ext)
+      ents: Iterator[CachedEventReader] = (CachedEventReader(e) for e in stream_events(reader))
+      if self._sort_by_time:
+        ents = sorted_within_window(ents, self._reorder_window)
+      try:
+        yield from ents
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in (self._stream_events() if self._stream else self._load()):
       if self._only_union_types:
         try:
           ent.which()
@@ -244,7 +553,8 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               sources: list[Source] | None = None, sort_by_time=False, only_union_types=False):
+               sources: list[Source] | None = None, sort_by_time=False, only_union_types=False, stream=False,
+               use_index=False, prefetch=0):
     if sources is None:
       sources = [internal_source, comma_api_source, openpilotci_source, comma_car_segments_source]
 
@@ -256,29 +566,96 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.stream = stream
+    self.use_index = use_index
+    self.prefetch = prefetch
 
     self.__lrs: dict[int, _LogFileReader] = {}
+    self._pool: multiprocessing.pool.Pool | None = None
+    self._pool_size = 0
+    self._keep_pool = False
     self.reset()
 
+  def __enter__(self):
+    # run_across_segments reuses its process pool until the block exits
+    self._keep_pool = True
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    self._keep_pool = False
+    self.close()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_pool'] = None
+    return state
+
+  def close(self) -> None:
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool = None
+
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                                     stream=self.stream)
     return self.__lrs[i]
 
   def __iter__(self):
+    if self.prefetch > 0 and not self.stream:
+      yield from self._iter_prefetched()
+      return
+
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
+  def _iter_prefetched(self):
+    """
+      Downloads, decompresses and parses the next `prefetch` segments in background threads while the current one is consumed.
+      Segments are unloaded once consumed, so at most prefetch + 1 segments are held in memory.
+    """
+    num_segs = len(self.logreader_identifiers)
+    executor = ThreadPoolExecutor(max_workers=self.prefetch)
+    futures: dict[int, Future] = {}
+
+    def submit(i):
+      if i < num_segs:
+        futures[i] = executor.submit(self._get_lr(i)._load)
+
+    try:
+      for i in range(self.prefetch):
+        submit(i)
+      for i in range(num_segs):
+        submit(i + self.prefetch)
+        futures.pop(i).result()
+        lr = self._get_lr(i)
+        yield from lr
+        lr.unload()
+    finally:
+      executor.shutdown(wait=True, cancel_futures=True)
+
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
 
+  def _get_pool(self, num_processes) -> multiprocessing.pool.Pool:
+    if self._pool is None or self._pool_size != num_processes:
+      self.close()
+      self._pool = multiprocessing.Pool(num_processes)
+      self._pool_size = num_processes
+    return self._pool
+
   def run_across_segments(self, num_processes, func, disable_tqdm=False, desc=None):
-    with multiprocessing.Pool(num_processes) as pool:
-      ret = []
-      num_segs = len(self.logreader_identifiers)
+    """Runs func on every segment in a process pool. The pool is shut down afterwards, unless inside `with LogReader(...)`"""
+    pool = self._get_pool(num_processes)
+    ret = []
+    num_segs = len(self.logreader_identifiers)
+    try:
       for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, disable=disable_tqdm, desc=desc):
         ret.extend(p)
-      return ret
+    finally:
+      if not self._keep_pool:
+        self.close()
+    return ret
 
   def reset(self):
     self.logreader_identifiers = []
@@ -289,15 +666,26 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
+  def read_events(self, msg_types: Iterable[str] | None = None, start_time: int | None = None, end_time: int | None = None):
+    """Yields events matching msg_types with start_time <= logMonoTime < end_time, using the per-segment event index"""
+    for i in range(len(self.logreader_identifiers)):
+      yield from self._get_lr(i).read_events(msg_types, start_time, end_time)
+
   def filter(self, msg_type: str):
+    if self.use_index:
+      return (getattr(m, msg_type) for m in self.read_events([msg_type]))
     return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def load_time_series(self, columns: Iterable[str] | None = None):
+    """Time series of "type" or "type/field" columns, built once per segment and cached in the download cache"""
+    return concat_time_series([self._get_lr(i).time_series(columns) for i in range(len(self.logreader_identifiers))])
+
   @property
   def time_series(self):
-    return msgs_to_time_series(self)
+    return self.load_time_series()
 
 
 if __name__ == "__main__":
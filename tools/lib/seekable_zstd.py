@@ -0,0 +1,81 @@
+import struct
+import numpy as np
+import zstandard as zstd
+
+from collections.abc import Iterable
+
+# https://github.com/facebook/zstd/blob/dev/contrib/seekable_format/zstd_seekable_compression_format.md
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER_SIZE = 9
+# per-frame logMonoTime ranges live in a second skippable frame right before the seek table
+TIME_TABLE_MAGIC = 0x184D2A5F
+
+FRAME_DTYPE = np.dtype([('offset', '<u8'), ('compressed_size', '<u4'), ('decompressed_size', '<u4'),
+                        ('start_time', '<u8'), ('end_time', '<u8')])
+
+
+def compress_seekable(frames: Iterable[tuple[bytes, int, int]], level: int = 10) -> bytes:
+  """Compresses (data, start_time, end_time) tuples into independent zstd frames, followed by a time table and seek table"""
+  out = []
+  sizes = []
+  times = []
+  for dat, start_time, end_time in frames:
+    frame = zstd.compress(dat, level)
+    out.append(frame)
+    sizes.append((len(frame), len(dat)))
+    times.append((start_time, end_time))
+
+  time_table = b"".join(struct.pack("<QQ", *t) for t in times)
+  out.append(struct.pack("<II", TIME_TABLE_MAGIC, len(time_table)) + time_table)
+
+  seek_table = b"".join(struct.pack("<II", *s) for s in sizes) + struct.pack("<IBI", len(sizes), 0, SEEKABLE_MAGIC)
+  out.append(struct.pack("<II", SKIPPABLE_MAGIC, len(seek_table)) + seek_table)
+  return b"".join(out)
+
+
+def read_seek_table(f, length: int) -> np.ndarray | None:
+  """Reads the frame table of a seekable zstd file of the given length, or returns None if it isn't seekable"""
+  if length < SEEK_TABLE_FOOTER_SIZE + 8:
+    return None
+
+  footer = f.get_multi_range([(length - SEEK_TABLE_FOOTER_SIZE, length)])[0]
+  num_frames, descriptor, magic = struct.unpack("<IBI", footer)
+  if magic != SEEKABLE_MAGIC:
+    return None
+
+  entry_size = 12 if descriptor & 0x80 else 8  # entries optionally include a checksum
+  seek_table_size = 8 + num_frames * entry_size + SEEK_TABLE_FOOTER_SIZE
+  time_table_size = 8 + num_frames * 16
+  tables_start = length - seek_table_size - time_table_size
+  if tables_start < 0:
+    return None
+
+  tables = f.get_multi_range([(tables_start, length - SEEK_TABLE_FOOTER_SIZE)])[0]
+  if struct.unpack_from("<I", tables)[0] != TIME_TABLE_MAGIC:
+    return None
+
+  table = np.zeros(num_frames, dtype=FRAME_DTYPE)
+  times = np.frombuffer(tables, dtype='<u8', count=num_frames * 2, offset=8).reshape(-1, 2)
+  table['start_time'], table['end_time'] = times[:, 0], times[:, 1]
+  sizes = np.frombuffer(tables, dtype='<u4', count=num_frames * entry_size // 4, offset=time_table_size + 8).reshape(num_frames, -1)
+  table['compressed_size'], table['decompressed_size'] = sizes[:, 0], sizes[:, 1]
+  table['offset'][1:] = np.cumsum(table['compressed_size'], dtype=np.uint64)[:-1]
+  return table
+
+
+def frame_ranges(table: np.ndarray, start_time: int | None = None, end_time: int | None = None) -> list[tuple[int, int]]:
+  """Returns the compressed byte ranges of the frames overlapping start_time <= t < end_time, with adjacent frames merged"""
+  mask = np.ones(len(table), dtype=bool)
+  if start_time is not None:
+    mask &= table['end_time'] >= start_time
+  if end_time is not None:
+    mask &= table['start_time'] < end_time
+
+  ranges: list[tuple[int, int]] = []
+  for offset, size in zip(table['offset'][mask].tolist(), table['compressed_size'][mask].tolist(), strict=True):
+    if ranges and ranges[-1][1] == offset:
+      ranges[-1] = (ranges[-1][0], offset + size)
+    else:
+      ranges.append((offset, offset + size))
+  return ranges
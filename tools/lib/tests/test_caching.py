@@ -30,6 +30,25 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = bytes(range(256)) * (3 * url_file_module.CHUNK_SIZE // 256 + 100)
+  requests: list[str] = []
+
+  def do_GET(self):
+    start, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+    RangeRequestHandler.requests.append(self.headers["Range"])
+    dat = self.DATA[start:end + 1]
+    self.send_response(206)
+    self.send_header("Content-Length", str(len(dat)))
+    self.end_headers()
+    self.wfile.write(dat)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
 @pytest.fixture
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
@@ -132,7 +151,62 @@ class TestFileDownload:
     assert length == 4
 
 
+  def test_coalesced_chunk_download(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir, http_server_context(handler=RangeRequestHandler) as (host, port):
+      monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: tmpdir + "/"))
+      url = f"http://{host}:{port}/test.bin"
+      data = RangeRequestHandler.DATA
+
+      # middle chunk is cached first, so reading everything needs two separate runs
+      f = URLFile(url, cache=True)
+      f.seek(url_file_module.CHUNK_SIZE + 10)
+      assert f.read(ll=100) == data[url_file_module.CHUNK_SIZE + 10:url_file_module.CHUNK_SIZE + 110]
+
+      RangeRequestHandler.requests.clear()
+      f.seek(0)
+      assert f.read() == data
+      assert len(RangeRequestHandler.requests) == 2
+
+      # all chunks are cached now
+      RangeRequestHandler.requests.clear()
+      f.seek(5)
+      assert f.read(ll=3 * url_file_module.CHUNK_SIZE) == data[5:5 + 3 * url_file_module.CHUNK_SIZE]
+      assert len(RangeRequestHandler.requests) == 0
+
+      with open(url_file_module.manifest_path()) as mf:
+        assert len({line.split()[0] for line in mf if line.strip()}) == 4
+
+
 class TestCache:
+  def test_coalesce_chunks(self):
+    assert url_file_module.coalesce_chunks([]) == []
+    assert url_file_module.coalesce_chunks([0, 1, 2, 5, 6, 9]) == [[0, 1, 2], [5, 6], [9]]
+    assert url_file_module.coalesce_chunks([0, 1, 2, 3], max_len=3) == [[0, 1, 2], [3]]
+
+  def test_touch_cache_compaction(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: tmpdir + "/"))
+      compactions = []
+      prune_cache = url_file_module.prune_cache
+      monkeypatch.setattr(url_file_module, 'prune_cache', lambda: compactions.append(1) or prune_cache())
+
+      # a full cache, with manifest lines longer than the shortest possible one
+      max_entries = url_file_module.CACHE_SIZE // url_file_module.CHUNK_SIZE
+      with open(url_file_module.manifest_path(), "w") as f:
+        f.write("".join(f"{'0' * 32}_{i}.0 1700000000\n" for i in range(1000, 1000 + max_entries)))
+
+      # compacted on the first touch, then only after every MAX_MANIFEST_APPENDS entries
+      url_file_module.touch_cache([f"{'0' * 32}_{1000 + i}.0" for i in range(10)])
+      assert len(compactions) == 1
+      for _ in range(url_file_module.MAX_MANIFEST_APPENDS):
+        url_file_module.touch_cache([f"{'0' * 32}_1000.0"])
+      assert len(compactions) == 1
+      url_file_module.touch_cache([f"{'0' * 32}_1000.0"])
+      assert len(compactions) == 2
+
+      with open(url_file_module.manifest_path()) as mf:
+        assert len(mf.readlines()) == max_entries
+
   def test_prune_cache(self, monkeypatch):
     with tempfile.TemporaryDirectory() as tmpdir:
       monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: tmpdir + "/"))
@@ -0,0 +1,110 @@
+import pickle
+import random
+import subprocess
+import numpy as np
+import pytest
+
+from openpilot.tools.lib.framereader import FrameReader, LRUCache, decompress_video_data, get_video_index
+
+W, H = 64, 48
+NUM_FRAMES = 50
+GOP_SIZE = 10
+
+
+@pytest.fixture(scope="module")
+def video(tmp_path_factory):
+  fn = str(tmp_path_factory.mktemp("framereader") / "video.hevc")
+  subprocess.check_call(["ffmpeg", "-v", "quiet", "-f", "lavfi", "-i", f"testsrc=size={W}x{H}:rate=20", "-frames:v", str(NUM_FRAMES),
+                         "-c:v", "libx265", "-x265-params", f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:scenecut=0:open-gop=0:bframes=0:log-level=none",
+                         "-f", "hevc", fn])
+
+  # decoding the whole file at once, like FrameReader used to for each GOP
+  with open(fn, "rb") as f:
+    frames = decompress_video_data(f.read(), W, H, loglevel="quiet")
+  assert len(frames) == NUM_FRAMES
+  return fn, get_video_index(fn, use_cache=False), frames
+
+
+class TestFrameReader:
+  @pytest.mark.parametrize("order", ["sequential", "strided", "backwards", "random"])
+  def test_frames(self, video, order):
+    fn, index_data, frames = video
+    fidxs = {
+      "sequential": list(range(NUM_FRAMES)),
+      "strided": list(range(3, NUM_FRAMES, GOP_SIZE + 3)),
+      "backwards": list(reversed(range(NUM_FRAMES))),
+      "random": random.Random(0).choices(range(NUM_FRAMES), k=2 * NUM_FRAMES),
+    }[order]
+
+    fr = FrameReader(fn, index_data=index_data)
+    for fidx in fidxs:
+      np.testing.assert_array_equal(fr.get(fidx), frames[fidx], err_msg=f"frame {fidx}")
+    fr.close()
+
+  def test_strided_read_ahead(self, video):
+    # skipping forward into the next GOP keeps decoding with the same process
+    fn, index_data, _ = video
+    fr = FrameReader(fn, index_data=index_data)
+    fr.get(0)
+    proc = fr._proc
+    for fidx in range(GOP_SIZE + 3, NUM_FRAMES, GOP_SIZE + 3):
+      fr.get(fidx)
+      assert fr._proc is proc
+
+    # going backwards restarts at the frame's GOP
+    fr._cache = LRUCache(0)
+    fr.get(GOP_SIZE + 1)
+    assert fr._proc is not proc and fr._proc.fidx == GOP_SIZE + 2
+    fr.close()
+
+  def test_cache_bytes(self, video):
+    fn, index_data, frames = video
+    fr = FrameReader(fn, index_data=index_data, cache_bytes=5 * frames[0].nbytes)
+    for fidx in range(2 * GOP_SIZE):
+      fr.get(fidx)
+    assert list(fr._cache._cache) == list(range(2 * GOP_SIZE - 5, 2 * GOP_SIZE))
+    assert fr._cache.size == 5 * frames[0].nbytes
+    fr.close()
+
+  def test_pickle(self, video):
+    fn, index_data, frames = video
+    fr = FrameReader(fn, index_data=index_data)
+    fr.get(0)
+
+    fr2 = pickle.loads(pickle.dumps(fr))
+    assert fr2._proc is None and fr2._cache.size == 0
+    assert fr2._cache.capacity == fr._cache.capacity
+    np.testing.assert_array_equal(fr2.get(1), frames[1])
+    fr.close()
+    fr2.close()
+
+  def test_pickle_cache(self, video):
+    # frames are kept when pickled if asked to, with the cache size in frames
+    fn, index_data, frames = video
+    fr = FrameReader(fn, index_data=index_data, cache_size=GOP_SIZE, pickle_cache=True)
+    for fidx in range(2 * GOP_SIZE):
+      fr.get(fidx)
+    assert list(fr._cache._cache) == list(range(GOP_SIZE, 2 * GOP_SIZE))
+    fr.close()
+
+    fr2 = pickle.loads(pickle.dumps(fr))
+    assert list(fr2._cache._cache) == list(range(GOP_SIZE, 2 * GOP_SIZE))
+    for fidx in range(GOP_SIZE, 2 * GOP_SIZE):
+      np.testing.assert_array_equal(fr2.get(fidx), frames[fidx])
+    assert fr2._proc is None
+
+
+class TestLRUCache:
+  def test_evict_by_size(self):
+    cache = LRUCache(10, sizeof=len)
+    cache[0] = b"a" * 4
+    cache[1] = b"b" * 4
+    assert cache[0] == b"a" * 4  # now most recently used
+    cache[2] = b"c" * 4
+    assert 1 not in cache and 0 in cache and 2 in cache
+    assert cache.size == 8
+
+    cache[0] = b"a"
+    assert cache.size == 5
+    cache[3] = b"d" * 20  # larger than the whole cache
+    assert cache.size == 0 and 3 not in cache
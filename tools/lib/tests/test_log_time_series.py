@@ -0,0 +1,102 @@
+import random
+import numpy as np
+import pytest
+
+import cereal.messaging as messaging
+from openpilot.tools.lib.log_time_series import SchemaExtractor
+
+
+def flatten(obj, prefix, out, expand_lists):
+  if isinstance(obj, dict):
+    for key, val in obj.items():
+      flatten(val, f"{prefix}/{key}" if prefix else key, out, expand_lists)
+  elif isinstance(obj, list) and expand_lists:
+    for i, val in enumerate(obj):
+      flatten(val, f"{prefix}/{i}", out, expand_lists)
+  else:
+    out[prefix] = np.array(obj) if isinstance(obj, list) else obj
+
+
+def to_dict_columns(msgs, expand_lists):
+  # flattened to_dict() of every message, with None where a message doesn't have a field
+  rows = []
+  for msg in msgs:
+    rows.append({})
+    flatten(msg._get(msg.which()).to_dict(verbose=True), None, rows[-1], expand_lists)
+  return {path: [row.get(path) for row in rows] for path in dict.fromkeys(path for row in rows for path in row)}
+
+
+def extractor_columns(msgs, expand_lists):
+  extractor = SchemaExtractor(msgs[0]._get(msgs[0].which()).schema, expand_lists)
+  for msg in msgs:
+    extractor.extract(msg._get(msg.which()))
+
+  cols = {}
+  for path, (_, values, rows) in extractor.columns().items():
+    if rows is not None:
+      dense: list = [None] * extractor.num_rows
+      for row, v in zip(rows, values, strict=True):
+        dense[row] = v
+      values = dense
+    cols[path] = values
+  return cols
+
+
+def make_msgs(which, n=50):
+  rng = random.Random(0)
+  msgs = []
+  for _ in range(n):
+    msg = messaging.new_message(which)
+    if which == 'liveCalibration':
+      # enums and scalar lists of varying length
+      msg.liveCalibration.calStatus = rng.choice(['uncalibrated', 'calibrated', 'recalibrating'])
+      msg.liveCalibration.validBlocks = rng.randint(0, 10)
+      msg.liveCalibration.rpyCalib = [rng.random() for _ in range(rng.randint(0, 3))]
+    elif which == 'accelerometer':
+      # union members of different types, only set in some messages
+      msg.accelerometer.source = rng.choice(['lsm6ds3', 'bmx055'])
+      member = rng.choice(['acceleration', 'gyro', 'temperature'])
+      if member == 'temperature':
+        msg.accelerometer.temperature = rng.random()
+      else:
+        vec = msg.accelerometer.init(member)
+        vec.v = [rng.random() for _ in range(3)]
+        vec.status = rng.randint(0, 1)
+    else:
+      # struct lists of varying length
+      procs = msg.managerState.init('processes', rng.randint(0, 3))
+      for i, proc in enumerate(procs):
+        proc.name = f"proc{i}"
+        proc.pid = rng.randint(0, 1000)
+        proc.running = rng.random() < 0.5
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestSchemaExtractor:
+  @pytest.mark.parametrize("expand_lists", [True, False])
+  @pytest.mark.parametrize("which", ['liveCalibration', 'accelerometer', 'managerState'])
+  def test_matches_to_dict(self, which, expand_lists):
+    msgs = make_msgs(which)
+    expected = to_dict_columns(msgs, expand_lists)
+    cols = extractor_columns(msgs, expand_lists)
+
+    assert cols.keys() == expected.keys()
+    for path, values in expected.items():
+      assert len(cols[path]) == len(values)
+      for v, ref in zip(cols[path], values, strict=True):
+        if isinstance(ref, np.ndarray):
+          assert isinstance(v, np.ndarray) and v.tolist() == ref.tolist(), path
+        else:
+          assert v == ref, path
+
+  def test_drop_last(self):
+    msgs = make_msgs('managerState')
+    extractor = SchemaExtractor(msgs[0].managerState.schema)
+    extractor.extract(msgs[0].managerState)
+    cols = extractor.columns()
+
+    extractor.extract(msgs[1].managerState)
+    extractor.drop_last()
+    assert extractor.num_rows == 1
+    assert extractor.columns() == cols
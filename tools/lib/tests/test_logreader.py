@@ -4,13 +4,18 @@ import io
 import shutil
 import tempfile
 import os
+import numpy as np
 import pytest
 import requests
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, parse_indirect, ReadMode
+from openpilot.system.hardware.hw import Paths
+from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, parse_indirect, ReadMode, save_log, log_index_path, \
+                                           time_series_path, _LogFileReader
+import openpilot.tools.lib.logreader as logreader_module
+from openpilot.tools.lib.log_time_series import msgs_to_time_series
 from openpilot.tools.lib.file_sources import comma_api_source, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
@@ -255,3 +260,131 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_stream(self, ext):
+    with tempfile.NamedTemporaryFile(suffix=ext) as log:
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(valid=True, logMonoTime=i * 10 + (i % 7) * 20)
+        msg.init("carState" if i % 2 else "controlsState")
+        msgs.append(msg.as_reader())
+      save_log(log.name, msgs)
+
+      streamed = list(LogReader(log.name, stream=True))
+      assert [m.logMonoTime for m in streamed] == [m.logMonoTime for m in LogReader(log.name)]
+      assert [m.which() for m in streamed] == [m.which() for m in msgs]
+      assert LogReader(log.name, stream=True).first("carState") is not None
+
+      times = [m.logMonoTime for m in LogReader(log.name, stream=True, sort_by_time=True)]
+      assert times == sorted(times)
+
+  def test_index(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: cache_dir + "/"))
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(valid=True, logMonoTime=1000 - i)
+        msg.init("carState" if i % 10 else "controlsState")
+        msgs.append(msg.as_reader())
+      save_log(log.name, msgs)
+
+      expected = [m.logMonoTime for m in msgs if m.which() == "controlsState"]
+      lr = LogReader(log.name, use_index=True)
+      assert [m.logMonoTime for m in lr.read_events(["controlsState"])] == expected
+      assert os.path.exists(log_index_path(log.name))
+
+      # second reader loads the cached index
+      lr = LogReader(log.name, use_index=True, sort_by_time=True)
+      assert len(list(lr.filter("controlsState"))) == len(expected)
+      assert [m.logMonoTime for m in lr.read_events(start_time=100, end_time=200)] == list(range(100, 200))
+      assert len(list(lr.read_events(["carParams"]))) == 0
+
+  def test_read_events_decompresses_once(self, mocker):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      msgs = []
+      for i in range(100):
+        msg = capnp_log.Event.new_message(valid=True, logMonoTime=i)
+        msg.init("carState" if i % 10 else "controlsState")
+        msgs.append(msg.as_reader())
+      save_log(log.name, msgs)
+
+      # the index is built from the same decompressed log, not by streaming the file again
+      decompress = mocker.spy(_LogFileReader, "_decompress")
+      open_decompressed = mocker.spy(logreader_module, "open_decompressed")
+      lr = _LogFileReader(log.name)
+      for _ in range(3):
+        assert len(list(lr.read_events(["controlsState"]))) == 10
+      list(lr)
+      assert decompress.call_count == 1
+      assert open_decompressed.call_count == 0
+
+      # decompressed again after unloading
+      lr.unload()
+      assert len(list(lr.read_events(["carState"]))) == 90
+      assert decompress.call_count == 2
+
+  def test_seekable_time_range(self, mocker):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(valid=True, logMonoTime=int(i * 1e8))
+        msg.init("carState" if i % 10 else "controlsState")
+        msgs.append(msg.as_reader())
+      save_log(log.name, msgs, frame_seconds=5)
+
+      # still readable as a regular zstd log
+      assert [m.logMonoTime for m in LogReader(log.name)] == [m.logMonoTime for m in msgs]
+      assert [m.logMonoTime for m in LogReader(log.name, stream=True)] == [m.logMonoTime for m in msgs]
+
+      index_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader.index")
+      lr = LogReader(log.name)
+      events = list(lr.read_events(start_time=int(32e9), end_time=int(41e9)))
+      assert [m.logMonoTime for m in events] == [int(i * 1e8) for i in range(320, 410)]
+      assert len(list(lr.read_events(["controlsState"], start_time=int(32e9), end_time=int(41e9)))) == 9
+      assert index_mock.call_count == 0
+
+  def test_time_series_cache(self, monkeypatch):
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      monkeypatch.setattr(Paths, 'download_cache_root', staticmethod(lambda: cache_dir + "/"))
+      msgs = []
+      for i in range(100):
+        msg = capnp_log.Event.new_message(valid=True, logMonoTime=int(i * 1e7))
+        msg.init("carState").vEgo = i
+        msgs.append(msg.as_reader())
+      save_log(log.name, msgs)
+
+      expected = msgs_to_time_series(msgs)
+      ts = LogReader(log.name).time_series
+      assert os.path.exists(time_series_path(log.name))
+      assert ts.keys() == expected.keys()
+      assert np.array_equal(ts['carState']['vEgo'], expected['carState']['vEgo'])
+
+      ts = LogReader([log.name, log.name]).load_time_series(["carState/vEgo"])
+      assert list(ts['carState'].keys()) == ['t', 'vEgo']
+      assert np.array_equal(ts['carState']['vEgo'], np.tile(expected['carState']['vEgo'], 2))
+
+  def test_prefetch(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fns = []
+      for seg in range(4):
+        fn = os.path.join(tmpdir, f"{seg}.zst")
+        save_log(fn, [capnp_log.Event.new_message(valid=True, logMonoTime=seg * 1000 + i).as_reader() for i in range(100)])
+        fns.append(fn)
+
+      expected = [m.logMonoTime for m in LogReader(fns)]
+      lr = LogReader(fns, prefetch=2)
+      assert [m.logMonoTime for m in lr] == expected
+      assert [m.logMonoTime for m in lr] == expected
+
+      # the pool is only kept between runs inside a with block
+      lr = LogReader(fns)
+      assert len(lr.run_across_segments(2, noop, disable_tqdm=True)) == len(expected)
+      assert lr._pool is None
+
+      with LogReader(fns) as lr:
+        assert len(lr.run_across_segments(2, noop, disable_tqdm=True)) == len(expected)
+        pool = lr._pool
+        assert len(lr.run_across_segments(2, noop, disable_tqdm=True)) == len(expected)
+        assert lr._pool is pool
+      assert lr._pool is None
@@ -0,0 +1,41 @@
+import random
+import pytest
+
+from openpilot.tools.lib import vidindex
+from openpilot.tools.lib.framereader import HEVC_SLICE_I, HEVC_SLICE_P
+
+START_CODE = vidindex.NAL_UNIT_START_CODE
+
+
+def payload(n):
+  # no emulated start codes inside the NAL unit body
+  return bytes(random.choice((0, 1, 0x55, 0xff)) for _ in range(n)).replace(b"\x00\x00", b"\x00\x03")
+
+
+def make_stream(num_frames):
+  nals = [b"\x40\x01" + payload(20), b"\x42\x01" + payload(30), b"\x44\x01" + payload(5)]  # VPS, SPS, PPS
+  frames = []
+  for i in range(num_frames):
+    offset = 1 + sum(len(START_CODE) + len(n) for n in nals)
+    if i % 10 == 0:
+      frames.append((HEVC_SLICE_I, offset))
+      nals.append(b"\x26\x01\xac" + payload(random.randint(1, 2000)))  # IDR_W_RADL, first slice, I
+    else:
+      frames.append((HEVC_SLICE_P, offset))
+      nals.append(b"\x02\x01\xd0" + payload(random.randint(1, 2000)))  # TRAIL_R, first slice, P
+    if random.random() < 0.3:
+      nals.append(b"\x02\x01\x50" + payload(random.randint(1, 200)))  # TRAIL_R, dependent slice
+  prefix = b"".join(START_CODE + n for n in nals[:3])
+  return b"\x00" + b"".join(START_CODE + n for n in nals), frames, prefix
+
+
+class TestVidIndex:
+  @pytest.mark.parametrize("chunk_size", [7, 100, 4096, vidindex.SCAN_CHUNK_SIZE])
+  def test_hevc_index(self, tmp_path, monkeypatch, chunk_size):
+    random.seed(0)
+    dat, frames, prefix = make_stream(100)
+    fn = tmp_path / "video.hevc"
+    fn.write_bytes(dat)
+
+    monkeypatch.setattr(vidindex, "SCAN_CHUNK_SIZE", chunk_size)
+    assert vidindex.hevc_index(str(fn)) == (frames, len(dat), prefix)
@@ -3,6 +3,7 @@ import os
 import re
 import socket
 import time
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -16,39 +17,81 @@ from urllib3.exceptions import MaxRetryError
 K = 1000
 CHUNK_SIZE = 1000 * K
 CACHE_SIZE = 10 * 1024 * 1024 * 1024  # total cache size in GB
+PRUNE_TARGET = 0.9  # evict down to this fraction of CACHE_SIZE, so pruning runs in batches
+MAX_MANIFEST_APPENDS = int(CACHE_SIZE * (1 - PRUNE_TARGET)) // CHUNK_SIZE  # entries appended between compactions, one pruning batch
+MAX_CHUNKS_PER_REQUEST = 8
+MAX_CONCURRENT_REQUESTS = 8
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+# entries this process appended to each manifest since it last compacted it
+_manifest_appends: dict[str, int] = {}
+
 
 def hash_url(link: str) -> str:
   return md5((link.split("?")[0]).encode('utf-8')).hexdigest()
 
 
+def manifest_path() -> str:
+  return Paths.download_cache_root() + "manifest.txt"
+
+
 def prune_cache(new_entry: str | None = None) -> None:
   """Evicts oldest cache files (LRU) until cache is under the size limit."""
   # we use a manifest to avoid tons of os.stat syscalls (slow)
   manifest = {}
-  manifest_path = Paths.download_cache_root() + "manifest.txt"
-  if os.path.exists(manifest_path):
-    with open(manifest_path) as f:
+  if os.path.exists(manifest_path()):
+    with open(manifest_path()) as f:
       manifest = {parts[0]: int(parts[1]) for line in f if (parts := line.strip().split()) and len(parts) == 2}
 
   if new_entry:
     manifest[new_entry] = int(time.time())  # noqa: TID251
 
   # evict the least recently used files until under limit
-  sorted_items = sorted(manifest.items(), key=lambda x: x[1])
-  while len(manifest) * CHUNK_SIZE > CACHE_SIZE and sorted_items:
-    key, _ = sorted_items.pop(0)
-    try:
-      os.remove(Paths.download_cache_root() + key)
-    except OSError:
-      pass
-    manifest.pop(key, None)
+  if len(manifest) * CHUNK_SIZE > CACHE_SIZE:
+    sorted_items = sorted(manifest.items(), key=lambda x: x[1])
+    while len(manifest) * CHUNK_SIZE > CACHE_SIZE * PRUNE_TARGET and sorted_items:
+      key, _ = sorted_items.pop(0)
+      try:
+        os.remove(Paths.download_cache_root() + key)
+      except OSError:
+        pass
+      manifest.pop(key, None)
+
+  # write out compacted manifest
+  with atomic_write(manifest_path(), mode="w", overwrite=True) as f:
+    f.write(''.join(f"{k} {v}\n" for k, v in manifest.items()))
+  _manifest_appends[manifest_path()] = 0
+
+
+def touch_cache(entries: list[str]) -> None:
+  """
+    Marks cache entries as recently used by appending them to the manifest, the latest line for an entry wins.
+    The manifest is compacted and pruned the first time a process touches it, and then after every MAX_MANIFEST_APPENDS entries,
+    so the cache goes over its limit by at most one pruning batch per process.
+  """
+  path = manifest_path()
+  now = int(time.time())  # noqa: TID251
+  with open(path, "a") as f:
+    f.write("\n" + "".join(f"{k} {now}\n" for k in entries))
+
+  appends = _manifest_appends.get(path)
+  if appends is None or appends + len(entries) > MAX_MANIFEST_APPENDS:
+    prune_cache()
+  else:
+    _manifest_appends[path] = appends + len(entries)
+
+
+def coalesce_chunks(chunks: list[int], max_len: int = MAX_CHUNKS_PER_REQUEST) -> list[list[int]]:
+  """Groups sorted chunk indices into runs of adjacent chunks, at most max_len long"""
+  runs: list[list[int]] = []
+  for idx in chunks:
+    if runs and runs[-1][-1] == idx - 1 and len(runs[-1]) < max_len:
+      runs[-1].append(idx)
+    else:
+      runs.append([idx])
+  return runs
 
-  # write out manifest
-  with atomic_write(manifest_path, mode="w", overwrite=True) as f:
-    f.write('\n'.join(f"{k} {v}" for k, v in manifest.items()))
 
 class URLFileException(Exception):
   pass
@@ -118,6 +161,17 @@ class URLFile:
         file_length.write(str(self._length))
     return self._length
 
+  def _chunk_name(self, idx: int) -> str:
+    return hash_url(self._url) + "_" + str(float(idx))
+
+  def _download_chunks(self, run: list[int]) -> list[bytes]:
+    data = self.get_multi_range([(run[0] * CHUNK_SIZE, (run[-1] + 1) * CHUNK_SIZE)])[0]
+    chunks = [data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE] for i in range(len(run))]
+    for idx, chunk in zip(run, chunks, strict=True):
+      with atomic_write(os.path.join(Paths.download_cache_root(), self._chunk_name(idx)), mode="wb", overwrite=True) as new_cached_file:
+        new_cached_file.write(chunk)
+    return chunks
+
   def read(self, ll: int | None = None) -> bytes:
     if self._force_download:
       return self.read_aux(ll=ll)
@@ -125,31 +179,37 @@ class URLFile:
     file_begin = self._pos
     file_end = self._pos + ll if ll is not None else self.get_length()
     assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_url(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-        prune_cache(file_name)
-      else:
+    if file_end <= file_begin:
+      return b""
+
+    #  We have to align with chunks we store
+    first_chunk, last_chunk = file_begin // CHUNK_SIZE, (file_end - 1) // CHUNK_SIZE
+    data: dict[int, bytes] = {}
+    missing = []
+    for idx in range(first_chunk, last_chunk + 1):
+      full_path = os.path.join(Paths.download_cache_root(), self._chunk_name(idx))
+      if os.path.exists(full_path):
         with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
+          data[idx] = cached_file.read()
+      else:
+        missing.append(idx)
 
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    #  Download missing chunks, adjacent ones in a single request and separate runs concurrently
+    if missing:
+      runs = coalesce_chunks(missing)
+      if len(runs) == 1:
+        downloaded = [self._download_chunks(runs[0])]
+      else:
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(runs))) as executor:
+          downloaded = list(executor.map(self._download_chunks, runs))
+      for run, chunks in zip(runs, downloaded, strict=True):
+        data.update(zip(run, chunks, strict=True))
+      touch_cache([self._chunk_name(idx) for idx in missing])
+
+    response = b"".join(data[idx] for idx in range(first_chunk, last_chunk + 1))
+    offset = file_begin - first_chunk * CHUNK_SIZE
+    self._pos = file_end
+    return response[offset:offset + (file_end - file_begin)]
 
   def read_aux(self, ll: int | None = None) -> bytes:
     if ll is None:
@@ -17,6 +17,7 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+SCAN_CHUNK_SIZE = 4 * 1024 * 1024
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -259,37 +260,63 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
   return slice_type, is_first_slice
 
 def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
-  with FileReader(hevc_file_name) as f:
-    dat = f.read()
-
-  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
-    raise VideoFileInvalid("data is too short")
-
-  if dat[0] != 0x00:
-    raise VideoFileInvalid("first byte must be 0x00")
-
-  prefix_dat = b""
+  """
+    Indexes the frames of a raw hevc stream. The file is read in chunks and start codes are found with bytes.find,
+    so only the NAL unit being parsed and the current chunk are held in memory.
+  """
+  prefix_dat = []
   frame_types = list()
 
-  i = 1 # skip past first byte 0x00
-  try:
-    while i < len(dat):
-      require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
-      nal_unit_type = get_hevc_nal_unit_type(dat, i)
-      if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
-      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
-        slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
-        if is_first_slice:
-          frame_types.append((slice_type, i))
-      i += nal_unit_len
-  except Exception as e:
-    if not allow_corrupt:
-      raise
-    print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
-
-  return frame_types, len(dat), prefix_dat
+  with FileReader(hevc_file_name) as f:
+    buf = f.read(SCAN_CHUNK_SIZE)
+    if len(buf) < NAL_UNIT_START_CODE_SIZE + 1:
+      raise VideoFileInvalid("data is too short")
+
+    if buf[0] != 0x00:
+      raise VideoFileInvalid("first byte must be 0x00")
+
+    base = 0  # file offset of buf[0]
+    i = 1 # skip past first byte 0x00
+    search_start = i + NAL_UNIT_START_CODE_SIZE
+    eof = False
+    try:
+      require_nal_unit_start(buf, i)
+      while i < len(buf):
+        # length of NAL unit is byte count up to next NAL unit start index
+        next_start = buf.find(NAL_UNIT_START_CODE, search_start)
+        if next_start == -1 and not eof:
+          chunk = f.read(SCAN_CHUNK_SIZE)
+          if chunk:
+            # keep the unfinished NAL unit, the next start code may straddle the chunk boundary
+            search_start = len(buf) - i - (NAL_UNIT_START_CODE_SIZE - 1)
+            buf = buf[i:] + chunk
+            base += i
+            i = 0
+            search_start = max(search_start, NAL_UNIT_START_CODE_SIZE)
+          else:
+            eof = True
+          continue
+        nal_unit_len = (next_start if next_start != -1 else len(buf)) - i
+        if DEBUG:
+          print("  nal_unit_len:", nal_unit_len)
+
+        nal_unit_type = get_hevc_nal_unit_type(buf, i)
+        if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+          prefix_dat.append(buf[i:i+nal_unit_len])
+        elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
+          slice_type, is_first_slice = get_hevc_slice_type(buf, i, nal_unit_type)
+          if is_first_slice:
+            frame_types.append((slice_type, base + i))
+        i += nal_unit_len
+        search_start = i + NAL_UNIT_START_CODE_SIZE
+      dat_len = base + len(buf)
+    except Exception as e:
+      if not allow_corrupt:
+        raise
+      print(f"ERROR: NAL unit skipped @ {base + i}\n", str(e))
+      dat_len = f.get_length()
+
+  return frame_types, dat_len, b"".join(prefix_dat)
 
 def main() -> None:
   parser = argparse.ArgumentParser()